@@ -1,14 +1,25 @@
 # ai_bot.py - AWS GPU 優化版本
 import asyncio
+import concurrent.futures
 import json
 import logging
 import os
+import time
 from pathlib import Path
 from livekit import rtc, api
-from ultralytics import YOLO
 from dotenv import load_dotenv
 import torch
 
+from detection_codec import DetectionSerializer
+from engine import chain_future, create_engine
+from frame_sampler import AdaptiveFrameSampler
+from inference_worker import BatchScheduler
+from metrics import StageMetrics
+from model_cache import ModelCache
+from motion_gate import MotionGate, parse_mask
+from preprocess import I420Letterbox, livekit_i420_planes
+from resolution_ladder import ResolutionLadder, parse_ladder
+
 # --- 日誌設定 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [AI Bot] - %(message)s')
 
@@ -22,16 +33,57 @@ MODELS_DIR = os.getenv('MODELS_DIR', 'models2')
 
 # --- Bot 設定 ---
 YOLO_BOT_IDENTITY = 'yolo-bot'
-PUBLISHER_IDENTITY = 'webcam-publisher'
-FRAME_INTERVAL = 2  # 每 2 幀處理一次（降低 GPU 負載）
+PUBLISHER_IDENTITY_PREFIX = 'webcam-publisher'  # 每支手臂一台攝影機：webcam-publisher、webcam-publisher-2 ...
+FRAME_INTERVAL = 2  # 初始抽樣間隔，之後依延遲目標自動調整
+TARGET_LATENCY_MS = int(os.getenv('TARGET_LATENCY_MS', '300'))  # 端到端偵測延遲目標
+MAX_FRAME_INTERVAL = int(os.getenv('MAX_FRAME_INTERVAL', '30'))
+# 偵測結果格式：'json'（預設，相容舊客戶端）或 'binary'（見 detection_codec.py）
+DETECTION_WIRE_FORMAT = os.getenv('DETECTION_WIRE_FORMAT', 'json')
+# 發布模式：'full'（每幀完整清單）或 'delta'（只送 new / moved / lost，定期 keyframe）
+DETECTION_PUBLISH_MODE = os.getenv('DETECTION_PUBLISH_MODE', 'full')
+MAX_BATCH = int(os.getenv('MAX_BATCH', '4'))  # 一次批次推理最多幾個軌道
+TRACK_MAX_FPS = float(os.getenv('TRACK_MAX_FPS', '0'))  # 每個軌道每秒最多推理幾次（0 = 不限）
+MODEL_CACHE_MB = int(os.getenv('MODEL_CACHE_MB', '1024'))  # 模型快取的記憶體預算
+# 前處理：'i420'（直接從 I420 幀 letterbox 到模型輸入，不配置暫存影像）或 'bgr'（舊路徑）
+YOLO_PREPROCESS = os.getenv('YOLO_PREPROCESS', 'i420')
+YOLO_IMGSZ = int(os.getenv('YOLO_IMGSZ', '640'))  # 模型輸入大小（32 的倍數）
+# 推理尺寸階梯：例如 '640,480,320'，批次推理超過 INFER_BUDGET_MS 就降一級，有餘裕時升回（空 = 固定 YOLO_IMGSZ）
+YOLO_IMGSZ_LADDER = os.getenv('YOLO_IMGSZ_LADDER', '')
+INFER_BUDGET_MS = float(os.getenv('INFER_BUDGET_MS', '150'))
+# 變化偵測：變化像素比例超過 MOTION_THRESHOLD 才推理（0 = 停用），MOTION_MASK 為 'x,y,w,h;...' 正規化區域
+MOTION_THRESHOLD = float(os.getenv('MOTION_THRESHOLD', '0'))
+MOTION_MASK = os.getenv('MOTION_MASK', '')
+MOTION_MAX_STALENESS = float(os.getenv('MOTION_MAX_STALENESS', '2.0'))  # 最多沿用幾秒就強制推理
+# 各階段延遲：本機 HTTP 端點 /metrics、/metrics.json（0 = 停用），並定期把 p50/p95/p99 寫進日誌
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9109'))
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', '30'))
+# 推理後端：torch / onnx / onnx-int8 / onnx-int8-static（見 engine.py），.pt 第一次使用時匯出並快取
+YOLO_BACKEND = os.getenv('YOLO_BACKEND', 'torch')
+ONNX_CALIBRATION = os.getenv('ONNX_CALIBRATION')  # onnx-int8-static 的校正影像資料夾或影片
+ENGINE_CACHE_DIR = os.getenv('ENGINE_CACHE_DIR')
+# 多行程推理（只在 CPU 上使用）：YOLO_WORKERS 個工作行程各自載入模型（0 = 在推理執行緒中推理），建議搭配 MAX_BATCH=1
+YOLO_WORKERS = int(os.getenv('YOLO_WORKERS', '0'))
+YOLO_WORKER_THREADS = int(os.getenv('YOLO_WORKER_THREADS', '0'))  # 每個行程的執行緒數（0 = 平分 CPU 核心）
+CONF_THRESHOLD = 0.5  # 信心度閾值
 
 class AIBot:
     def __init__(self, models_dir: str):
         self.models_dir = Path(models_dir)
-        self.current_model = None
-        self.current_model_name = None
+        # (model_name, model, serializers, last_detections) 整組替換，推理執行緒讀到的一定是一致的組合
+        self.active = None
+        # 被淘汰的模型立即釋放（多行程引擎要關閉工作行程與共享記憶體）
+        self.model_cache = ModelCache(MODEL_CACHE_MB * 1024 * 1024, on_evict=lambda engine: engine.close())
+        self.loader = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='model-loader')
+        self.switch_lock = asyncio.Lock()
         self.room = None
-        self.frame_count = 0
+        # 每個軌道各自的幀計數與抽樣器
+        self.frame_counts = {}
+        self.samplers = {}
+        self.motion_gates = {}
+        self.scheduler = None
+        self.ladder = ResolutionLadder(parse_ladder(YOLO_IMGSZ_LADDER, YOLO_IMGSZ), INFER_BUDGET_MS / 1000)
+        self.preprocessor = I420Letterbox(self.ladder.size, max_batch=MAX_BATCH)
+        self.metrics = StageMetrics('ai_bot')
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
         logging.info(f"Device: {self.device}")
@@ -55,103 +107,274 @@ class AIBot:
         models = [f.name for f in self.models_dir.glob('*.pt')]
         return sorted(models)
 
-    def load_model(self, model_name: str):
-        """載入 YOLO 模型"""
-        model_path = self.models_dir / model_name
+    def _model_size(self, engine, model_path: Path):
+        """估計模型佔用的記憶體（參數 / ONNX 檔大小），失敗時以 .pt 檔案大小代替"""
+        try:
+            return engine.size_bytes
+        except Exception:
+            return model_path.stat().st_size
 
+    def _prepare_model(self, model_name: str):
+        """取得可直接使用的模型：先查快取，沒有才從磁碟載入並暖機（在背景執行緒中執行）"""
+        model = self.model_cache.get(model_name)
+        if model is not None:
+            return model
+
+        model_path = self.models_dir / model_name
         if not model_path.exists():
-            logging.error(f"Model not found: {model_path}")
-            return False
+            raise FileNotFoundError(f"Model not found: {model_path}")
+
+        logging.info(f"Loading model: {model_name} (backend={YOLO_BACKEND})")
+        engine = create_engine(str(model_path), YOLO_BACKEND, device=self.device, imgsz=self.ladder.sizes[0],
+                               conf=CONF_THRESHOLD, half=self.device == 'cuda',  # FP16 加速
+                               cache_dir=ENGINE_CACHE_DIR, calibration=ONNX_CALIBRATION, threads=YOLO_WORKER_THREADS,
+                               workers=YOLO_WORKERS if self.device == 'cpu' else 0, max_batch=MAX_BATCH)
+        # 用假影像跑一次推理，讓 CUDA kernel / FP16 轉換在換上線前完成（階梯中的每個尺寸都要）
+        for size in self.ladder.sizes:
+            engine.warm_up(imgsz=size)
+        # 目前使用中的模型可能還有批次在推理，換上新模型前不能淘汰（關閉）它；超出預算的部分留到下次載入時再淘汰
+        active = self.active
+        self.model_cache.put(model_name, engine, self._model_size(engine, model_path),
+                             pinned=(active[0],) if active else ())
+        return engine
+
+    def _activate(self, model_name: str, model):
+        """原子替換目前使用的模型"""
+        # 換模型時類別表不同，各軌道的追蹤狀態與沿用的偵測結果也要重新開始（在推理執行緒中依軌道建立）
+        self.active = (model_name, model, {}, {})
+        # 變化偵測的基準畫面與推理時間也屬於舊模型，換成新的（整個 dict 替換，推理執行緒手上的舊物件不受影響）
+        self.motion_gates = {key: self._new_motion_gate() for key in self.motion_gates}
 
+    def load_model(self, model_name: str):
+        """同步載入 YOLO 模型（啟動時使用）"""
         try:
-            logging.info(f"Loading model: {model_name}")
-            self.current_model = YOLO(str(model_path))
-            self.current_model.to(self.device)
-            self.current_model_name = model_name
+            self._activate(model_name, self._prepare_model(model_name))
             logging.info(f"Model loaded successfully: {model_name}")
             return True
         except Exception as e:
             logging.error(f"Failed to load model {model_name}: {e}")
             return False
 
+    async def switch_model(self, model_name: str):
+        """在背景載入並暖機模型後再替換；載入期間繼續用舊模型推理"""
+        async with self.switch_lock:
+            start = time.monotonic()
+            cached = model_name in self.model_cache
+            try:
+                model = await asyncio.get_running_loop().run_in_executor(
+                    self.loader, self._prepare_model, model_name
+                )
+            except Exception as e:
+                logging.error(f"Failed to load model {model_name}: {e}")
+                return False
+
+            self._activate(model_name, model)
+            elapsed_ms = (time.monotonic() - start) * 1000
+            logging.info(
+                f"Model switched to {model_name} in {elapsed_ms:.0f} ms "
+                f"({'cache hit' if cached else 'loaded from disk'}, "
+                f"cache hit rate {self.model_cache.hit_rate:.0%}, "
+                f"cached {self.model_cache.total_bytes / 1e6:.0f} MB)"
+            )
+            return True
+
     async def broadcast_model_list(self):
         """廣播模型列表給所有參與者"""
         if not self.room:
             return
 
+        model_name, model = self.active[:2] if self.active else (None, None)
+        serializer = DetectionSerializer(model.names, DETECTION_WIRE_FORMAT, DETECTION_PUBLISH_MODE) if model else None
+        scheduler_stats = self.scheduler.stats()['tracks'] if self.scheduler else {}
         payload = {
             'type': 'modelList',
             'models': self.available_models,
-            'current': self.current_model_name
+            'current': model_name,
+            'backend': model.backend if model else None,  # 實際建立的後端（ONNX 失敗退回 torch 時不同於 YOLO_BACKEND）
+            # 二進位格式用的類別名稱表（class id -> label）
+            'classes': serializer.classes if serializer else [],
+            'wireFormat': serializer.wire_format if serializer else 'json',
+            'publishMode': DETECTION_PUBLISH_MODE,
+            # 各攝影機目前的抽樣設定與統計，讓客戶端知道實際偵測速率
+            'tracks': {
+                key: {**sampler.stats(), **scheduler_stats.get(key, {}),
+                      'motion': self.motion_gates[key].stats() if key in self.motion_gates else None}
+                for key, sampler in self.samplers.items()
+            },
+            'preprocess': self.preprocessor.stats(),
+            'resolution': self.ladder.stats(),
+            'latency': self.metrics.summary()
         }
 
         data = json.dumps(payload).encode('utf-8')
         await self.room.local_participant.publish_data(data, kind=api.DataPacketKind.RELIABLE)
         logging.info(f"Broadcasted model list: {self.available_models}")
 
-    def on_frame_received(self, event: rtc.VideoFrameEvent):
+    def on_frame_received(self, key: str, event: rtc.VideoFrameEvent):
         """處理接收到的影像幀（事件驅動）"""
-        self.frame_count += 1
+        count = self.frame_counts.get(key, 0) + 1
+        self.frame_counts[key] = count
 
-        # 幀抽樣：每 N 幀處理一次
-        if self.frame_count % FRAME_INTERVAL != 0:
+        # 幀抽樣：間隔由延遲目標與推理耗時動態決定（每個軌道各自調整）
+        sampler = self.samplers.get(key)
+        if sampler is None or not sampler.should_process():
             return
 
-        if not self.current_model:
+        if not self.active or not self.scheduler:
             return
 
-        # 轉換影像格式
-        frame = event.frame
-        arr = frame.to_ndarray(format="bgr24")
-
-        # YOLO 推理（GPU）
-        try:
-            results = self.current_model.predict(
-                arr,
-                verbose=False,
-                device=self.device,
-                conf=0.5,  # 信心度閾值
-                half=True if self.device == 'cuda' else False  # FP16 加速
-            )
-
-            # 準備偵測結果
-            detections = []
-            for r in results:
-                for box in r.boxes:
-                    x_center, y_center, width, height = box.xyn[0].tolist()
-                    x = x_center - (width / 2)
-                    y = y_center - (height / 2)
-
-                    detections.append({
-                        'label': self.current_model.names[int(box.cls)],
-                        'confidence': float(box.conf),
-                        'box': [x, y, width, height]
-                    })
-
-            # 廣播結果
-            if detections:
-                asyncio.create_task(self._send_detections(detections))
-
-        except Exception as e:
-            logging.error(f"YOLO prediction error: {e}")
-
-    async def _send_detections(self, detections):
-        """發送偵測結果"""
+        # 只交給排程器，不在事件迴圈中做轉換與推理
+        self.scheduler.submit(key, (count, event.timestamp_us, event.frame, time.monotonic()))
+
+    def _infer_batch(self, batch):
+        """
+        在推理執行緒中執行批次 YOLO 推理，回傳各軌道序列化後的偵測結果；
+        多行程引擎回傳 Future，後處理與序列化在結果回來後完成
+        """
+        if not self.active:
+            return [None] * len(batch)
+        active = self.active
+        _, model, serializers, last_detections = active
+
+        # receive：幀從事件迴圈收到到被排程器取出的等待時間
+        now = time.monotonic()
+        for _, (_, _, _, received_at) in batch:
+            self.metrics.observe('receive', now - received_at)
+
+        # 變化偵測：畫面沒變（且有上次結果）的軌道不推理，沿用上一次的偵測結果
+        with self.metrics.time('motion'):
+            planes = [livekit_i420_planes(frame) for _, (_, _, frame, _) in batch]
+            infer = []
+            for (key, _), (y_plane, _, _) in zip(batch, planes):
+                gate = self.motion_gates.get(key)
+                # 先呼叫 should_infer()：第一幀也要記錄成變化偵測的基準畫面
+                changed = gate is None or gate.should_infer(y_plane)
+                infer.append(changed or key not in last_detections)
+        selected = [i for i, run in enumerate(infer) if run]
+
+        if selected:
+            # 這一批使用的推理尺寸；座標經由各幀的 LetterboxInfo 換回原圖，與尺寸無關
+            size = self.ladder.size
+            # 轉換影像格式
+            with self.metrics.time('convert'):
+                if YOLO_PREPROCESS == 'i420':
+                    # 直接從 I420 平面 letterbox 進預先配置的 float32 批次陣列，零複製交給模型
+                    self.preprocessor.set_imgsz(size)
+                    self.preprocessor.begin_batch()
+                    letterboxes = [self.preprocessor.add(*planes[i]) for i in selected]
+                else:
+                    letterboxes = [None] * len(selected)
+                    images = [batch[i][1][2].to_ndarray(format="bgr24") for i in selected]
+
+            # YOLO 推理（GPU），一次處理所有需要推理的軌道
+            start = time.monotonic()
+            if YOLO_PREPROCESS == 'i420' and model.asynchronous:
+                future = model.detect_async(self.preprocessor.batch())
+                return chain_future(future, lambda results: self._finish_batch(
+                    active, batch, infer, selected, letterboxes, results, time.monotonic() - start, size))
+            if YOLO_PREPROCESS == 'i420':
+                results = model.detect(self.preprocessor.batch())
+            else:
+                results = model.detect_images(images, size)
+            return self._finish_batch(active, batch, infer, selected, letterboxes, results,
+                                      time.monotonic() - start, size)
+        return self._finish_batch(active, batch, infer, selected, [], [], 0.0, None)
+
+    def _finish_batch(self, active, batch, infer, selected, letterboxes, results, elapsed, size):
+        """後處理推理結果，並把所有軌道（含沿用結果的）序列化成要發送的內容"""
+        _, model, serializers, last_detections = active
+        if selected:
+            self.metrics.observe('infer', elapsed)
+            self.ladder.record(elapsed, size)
+
+            # 一個批次的耗時由其中的軌道分攤，否則 N 個軌道一起推理時每個抽樣器都會看到 N 倍的成本
+            per_frame = elapsed / len(selected)
+            for i, rows, letterbox in zip(selected, results, letterboxes):
+                key = batch[i][0]
+                sampler = self.samplers.get(key)
+                if sampler:
+                    sampler.record_inference(per_frame)
+                gate = self.motion_gates.get(key)
+                if gate:
+                    gate.record_inference(per_frame)
+
+                # 準備偵測結果
+                with self.metrics.time('postprocess'):
+                    detections = []
+                    for x, y, width, height, confidence, class_id in rows.tolist():
+                        box_xywh = [x, y, width, height]
+                        if letterbox is not None:
+                            # 模型輸入上的座標換回原圖座標
+                            box_xywh = letterbox.unletterbox(*box_xywh)
+
+                        detections.append({
+                            'label': model.names[int(class_id)],
+                            'confidence': confidence,
+                            'box': box_xywh
+                        })
+                    last_detections[key] = detections
+
+        payloads = []
+        for (key, (seq, timestamp_us, _, received_at)), run in zip(batch, infer):
+            # 追蹤 + 序列化；沒有需要發送的內容時為 None
+            serializer = serializers.get(key)
+            if serializer is None:
+                serializer = DetectionSerializer(model.names, DETECTION_WIRE_FORMAT, DETECTION_PUBLISH_MODE)
+                serializers[key] = serializer
+            with self.metrics.time('serialize'):
+                payload = serializer.serialize(last_detections[key], seq, timestamp_us, reused=not run)
+            # 擷取時間戳與收到的時間一路帶到發布，用來計算端到端延遲
+            payloads.append((payload, timestamp_us, received_at) if payload is not None else None)
+
+        return payloads
+
+    async def _send_detections(self, key: str, result):
+        """發送偵測結果，topic 標示來源攝影機"""
         if not self.room:
             return
 
-        payload = json.dumps(detections).encode('utf-8')
+        payload, timestamp_us, received_at = result
+        start = time.monotonic()
         try:
             await self.room.local_participant.publish_data(
                 payload,
-                kind=api.DataPacketKind.RELIABLE
+                kind=api.DataPacketKind.RELIABLE,
+                topic=key
             )
         except Exception as e:
-            logging.warning(f"Failed to send detections: {e}")
+            logging.warning(f"Failed to send detections for {key}: {e}")
+            return
+        now = time.monotonic()
+        self.metrics.observe('publish', now - start)
+        # pipeline：Bot 內部從收到幀到送出結果；e2e：從擷取時間戳算起（需為 wall clock）
+        self.metrics.observe('pipeline', now - received_at)
+        self.metrics.observe_e2e(timestamp_us)
+
+    def add_track(self, key: str, track: rtc.Track):
+        """開始處理某個發布者的影像軌道"""
+        self.frame_counts[key] = 0
+        self.samplers[key] = AdaptiveFrameSampler(
+            target_latency=TARGET_LATENCY_MS / 1000,
+            initial_interval=FRAME_INTERVAL,
+            max_interval=MAX_FRAME_INTERVAL
+        )
+        self.motion_gates[key] = self._new_motion_gate()
+        self.scheduler.add_track(key, TRACK_MAX_FPS)
+        # 註冊幀接收事件
+        track.on("frame_received", lambda event: self.on_frame_received(key, event))
+
+    def _new_motion_gate(self):
+        return MotionGate(MOTION_THRESHOLD, mask=parse_mask(MOTION_MASK), max_staleness=MOTION_MAX_STALENESS)
+
+    def remove_track(self, key: str):
+        self.samplers.pop(key, None)
+        self.motion_gates.pop(key, None)
+        self.frame_counts.pop(key, None)
+        self.scheduler.remove_track(key)
 
     async def on_data_received(self, data_packet: rtc.DataPacket, participant):
         """處理接收到的指令"""
-        if participant.identity != PUBLISHER_IDENTITY:
+        if not participant.identity.startswith(PUBLISHER_IDENTITY_PREFIX):
             return
 
         try:
@@ -161,9 +384,8 @@ class AIBot:
             if msg_type == 'setModel':
                 model_name = message.get('model')
                 if model_name in self.available_models:
-                    if self.load_model(model_name):
+                    if await self.switch_model(model_name):
                         await self.broadcast_model_list()
-                        logging.info(f"Model switched to: {model_name}")
                 else:
                     logging.warning(f"Invalid model requested: {model_name}")
 
@@ -188,6 +410,16 @@ class AIBot:
 
         self.room = rtc.Room()
 
+        # 推理執行緒：所有攝影機共用一個模型，事件迴圈只負責交付幀與發布結果
+        self.scheduler = BatchScheduler(self._infer_batch, self._send_detections, asyncio.get_running_loop(),
+                                        max_batch=MAX_BATCH, max_fps=TRACK_MAX_FPS)
+        self.scheduler.start()
+        if METRICS_PORT:
+            self.metrics.start_http_server(METRICS_PORT, extra=lambda: {
+                'scheduler': self.scheduler.stats(), 'modelCache': self.model_cache.stats(),
+                'resolution': self.ladder.stats()})
+        self.metrics.start_reporter(METRICS_LOG_INTERVAL)
+
         # 註冊事件處理器
         @self.room.on("track_subscribed")
         def on_track_subscribed(
@@ -195,10 +427,19 @@ class AIBot:
             publication: rtc.RemoteTrackPublication,
             participant: rtc.RemoteParticipant
         ):
-            if track.kind == rtc.TrackKind.KIND_VIDEO and participant.identity == PUBLISHER_IDENTITY:
+            if track.kind == rtc.TrackKind.KIND_VIDEO and participant.identity.startswith(PUBLISHER_IDENTITY_PREFIX):
                 logging.info(f"Subscribed to video from {participant.identity}")
-                # 註冊幀接收事件
-                track.on("frame_received", self.on_frame_received)
+                self.add_track(participant.identity, track)
+
+        @self.room.on("track_unsubscribed")
+        def on_track_unsubscribed(
+            track: rtc.Track,
+            publication: rtc.RemoteTrackPublication,
+            participant: rtc.RemoteParticipant
+        ):
+            if track.kind == rtc.TrackKind.KIND_VIDEO and participant.identity.startswith(PUBLISHER_IDENTITY_PREFIX):
+                logging.info(f"Unsubscribed from video of {participant.identity}")
+                self.remove_track(participant.identity)
 
         @self.room.on("data_received")
         def on_data_received(data_packet: rtc.DataPacket, participant):
@@ -208,7 +449,7 @@ class AIBot:
         async def on_participant_connected(participant: rtc.RemoteParticipant):
             logging.info(f"Participant connected: {participant.identity}")
             # 新參與者加入時廣播模型列表
-            if participant.identity == PUBLISHER_IDENTITY:
+            if participant.identity.startswith(PUBLISHER_IDENTITY_PREFIX):
                 await asyncio.sleep(1)  # 等待連接穩定
                 await self.broadcast_model_list()
 
@@ -227,6 +468,10 @@ class AIBot:
         except Exception as e:
             logging.error(f"Error: {e}", exc_info=True)
         finally:
+            self.scheduler.stop()
+            self.metrics.stop()
+            self.loader.shutdown(wait=False)
+            self.model_cache.clear()
             if self.room:
                 await self.room.disconnect()
             logging.info("Bot shutdown complete")
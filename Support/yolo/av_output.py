@@ -0,0 +1,296 @@
+# av_output.py - 以 PyAV 在行程內編碼 H.264 並推到 RTMP / SRT / UDP（或寫檔），取代 ffmpeg 子行程 + 原始幀管道
+#
+# SharedEncoder 與 FFmpegFeeder 相同的介面（submit / stats / close），在獨立執行緒編碼、佇列滿了丟最舊的幀；
+# 編好的封包分送給每個 PacketSink，各自在自己的執行緒封裝送出（同一組編碼設定的輸出共用一次編碼）。
+# 某個輸出卡住時只丟它自己的封包並等下一個關鍵幀再接上；連線中斷時只重開該輸出（每 reconnect_delay 秒重試），
+# 擷取、推理與其他輸出照常運作。編碼參數與原本的 ffmpeg 命令相同：libx264 veryfast + zerolatency、無 B 幀、固定 GOP，
+# 編碼器開啟 global header（FLV / MP4 的檔頭需要 AVCDecoderConfigurationRecord，複製到每個輸出的 extradata），
+# 同時用 repeat-headers 讓 SPS/PPS 也放在每個關鍵幀前，中途加入或重連的輸出（MPEG-TS / UDP）從關鍵幀就能解碼。
+# 需要 PyAV >= 13。
+#
+#   python av_output.py out.flv --seconds 5                      寫檔測試
+#   python av_output.py udp://127.0.0.1:5000?pkt_size=1316      另開 ffplay udp://127.0.0.1:5000 觀看
+#   python av_output.py a.flv b.ts                               共用編碼器同時寫兩個輸出
+# srt:// 需要 PyAV 內建的 FFmpeg 有編入 libsrt。
+import collections
+import logging
+import threading
+import time
+from fractions import Fraction
+
+import av
+
+from ffmpeg_feeder import FFmpegFeeder, container_format
+
+logger = logging.getLogger(__name__)
+
+
+def _copy_packet(packet):
+    # 每個輸出各自一份：封裝時會改寫時間戳
+    copy = av.Packet(bytes(packet))
+    copy.pts = packet.pts
+    copy.dts = packet.dts
+    copy.time_base = packet.time_base
+    copy.is_keyframe = packet.is_keyframe
+    return copy
+
+
+class PacketSink:
+    """
+    單一輸出網址：有上限的封包佇列 + 自己的封裝執行緒。
+    佇列滿了（輸出跟不上）就清空並丟到下一個關鍵幀；開啟或寫入失敗時關閉輸出，reconnect_delay 秒後重開。
+    """
+
+    def __init__(self, url: str, max_packets: int = 60, reconnect_delay: float = 1.0):
+        self.url = url
+        self.format = container_format(url)
+        self.max_packets = max_packets
+        self.reconnect_delay = reconnect_delay
+        self._template = None
+        self._container = None
+        self._stream = None
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._need_keyframe = True
+        self._thread = None
+        self.connects = 0
+        self.muxed = 0
+        self.dropped = 0   # 佇列滿了或重連時清掉的封包
+        self.skipped = 0   # 等關鍵幀期間沒有送出的封包
+        self.errors = 0
+        self.max_depth = 0
+
+    def start(self, template):
+        """template：編碼器的 stream（複製編碼參數用）"""
+        self._template = template
+        self._thread = threading.Thread(target=self._run, name=f'mux-{self.format or "file"}', daemon=True)
+        self._thread.start()
+
+    def put(self, packet):
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._queue) >= self.max_packets:
+                self.dropped += len(self._queue)
+                self._queue.clear()
+                self._need_keyframe = True
+            if self._need_keyframe and not packet.is_keyframe:
+                self.skipped += 1
+                return
+            self._need_keyframe = False
+            self._queue.append(_copy_packet(packet))
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                packet = self._queue.popleft()
+            try:
+                if self._container is None:
+                    self._open()
+                packet.stream = self._stream
+                self._container.mux(packet)
+                self.muxed += 1
+            except av.error.FFmpegError as e:
+                self.errors += 1
+                logger.error(f"Output {self.url} failed, reconnecting in {self.reconnect_delay}s: {e}")
+                self._close_container()
+                with self._cond:
+                    # 重連後從關鍵幀開始
+                    self.dropped += len(self._queue)
+                    self._queue.clear()
+                    self._need_keyframe = True
+                    self._cond.wait_for(lambda: self._closed, self.reconnect_delay)
+                    if self._closed:
+                        return
+
+    def _open(self):
+        container = av.open(self.url, mode='w', format=self.format, timeout=5.0)
+        try:
+            stream = container.add_stream_from_template(self._template)
+            # add_stream_from_template 不會複製 extradata（SPS/PPS），FLV / MP4 寫檔頭時需要
+            stream.codec_context.extradata = self._template.codec_context.extradata
+        except Exception:
+            container.close()
+            raise
+        self._container, self._stream = container, stream
+        self.connects += 1
+        logger.info(f"Output opened: {self.url} ({self.format or 'by extension'})")
+
+    def _close_container(self):
+        container, self._container = self._container, None
+        self._stream = None
+        if container is not None:
+            try:
+                container.close()
+            except av.error.FFmpegError as e:
+                logger.warning(f"Closing output {self.url} failed: {e}")
+
+    def close(self, timeout: float = 2.0):
+        """送完佇列中的封包（最多等 timeout 秒）後寫完檔尾並關閉"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._thread is None or not self._thread.is_alive():
+            self._close_container()
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'connected': self._container is not None,
+            'connects': self.connects,
+            'muxed': self.muxed,
+            'dropped': self.dropped,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'queueDepth': len(self._queue),
+            'maxQueueDepth': self.max_depth,
+        }
+
+
+class SharedEncoder(FFmpegFeeder):
+    """一次編碼，封包分送給多個 PacketSink；encoder_key() 相同的輸出可以共用同一個 SharedEncoder"""
+
+    def __init__(self, width: int, height: int, fps: int, bitrate: str = "3000k", bufsize: str = None,
+                 gop: int = None, preset: str = "veryfast", i420: bool = True, max_queue: int = 2,
+                 stall_threshold: float = None):
+        self.fps = fps
+        self.bitrate = bitrate
+        self.bufsize = bufsize  # 預設為碼率的兩倍（同 ingross.py 的命令）
+        self.gop = gop or fps
+        self.preset = preset
+        self.sinks = []
+        self._started = None
+        self._last_pts = -1
+        # 編碼器掛在不輸出的 null 容器上，只用來當各輸出 stream 的範本
+        self._home = av.open('null', mode='w', format='null')
+        kbps = int(bitrate.lower().rstrip('k'))
+        self._stream = self._home.add_stream('libx264', rate=fps, options={
+            'preset': preset,
+            'tune': 'zerolatency',
+            'g': str(self.gop),
+            'keyint_min': str(self.gop),
+            'bf': '0',
+            'maxrate': f"{kbps}k",
+            'bufsize': bufsize or f"{kbps * 2}k",
+            # global header 會讓 x264 不再在關鍵幀前重複 SPS/PPS，這裡明確要求重複
+            'x264-params': 'repeat-headers=1',
+        })
+        self._stream.width = width
+        self._stream.height = height
+        self._stream.pix_fmt = 'yuv420p'
+        self._stream.bit_rate = kbps * 1000
+        # 產生 extradata：RTMP（FLV）的檔頭需要 AVCDecoderConfigurationRecord
+        self._stream.codec_context.flags |= av.codec.context.Flags.global_header.value
+        self._stream.codec_context.open()
+        super().__init__(None, width, height, i420=i420, max_queue=max_queue,
+                         stall_threshold=stall_threshold or 1.0 / fps)
+
+    @staticmethod
+    def encoder_key(width, height, fps, bitrate="3000k", bufsize=None, gop=None, preset="veryfast"):
+        return (width, height, fps, bitrate, bufsize, gop or fps, preset)
+
+    def add_output(self, url: str, max_packets: int = None, reconnect_delay: float = 1.0) -> PacketSink:
+        # 預設最多積壓約 2 秒的封包
+        sink = PacketSink(url, max_packets or max(2 * self.fps, 30), reconnect_delay)
+        sink.start(self._stream)
+        self.sinks.append(sink)
+        return sink
+
+    def _send(self, frame):
+        if self._started is None:
+            self._started = self.timestamp
+        # 時間戳依擷取時間計算：丟幀時播放端不會加速
+        pts = max(round((self.timestamp - self._started) * self.fps), self._last_pts + 1)
+        video_frame = av.VideoFrame.from_ndarray(frame, format=self.pix_fmt)
+        video_frame.pts = pts
+        video_frame.time_base = Fraction(1, self.fps)
+        self._last_pts = pts
+        try:
+            packets = self._stream.encode(video_frame)
+        except av.error.FFmpegError as e:
+            raise OSError(f"encode failed: {e}") from e
+        for packet in packets:
+            for sink in self.sinks:
+                sink.put(packet)
+
+    def _failed(self, error):
+        # 編碼錯誤只丟掉這一幀；輸出端的錯誤由各 PacketSink 自行重連
+        logger.error(f"Encoder error: {error}")
+
+    def close(self, timeout: float = 2.0):
+        super().close(timeout)
+        if self._thread.is_alive():
+            # 送幀執行緒還在 _send() 裡編碼：不能從這個執行緒同時使用同一個編碼器，放棄送出剩下的幀
+            logger.warning(f"Encoder thread still busy after {timeout}s, skipping encoder flush")
+        else:
+            # 送幀執行緒已停止：送出編碼器剩下的幀，再讓各輸出寫完檔尾
+            try:
+                for packet in self._stream.encode():
+                    for sink in self.sinks:
+                        sink.put(packet)
+            except av.error.FFmpegError as e:
+                logger.warning(f"Flushing encoder failed: {e}")
+        for sink in self.sinks:
+            sink.close(timeout)
+        self._home.close()
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({'backend': 'pyav', 'bitrate': self.bitrate, 'outputs': [sink.stats() for sink in self.sinks]})
+        return stats
+
+
+class AVOutput(SharedEncoder):
+    """只有一個輸出網址的 SharedEncoder"""
+
+    def __init__(self, url: str, width: int, height: int, fps: int, bitrate: str = "3000k", bufsize: str = None,
+                 gop: int = None, preset: str = "veryfast", i420: bool = True, max_queue: int = 2,
+                 reconnect_delay: float = 1.0, stall_threshold: float = None):
+        super().__init__(width, height, fps, bitrate=bitrate, bufsize=bufsize, gop=gop, preset=preset, i420=i420,
+                         max_queue=max_queue, stall_threshold=stall_threshold)
+        self.url = url
+        self.add_output(url, reconnect_delay=reconnect_delay)
+
+
+def _selftest(urls, seconds=5.0, width=640, height=480, fps=15):
+    """送出移動方塊的合成畫面，檢查編碼 / 封裝與各輸出的統計"""
+    import numpy as np
+    output = SharedEncoder(width, height, fps)
+    for url in urls:
+        output.add_output(url)
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    start = time.monotonic()
+    n = 0
+    try:
+        while time.monotonic() - start < seconds:
+            frame[:] = 32
+            x = int((n * 8) % (width - 80))
+            frame[height // 2 - 40:height // 2 + 40, x:x + 80] = (0, 200, 255)
+            output.submit(frame)
+            n += 1
+            time.sleep(max(start + n / fps - time.monotonic(), 0))
+    finally:
+        output.close()
+    print(output.stats())
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+    parser = argparse.ArgumentParser(description="PyAV output self-test with synthetic frames")
+    parser.add_argument('urls', nargs='+', help="Output files or rtmp:// / srt:// / udp:// URLs (one shared encoder)")
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--fps', type=int, default=15)
+    args = parser.parse_args()
+    _selftest(args.urls, args.seconds, args.width, args.height, args.fps)
@@ -0,0 +1,365 @@
+# detection_codec.py - 偵測結果的精簡二進位格式（Data Channel 用）
+#
+# 格式 v1（little-endian）：
+#   header (18 bytes)
+#     magic      2s   b'YD'（JSON 一定以 '[' 或 '{' 開頭，可直接區分）
+#     version    u8   目前為 1
+#     flags      u8   保留旗標
+#     seq        u32  幀序號（溢位後從 0 重新開始）
+#     timestamp  u64  擷取時間戳（微秒）
+#     count      u16  偵測框數量
+#   每個偵測框 (11 bytes)
+#     class_id   u16  對應 modelList 廣播中的 classes 陣列索引
+#     confidence u8   信心度 * 255
+#     x, y, w, h u16  左上角正規化座標 * 65535
+#
+# 格式 v2（追蹤版）：header 相同，flags bit0 = keyframe，bit1 = reused（畫面沒變，沿用上次推理結果）
+#   每個項目 (14 bytes)
+#     track_id   u16  持續的追蹤 id（溢位後循環）
+#     op         u8   0=keyframe 完整項目, 1=new, 2=moved, 3=lost（lost 只有 id 有意義）
+#     confidence u8
+#     class_id   u16
+#     x, y, w, h u16
+import json
+import struct
+import time
+
+from tracker import DeltaPublisher, IoUTracker
+
+MAGIC = b'YD'
+VERSION = 1
+VERSION_TRACKED = 2
+WIRE_FORMAT = 'yd1'
+WIRE_FORMAT_TRACKED = 'yd2'
+
+FLAG_KEYFRAME = 0x01
+FLAG_REUSED = 0x02
+OP_TRACK, OP_NEW, OP_MOVED, OP_LOST = 0, 1, 2, 3
+
+HEADER = struct.Struct('<2sBBIQH')
+BOX = struct.Struct('<HB4H')
+TRACK_BOX = struct.Struct('<HBBH4H')
+
+_COORD_SCALE = 65535
+_CONF_SCALE = 255
+
+
+def class_table(names):
+    """將 YOLO 的 model.names（dict 或 list）轉成依 class id 排序的名稱陣列"""
+    if isinstance(names, dict):
+        size = max(names) + 1 if names else 0
+        return [names.get(i, str(i)) for i in range(size)]
+    return list(names)
+
+
+def _quantize(value, scale):
+    if value <= 0.0:
+        return 0
+    if value >= 1.0:
+        return scale
+    return int(value * scale + 0.5)
+
+
+def is_binary(payload: bytes) -> bool:
+    return payload[:2] == MAGIC
+
+
+class DetectionEncoder:
+    """將 bots 產生的偵測 dict 列表編碼成二進位封包"""
+
+    def __init__(self, names):
+        self.classes = class_table(names)
+        self._ids = {name: i for i, name in enumerate(self.classes)}
+
+    def encode(self, detections, seq: int, timestamp_us: int = None, flags: int = 0) -> bytes:
+        if timestamp_us is None:
+            timestamp_us = int(time.time() * 1e6)
+        out = bytearray(HEADER.size + BOX.size * len(detections))
+        HEADER.pack_into(out, 0, MAGIC, VERSION, flags, seq & 0xFFFFFFFF,
+                         timestamp_us & 0xFFFFFFFFFFFFFFFF, len(detections))
+        offset = HEADER.size
+        for det in detections:
+            x, y, w, h = det['box']
+            BOX.pack_into(out, offset,
+                          self._ids.get(det['label'], 0xFFFF),
+                          _quantize(det['confidence'], _CONF_SCALE),
+                          _quantize(x, _COORD_SCALE), _quantize(y, _COORD_SCALE),
+                          _quantize(w, _COORD_SCALE), _quantize(h, _COORD_SCALE))
+            offset += BOX.size
+        return bytes(out)
+
+    def encode_tracks(self, message, seq: int, timestamp_us: int = None, flags: int = 0) -> bytes:
+        """編碼 tracker / DeltaPublisher 產生的訊息（v2 格式）"""
+        if timestamp_us is None:
+            timestamp_us = int(time.time() * 1e6)
+        if message['keyframe']:
+            entries = [(OP_TRACK, t) for t in message['tracks']]
+        else:
+            entries = ([(OP_NEW, t) for t in message['new']] +
+                       [(OP_MOVED, t) for t in message['moved']] +
+                       [(OP_LOST, {'id': i}) for i in message['lost']])
+
+        out = bytearray(HEADER.size + TRACK_BOX.size * len(entries))
+        if message['keyframe']:
+            flags |= FLAG_KEYFRAME
+        HEADER.pack_into(out, 0, MAGIC, VERSION_TRACKED, flags,
+                         seq & 0xFFFFFFFF, timestamp_us & 0xFFFFFFFFFFFFFFFF, len(entries))
+        offset = HEADER.size
+        for op, t in entries:
+            if op == OP_LOST:
+                TRACK_BOX.pack_into(out, offset, t['id'] & 0xFFFF, op, 0, 0, 0, 0, 0, 0)
+            else:
+                x, y, w, h = t['box']
+                TRACK_BOX.pack_into(out, offset, t['id'] & 0xFFFF, op,
+                                    _quantize(t['confidence'], _CONF_SCALE),
+                                    self._ids.get(t['label'], 0xFFFF),
+                                    _quantize(x, _COORD_SCALE), _quantize(y, _COORD_SCALE),
+                                    _quantize(w, _COORD_SCALE), _quantize(h, _COORD_SCALE))
+            offset += TRACK_BOX.size
+        return bytes(out)
+
+
+class DetectionSerializer:
+    """
+    bots 共用的輸出階段：追蹤 -> 完整/差量 -> JSON/二進位。
+    只在推理執行緒中呼叫（tracker 不是 thread-safe）。
+    """
+
+    def __init__(self, names, wire_format: str = 'json', publish_mode: str = 'full'):
+        self.encoder = DetectionEncoder(names)
+        self.binary = wire_format == 'binary'
+        self.delta = publish_mode == 'delta'
+        self.tracker = IoUTracker()
+        self.publisher = DeltaPublisher()
+
+    @property
+    def classes(self):
+        return self.encoder.classes
+
+    @property
+    def wire_format(self):
+        return WIRE_FORMAT_TRACKED if self.binary else 'json'
+
+    @property
+    def publish_mode(self):
+        return 'delta' if self.delta else 'full'
+
+    def serialize(self, detections, seq: int, timestamp_us: int, now: float = None, reused: bool = False):
+        """
+        回傳要發送的 bytes；沒有需要發送的內容時回傳 None。
+        reused 表示 detections 是沿用上一次推理的結果（畫面沒變），會在輸出中標示。
+        """
+        tracks, lost = self.tracker.update(detections)
+        if self.delta:
+            message = self.publisher.update(tracks, lost, now)
+            if message is None:
+                return None
+        else:
+            if not tracks:
+                return None
+            message = {'keyframe': True, 'tracks': [t.to_dict() for t in tracks]}
+
+        if self.binary:
+            return self.encoder.encode_tracks(message, seq, timestamp_us, FLAG_REUSED if reused else 0)
+        if self.delta:
+            extra = {'reused': True} if reused else {}
+            return json.dumps({'type': 'detections', 'seq': seq, 'timestamp': timestamp_us, **message, **extra}).encode('utf-8')
+        # 完整模式維持原本的 JSON 陣列，只多了 id 欄位（沿用的結果每個項目另有 reused 欄位）
+        tracks = [dict(t, reused=True) for t in message['tracks']] if reused else message['tracks']
+        return json.dumps(tracks).encode('utf-8')
+
+
+def _label(classes, class_id):
+    return classes[class_id] if class_id < len(classes) else str(class_id)
+
+
+def _decode_tracks(payload, flags, seq, timestamp_us, count, classes):
+    expected = HEADER.size + TRACK_BOX.size * count
+    if len(payload) < expected:
+        raise ValueError(f"Truncated detection payload: {len(payload)} < {expected} bytes")
+
+    keyframe = bool(flags & FLAG_KEYFRAME)
+    out = {'seq': seq, 'timestamp_us': timestamp_us, 'flags': flags, 'keyframe': keyframe,
+           'reused': bool(flags & FLAG_REUSED)}
+    if keyframe:
+        out['tracks'] = []
+    else:
+        out.update({'new': [], 'moved': [], 'lost': []})
+
+    for track_id, op, conf, class_id, x, y, w, h in TRACK_BOX.iter_unpack(payload[HEADER.size:expected]):
+        if op == OP_LOST:
+            out['lost'].append(track_id)
+            continue
+        track = {
+            'id': track_id,
+            'classId': class_id,
+            'confidence': conf / _CONF_SCALE,
+            'box': [x / _COORD_SCALE, y / _COORD_SCALE, w / _COORD_SCALE, h / _COORD_SCALE]
+        }
+        if classes is not None:
+            track['label'] = _label(classes, class_id)
+        out['tracks' if op == OP_TRACK else 'new' if op == OP_NEW else 'moved'].append(track)
+    return out
+
+
+def decode(payload: bytes, classes=None):
+    """
+    解碼二進位封包。
+    v1 回傳 dict：seq、timestamp_us、flags、detections；
+    v2 另有 keyframe，以及 tracks 或 new / moved / lost。
+    有提供 classes 時，每個偵測框會附上 label。
+    """
+    magic, version, flags, seq, timestamp_us, count = HEADER.unpack_from(payload, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a binary detection payload")
+    if version == VERSION_TRACKED:
+        return _decode_tracks(payload, flags, seq, timestamp_us, count, classes)
+    if version != VERSION:
+        raise ValueError(f"Unsupported detection wire version: {version}")
+    expected = HEADER.size + BOX.size * count
+    if len(payload) < expected:
+        raise ValueError(f"Truncated detection payload: {len(payload)} < {expected} bytes")
+
+    detections = []
+    for class_id, conf, x, y, w, h in BOX.iter_unpack(payload[HEADER.size:expected]):
+        det = {
+            'classId': class_id,
+            'confidence': conf / _CONF_SCALE,
+            'box': [x / _COORD_SCALE, y / _COORD_SCALE, w / _COORD_SCALE, h / _COORD_SCALE]
+        }
+        if classes is not None:
+            det['label'] = _label(classes, class_id)
+        detections.append(det)
+
+    return {'seq': seq, 'timestamp_us': timestamp_us, 'flags': flags, 'detections': detections}
+
+
+def _self_test():
+    """編碼/解碼來回測試"""
+    import random
+    rng = random.Random(0)
+    names = {0: 'red', 1: 'green', 2: 'blue'}
+    encoder = DetectionEncoder(names)
+    assert encoder.classes == ['red', 'green', 'blue']
+
+    # 空列表
+    empty = decode(encoder.encode([], seq=7, timestamp_us=123))
+    assert empty == {'seq': 7, 'timestamp_us': 123, 'flags': 0, 'detections': []}
+
+    # 隨機偵測框：誤差需在量化步長內
+    for n in (1, 5, 50):
+        dets = [{
+            'label': rng.choice(encoder.classes),
+            'confidence': rng.random(),
+            'box': [rng.random(), rng.random(), rng.random(), rng.random()]
+        } for _ in range(n)]
+        payload = encoder.encode(dets, seq=2**32 + n, timestamp_us=1_700_000_000_000_000, flags=1)
+        assert is_binary(payload) and len(payload) == HEADER.size + BOX.size * n
+        out = decode(payload, encoder.classes)
+        assert out['seq'] == n and out['flags'] == 1
+        assert out['timestamp_us'] == 1_700_000_000_000_000
+        for a, b in zip(dets, out['detections']):
+            assert a['label'] == b['label']
+            assert abs(a['confidence'] - b['confidence']) <= 0.5 / _CONF_SCALE + 1e-9
+            for va, vb in zip(a['box'], b['box']):
+                assert abs(va - vb) <= 0.5 / _COORD_SCALE + 1e-9
+
+    # 超出範圍的座標會被截斷
+    out = decode(encoder.encode([{'label': 'red', 'confidence': 1.2, 'box': [-0.1, 1.5, 0, 1]}], seq=0))
+    assert out['detections'][0]['box'] == [0.0, 1.0, 0.0, 1.0]
+    assert out['detections'][0]['confidence'] == 1.0
+
+    # 截斷的封包要報錯
+    try:
+        decode(encoder.encode(dets, seq=0)[:-1])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("truncated payload was accepted")
+
+    assert not is_binary(json.dumps(dets).encode('utf-8'))
+
+    # v2：追蹤 + 差量
+    serializer = DetectionSerializer(names, wire_format='binary', publish_mode='delta')
+    first = [{'label': 'red', 'confidence': 0.9, 'box': [0.1, 0.1, 0.2, 0.2]},
+             {'label': 'blue', 'confidence': 0.8, 'box': [0.6, 0.6, 0.2, 0.2]}]
+    out = decode(serializer.serialize(first, seq=1, timestamp_us=10, now=0.0), encoder.classes)
+    assert out['keyframe'] and [t['label'] for t in out['tracks']] == ['red', 'blue']
+    red_id, blue_id = out['tracks'][0]['id'], out['tracks'][1]['id']
+
+    # 沒有移動 -> 不發送
+    assert serializer.serialize(first, seq=2, timestamp_us=20, now=0.1) is None
+
+    # red 移動、blue 消失、green 新出現
+    second = [{'label': 'red', 'confidence': 0.9, 'box': [0.15, 0.1, 0.2, 0.2]},
+              {'label': 'green', 'confidence': 0.7, 'box': [0.4, 0.0, 0.1, 0.1]}]
+    # blue 要連續 max_missed + 1 次沒出現才算消失
+    for i in range(serializer.tracker.max_missed):
+        serializer.serialize(second, seq=3 + i, timestamp_us=30, now=0.2)
+    out = decode(serializer.serialize(second, seq=9, timestamp_us=40, now=0.3), encoder.classes)
+    assert not out['keyframe'] and out['lost'] == [blue_id]
+
+    fresh = DetectionSerializer(names, wire_format='binary', publish_mode='delta')
+    fresh.serialize(first, seq=1, timestamp_us=0, now=0.0)
+    out = decode(fresh.serialize(second, seq=2, timestamp_us=0, now=0.1), encoder.classes)
+    assert [t['id'] for t in out['moved']] == [red_id] and [t['label'] for t in out['new']] == ['green']
+    assert abs(out['moved'][0]['box'][0] - 0.15) < 1e-4
+
+    # 到期送 keyframe
+    out = decode(fresh.serialize(second, seq=3, timestamp_us=0, now=1.5), encoder.classes)
+    assert out['keyframe'] and len(out['tracks']) == 2 and not out['reused']
+
+    # 沿用上次結果的 keyframe 要帶 reused 旗標
+    out = decode(fresh.serialize(second, seq=4, timestamp_us=0, now=3.0, reused=True), encoder.classes)
+    assert out['keyframe'] and out['reused'] and out['flags'] == FLAG_KEYFRAME | FLAG_REUSED
+    full = DetectionSerializer(names)
+    assert all(t['reused'] for t in json.loads(full.serialize(second, seq=1, timestamp_us=0, reused=True)))
+    print("Round-trip tests passed")
+
+
+def _benchmark(iterations: int = 2000):
+    """與目前 JSON 格式比較封包大小與編碼/解碼速度"""
+    import random
+    rng = random.Random(1)
+    names = {i: f'class_{i}' for i in range(10)}
+    encoder = DetectionEncoder(names)
+
+    print(f"{'boxes':>5} {'json B':>8} {'bin B':>7} {'v2 B':>6} {'ratio':>6} "
+          f"{'json enc us':>12} {'bin enc us':>11} {'json dec us':>12} {'bin dec us':>11}")
+    for n in (1, 5, 20, 50):
+        dets = [{
+            'label': rng.choice(encoder.classes),
+            'confidence': rng.random(),
+            'box': [rng.random(), rng.random(), rng.random(), rng.random()]
+        } for _ in range(n)]
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            json_payload = json.dumps(dets).encode('utf-8')
+        json_enc = (time.perf_counter() - start) / iterations * 1e6
+
+        start = time.perf_counter()
+        for i in range(iterations):
+            bin_payload = encoder.encode(dets, seq=i, timestamp_us=0)
+        bin_enc = (time.perf_counter() - start) / iterations * 1e6
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            json.loads(json_payload.decode('utf-8'))
+        json_dec = (time.perf_counter() - start) / iterations * 1e6
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            decode(bin_payload, encoder.classes)
+        bin_dec = (time.perf_counter() - start) / iterations * 1e6
+
+        v2_size = len(encoder.encode_tracks(
+            {'keyframe': True, 'tracks': [dict(d, id=i) for i, d in enumerate(dets)]}, seq=0, timestamp_us=0))
+        print(f"{n:>5} {len(json_payload):>8} {len(bin_payload):>7} {v2_size:>6} "
+              f"{len(json_payload) / len(bin_payload):>5.1f}x "
+              f"{json_enc:>12.1f} {bin_enc:>11.1f} {json_dec:>12.1f} {bin_dec:>11.1f}")
+
+
+if __name__ == "__main__":
+    _self_test()
+    _benchmark()
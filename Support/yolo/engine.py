@@ -0,0 +1,378 @@
+# engine.py - 偵測引擎：bots 共用的推理介面，可選 PyTorch 或 ONNX Runtime（FP32 / INT8）後端
+#
+# 後端（YOLO_BACKEND）：
+#   torch             Ultralytics PyTorch（預設，支援 GPU）
+#   onnx              ONNX Runtime FP32
+#   onnx-int8         ONNX Runtime + 動態 INT8 量化（權重量化，不需要校正資料）
+#   onnx-int8-static  ONNX Runtime + 靜態 INT8 量化（QDQ，需要校正影像 ONNX_CALIBRATION）
+#
+# ONNX 模型第一次使用時由 .pt 匯出並快取在 ENGINE_CACHE_DIR（預設為模型旁的 .engine_cache），
+# 檔名包含 .pt 的大小與修改時間，模型更新後會自動重新匯出。
+#
+#   python engine.py ../../models2/best.pt --images ../yolotest   比較各後端的 CPU 延遲與偵測結果差異
+import ast
+import concurrent.futures
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+import cv2
+import numpy as np
+
+from preprocess import LetterboxInfo
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8', 'onnx-int8-static')
+
+_PAD_VALUE = 114
+
+
+def letterbox_bgr(image, imgsz: int):
+    """單張 BGR 影像 -> (3, imgsz, imgsz) float32 RGB 0~1 與 LetterboxInfo（與 I420Letterbox 相同的幾何）"""
+    height, width = image.shape[:2]
+    info = LetterboxInfo(width, height, imgsz)
+    canvas = np.full((imgsz, imgsz, 3), _PAD_VALUE, dtype=np.uint8)
+    canvas[info.pad_y:info.pad_y + info.new_h, info.pad_x:info.pad_x + info.new_w] = cv2.resize(
+        image, (info.new_w, info.new_h), interpolation=cv2.INTER_LINEAR)
+    chw = cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB).transpose(2, 0, 1)
+    return chw.astype(np.float32) / 255.0, info
+
+
+def _unletterbox_rows(rows, info):
+    out = rows.copy()
+    for row in out:
+        row[:4] = info.unletterbox(*row[:4])
+    return out
+
+
+class DetectionEngine:
+    """
+    推理介面。detect() 輸入 (n, 3, s, s) float32 RGB 0~1 的批次（s 為 32 的倍數，預設 imgsz），
+    回傳每張影像一個 (k, 6) 陣列：x, y, w, h（模型輸入上的正規化左上角座標）, confidence, class_id。
+    """
+    backend = None
+    asynchronous = False  # True 表示提供 detect_async()，回傳 concurrent.futures.Future
+
+    def __init__(self, names, imgsz: int, conf: float):
+        self.names = names
+        self.imgsz = imgsz
+        self.conf = conf
+
+    @property
+    def size_bytes(self) -> int:
+        raise NotImplementedError
+
+    def detect(self, batch):
+        raise NotImplementedError
+
+    def detect_images(self, images, imgsz: int = None):
+        """BGR 影像列表；座標已換回各原圖的正規化座標"""
+        prepared = [letterbox_bgr(image, imgsz or self.imgsz) for image in images]
+        results = self.detect(np.stack([chw for chw, _ in prepared]))
+        return [_unletterbox_rows(rows, info) for rows, (_, info) in zip(results, prepared)]
+
+    def warm_up(self, batch_size: int = 1, imgsz: int = None):
+        """用假影像跑一次推理，讓 kernel 編譯 / 記憶體配置在上線前完成"""
+        imgsz = imgsz or self.imgsz
+        self.detect(np.zeros((batch_size, 3, imgsz, imgsz), dtype=np.float32))
+
+    def close(self):
+        """釋放引擎持有的資源（工作行程、共享記憶體等）"""
+
+
+class TorchEngine(DetectionEngine):
+    backend = 'torch'
+
+    def __init__(self, model_path: str, device: str = 'cpu', imgsz: int = 640, conf: float = 0.25,
+                 half: bool = False):
+        from ultralytics import YOLO
+        self.model = YOLO(model_path)
+        self.device = device
+        self.half = half
+        super().__init__(self.model.names, imgsz, conf)
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(p.numel() * p.element_size() for p in self.model.model.parameters())
+
+    def _rows(self, result):
+        boxes = result.boxes
+        if boxes is None or not len(boxes):
+            return np.zeros((0, 6), dtype=np.float32)
+        xywhn = boxes.xywhn.cpu().numpy()
+        rows = np.empty((len(xywhn), 6), dtype=np.float32)
+        rows[:, 0] = xywhn[:, 0] - xywhn[:, 2] / 2
+        rows[:, 1] = xywhn[:, 1] - xywhn[:, 3] / 2
+        rows[:, 2:4] = xywhn[:, 2:4]
+        rows[:, 4] = boxes.conf.cpu().numpy()
+        rows[:, 5] = boxes.cls.cpu().numpy()
+        return rows
+
+    def detect(self, batch):
+        import torch
+        results = self.model.predict(torch.from_numpy(batch), verbose=False, device=self.device,
+                                     conf=self.conf, half=self.half)
+        return [self._rows(r) for r in results]
+
+    def detect_images(self, images, imgsz: int = None):
+        # Ultralytics 自己做 letterbox，xywhn 已經是原圖座標
+        results = self.model.predict(list(images), verbose=False, device=self.device,
+                                     conf=self.conf, half=self.half, imgsz=imgsz or self.imgsz)
+        return [self._rows(r) for r in results]
+
+
+class OnnxEngine(DetectionEngine):
+    """ONNX Runtime 後端；輸出為 YOLOv8 以後的 (n, 4 + classes, anchors) 格式，在這裡做 NMS"""
+
+    def __init__(self, onnx_path: str, backend: str = 'onnx', device: str = 'cpu', imgsz: int = 640,
+                 conf: float = 0.25, iou: float = 0.7, max_det: int = 300, threads: int = 0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        providers = ['CPUExecutionProvider']
+        if device != 'cpu' and 'CUDAExecutionProvider' in ort.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = ort.InferenceSession(onnx_path, options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        self.path = onnx_path
+        self.backend = backend
+        self.iou = iou
+        self.max_det = max_det
+        # Ultralytics 匯出時會把類別表寫進 metadata
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        names = ast.literal_eval(metadata['names']) if 'names' in metadata else {}
+        super().__init__(names, imgsz, conf)
+
+    @property
+    def size_bytes(self) -> int:
+        return os.path.getsize(self.path)
+
+    def _postprocess(self, output, size):
+        preds = output.T  # (anchors, 4 + classes)
+        scores = preds[:, 4:]
+        class_ids = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), class_ids]
+        keep = confidences >= self.conf
+        if not keep.any():
+            return np.zeros((0, 6), dtype=np.float32)
+        boxes = preds[keep, :4].copy()
+        boxes[:, 0] -= boxes[:, 2] / 2
+        boxes[:, 1] -= boxes[:, 3] / 2
+        confidences, class_ids = confidences[keep], class_ids[keep]
+        # 與 Ultralytics 預設相同：同類別之間才做 NMS
+        indices = cv2.dnn.NMSBoxesBatched(boxes.tolist(), confidences.tolist(), class_ids.tolist(),
+                                          self.conf, self.iou)
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)[:self.max_det]
+        rows = np.empty((len(indices), 6), dtype=np.float32)
+        rows[:, :4] = boxes[indices] / size  # 依這次的輸入尺寸正規化
+        rows[:, 4] = confidences[indices]
+        rows[:, 5] = class_ids[indices]
+        return rows
+
+    def detect(self, batch):
+        outputs = self.session.run(None, {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
+        return [self._postprocess(output, batch.shape[-1]) for output in outputs]
+
+
+def _model_signature(model_path: str) -> str:
+    stat = os.stat(model_path)
+    return hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:10]
+
+
+def _cache_path(model_path: str, imgsz: int, suffix: str, cache_dir: str = None) -> str:
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(model_path)), '.engine_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_dir, f"{stem}-{_model_signature(model_path)}-{imgsz}{suffix}.onnx")
+
+
+def export_onnx(model_path: str, imgsz: int = 640, cache_dir: str = None) -> str:
+    """.pt -> FP32 ONNX（動態 batch 與輸入尺寸），已快取則直接回傳路徑"""
+    target = _cache_path(model_path, imgsz, '', cache_dir)
+    if os.path.exists(target):
+        return target
+    from ultralytics import YOLO
+    logging.info(f"Exporting {model_path} to ONNX (imgsz={imgsz})")
+    start = time.monotonic()
+    exported = YOLO(model_path).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+    shutil.move(str(exported), target)
+    logging.info(f"Exported {target} in {time.monotonic() - start:.1f}s")
+    return target
+
+
+def calibration_images(source: str, limit: int = 64):
+    """校正 / 比較用影像：資料夾中的 png/jpg，或影片中均勻取樣的幀（BGR）"""
+    if os.path.isdir(source):
+        paths = sorted(p for ext in ('*.png', '*.jpg', '*.jpeg')
+                       for p in glob.glob(os.path.join(source, ext)))
+        images = [cv2.imread(p) for p in paths[:limit]]
+        return [image for image in images if image is not None]
+    cap = cv2.VideoCapture(source)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or limit
+    images = []
+    for index in np.linspace(0, total - 1, min(limit, total)).astype(int):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+        ok, image = cap.read()
+        if ok:
+            images.append(image)
+    cap.release()
+    return images
+
+
+def quantize_onnx(fp32_path: str, mode: str = 'dynamic', calibration: str = None, imgsz: int = 640) -> str:
+    """FP32 ONNX -> INT8 ONNX（dynamic 或 static），已快取則直接回傳路徑"""
+    target = fp32_path[:-len('.onnx')] + f"-int8-{mode}.onnx"
+    if os.path.exists(target):
+        return target
+    from onnxruntime import quantization as q
+    start = time.monotonic()
+    if mode == 'dynamic':
+        q.quantize_dynamic(fp32_path, target, weight_type=q.QuantType.QUInt8)
+    else:
+        images = calibration_images(calibration) if calibration else []
+        if not images:
+            raise ValueError("Static INT8 quantization needs calibration images (ONNX_CALIBRATION)")
+        class Reader(q.CalibrationDataReader):
+            def __init__(self, input_name):
+                self.input_name = input_name
+                self.batches = iter(letterbox_bgr(image, imgsz)[0][None] for image in images)
+
+            def get_next(self):
+                batch = next(self.batches, None)
+                return None if batch is None else {self.input_name: batch}
+
+        import onnxruntime as ort
+        input_name = ort.InferenceSession(fp32_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+        logging.info(f"Calibrating static INT8 with {len(images)} images from {calibration}")
+        q.quantize_static(fp32_path, target, Reader(input_name), quant_format=q.QuantFormat.QDQ,
+                          per_channel=True, activation_type=q.QuantType.QUInt8,
+                          weight_type=q.QuantType.QInt8)
+    logging.info(f"Quantized {target} ({mode}) in {time.monotonic() - start:.1f}s")
+    return target
+
+
+def prepare_model_file(model_path: str, backend: str = 'torch', imgsz: int = 640, cache_dir: str = None,
+                       calibration: str = None) -> str:
+    """回傳後端實際載入的模型檔；ONNX 後端會先匯出 / 量化並快取"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+    if backend == 'torch' or model_path.endswith('.onnx'):
+        return model_path
+    path = export_onnx(model_path, imgsz, cache_dir)
+    if backend == 'onnx-int8':
+        path = quantize_onnx(path, 'dynamic')
+    elif backend == 'onnx-int8-static':
+        path = quantize_onnx(path, 'static', calibration, imgsz)
+    return path
+
+
+def create_engine(model_path: str, backend: str = 'torch', device: str = 'cpu', imgsz: int = 640,
+                  conf: float = 0.25, half: bool = False, cache_dir: str = None, calibration: str = None,
+                  threads: int = 0, workers: int = 0, max_batch: int = 1) -> DetectionEngine:
+    """依後端名稱建立引擎；workers > 0 時改用多行程引擎（只支援 CPU，其他裝置忽略 workers）"""
+    if workers > 0 and str(device) != 'cpu':
+        logging.warning(f"Multi-process inference is CPU-only, ignoring workers={workers} on device {device}")
+        workers = 0
+    if workers > 0:
+        from process_pool import ProcessPoolEngine
+        return ProcessPoolEngine(model_path, backend, workers=workers, imgsz=imgsz, conf=conf,
+                                 max_batch=max_batch, threads=threads, cache_dir=cache_dir, calibration=calibration)
+    path = prepare_model_file(model_path, backend, imgsz, cache_dir, calibration)
+    if backend == 'torch':
+        return TorchEngine(path, device=device, imgsz=imgsz, conf=conf, half=half)
+    return OnnxEngine(path, backend=backend, device=device, imgsz=imgsz, conf=conf, threads=threads)
+
+
+def chain_future(future, fn):
+    """回傳新的 Future：future 完成後以 fn(結果) 完成（例外會往下傳）"""
+    chained = concurrent.futures.Future()
+
+    def done(source):
+        try:
+            chained.set_result(fn(source.result()))
+        except BaseException as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+def _match(reference, rows, iou_threshold=0.5):
+    """同類別貪婪配對，回傳 (配對數, 平均 IoU, 平均信心度差)"""
+    from tracker import iou
+    used = set()
+    ious, conf_diffs = [], []
+    for ref in reference:
+        best, best_iou = None, iou_threshold
+        for j, row in enumerate(rows):
+            if j in used or int(row[5]) != int(ref[5]):
+                continue
+            overlap = iou(ref[:4], row[:4])
+            if overlap >= best_iou:
+                best, best_iou = j, overlap
+        if best is not None:
+            used.add(best)
+            ious.append(best_iou)
+            conf_diffs.append(abs(float(ref[4]) - float(rows[best][4])))
+    return len(ious), (float(np.mean(ious)) if ious else None), (float(np.mean(conf_diffs)) if conf_diffs else None)
+
+
+def _benchmark(model_path, backends, images, imgsz=640, conf=0.25, calibration=None, iterations=30):
+    """各後端的 CPU 延遲（batch=1）與相對 torch 的偵測結果差異"""
+    batches = [letterbox_bgr(image, imgsz)[0][None] for image in images]
+    reference = None
+    print(f"{'backend':<18}{'mean ms':>9}{'p50 ms':>8}{'p95 ms':>8}{'MB':>8}"
+          f"{'recall':>8}{'precision':>10}{'mIoU':>7}{'dConf':>7}")
+    for backend in backends:
+        try:
+            engine = create_engine(model_path, backend, imgsz=imgsz, conf=conf, calibration=calibration)
+        except Exception as e:
+            print(f"{backend:<18}skipped: {e}")
+            continue
+        engine.warm_up()
+        outputs = [engine.detect(batch)[0] for batch in batches]
+        timings = []
+        for i in range(iterations):
+            batch = batches[i % len(batches)]
+            start = time.perf_counter()
+            engine.detect(batch)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        if reference is None:
+            reference = outputs
+        matched = ref_total = out_total = 0
+        ious, diffs = [], []
+        for ref_rows, rows in zip(reference, outputs):
+            count, mean_iou, conf_diff = _match(ref_rows, rows)
+            matched += count
+            ref_total += len(ref_rows)
+            out_total += len(rows)
+            if mean_iou is not None:
+                ious.append(mean_iou)
+                diffs.append(conf_diff)
+        recall = matched / ref_total if ref_total else 1.0
+        precision = matched / out_total if out_total else 1.0
+        print(f"{backend:<18}{np.mean(timings):>9.1f}{np.percentile(timings, 50):>8.1f}"
+              f"{np.percentile(timings, 95):>8.1f}{engine.size_bytes / 1e6:>8.1f}{recall:>8.3f}{precision:>10.3f}"
+              f"{(np.mean(ious) if ious else float('nan')):>7.3f}{(np.mean(diffs) if diffs else float('nan')):>7.3f}")
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [Engine] - %(message)s')
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+    parser = argparse.ArgumentParser(description="Compare detection backends on CPU")
+    parser.add_argument('model', help=".pt model path")
+    parser.add_argument('--backends', default=','.join(BACKENDS))
+    parser.add_argument('--images', required=True, help="image folder or video used for timing and comparison")
+    parser.add_argument('--calibration', help="images for static INT8 (default: --images)")
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--iterations', type=int, default=30)
+    args = parser.parse_args()
+    _benchmark(args.model, args.backends.split(','), calibration_images(args.images), args.imgsz, args.conf,
+               args.calibration or args.images, args.iterations)
@@ -1,22 +1,22 @@
 import cv2
 
+from mjpeg_source import MJPEGCapture
+
 # 請將 URL 替換成 ESP32-CAM 的實際 IP
 url = "http://172.30.71.19/stream"
-cap = cv2.VideoCapture(url)
-
-if not cap.isOpened():
-    print("無法開啟 ESP32-CAM 串流")
-    exit()
+# 以 asyncio 直接解析 MJPEG：只保留最新一幀、斷線自動重連（cv2.VideoCapture(url) 會積壓畫面且不會重連）
+cap = MJPEGCapture(url, timeout=10.0)
 
 while True:
     ret, frame = cap.read()
     if not ret:
-        print("讀取串流失敗")
-        break
+        print("讀取串流逾時，等待重新連線...")
+        continue
     frame = cv2.flip(frame, 1)
     cv2.imshow("ESP32-CAM Stream", frame)
     if cv2.waitKey(1) & 0xFF == ord('q'):
         break
 
+print(cap.stats())
 cap.release()
 cv2.destroyAllWindows()
@@ -0,0 +1,296 @@
+# fanout.py - 一個行程擷取一次、推理一次，再分送到多個輸出（RTMP / SRT / UDP MPEG-TS / 檔案 / 行程內回呼）
+#
+# 原本每個輸出是一支獨立腳本（ingross / rtc / srt / yolortmp / fixed_publisher / live / new），各自開攝影機、各自跑 YOLO；
+# 同時開兩個輸出會讓擷取與推理成本加倍，而且攝影機只能被開一次。這裡：
+#   擷取執行緒 -> FrameExchange -> 推理執行緒（OverlayRenderer.update）
+#                              -> 組合迴圈（疊加最新結果）-> 每個 sink 的 submit()
+# 每個 sink 有自己的佇列與執行緒（FFmpegFeeder 系列，滿了丟最舊的幀），慢的輸出不會拖慢其他輸出。
+# 編碼設定相同的 PyAV 輸出共用一個 SharedEncoder（只編碼一次，封包分送給各輸出各自封裝）。
+#
+#   python fanout.py --output rtmp://host/live/key --output "udp://127.0.0.1:6004?pkt_size=1316;bitrate=2000k"
+#   python fanout.py --livekit-ingress --output "srt://host:9000;backend=ffmpeg"
+#   python fanout.py --camera http://172.30.71.19/stream --output out.flv   以 ESP32-CAM 為來源（mjpeg_source.py）
+#   python fanout.py --camera synthetic:900 --pacing fast --output out.mp4   不需要攝影機的吞吐量測試（frame_source.py）
+# 輸出格式：網址後面可接 ;key=value（bitrate / bufsize / gop / preset / backend=pyav|ffmpeg）。
+import logging
+import threading
+import time
+
+from ffmpeg_feeder import FFmpegFeeder, FFmpegOutput
+from frame_exchange import FrameExchange, Pacer
+from frame_source import open_source
+from overlay import OverlayRenderer, result_detections
+from resolution_ladder import ResolutionLadder, parse_ladder
+
+logger = logging.getLogger("fanout")
+
+STATS_LOG_INTERVAL = 30  # 每隔幾秒把推理 / 各輸出的統計寫進日誌
+OUTPUT_OPTIONS = ('bitrate', 'bufsize', 'gop', 'preset', 'backend')
+
+
+def parse_output(spec: str):
+    """'url;bitrate=2000k;gop=30' -> (url, {'bitrate': '2000k', 'gop': 30})"""
+    url, *parts = spec.split(';')
+    options = {}
+    for part in parts:
+        key, _, value = part.partition('=')
+        key = key.strip()
+        if key not in OUTPUT_OPTIONS or not value:
+            raise ValueError(f"Invalid output option {part!r} in {spec!r} (expected one of {OUTPUT_OPTIONS})")
+        options[key] = int(value) if key == 'gop' else value.strip()
+    return url.strip(), options
+
+
+class CallbackSink(FFmpegFeeder):
+    """
+    把幀交給行程內的函式（例如 aiortc / LiveKit 的視訊軌）：fn(frame, captured_at) 在 sink 自己的執行緒呼叫，
+    frame 只在呼叫期間有效（BGR，i420=True 時為 I420），captured_at 為擷取時的 time.monotonic()。
+    """
+
+    def __init__(self, fn, width: int, height: int, name: str = "callback", max_queue: int = 1, i420: bool = False):
+        self.fn = fn
+        self.name = name
+        super().__init__(None, width, height, i420=i420, max_queue=max_queue)
+
+    def _send(self, frame):
+        try:
+            self.fn(frame, self.timestamp)
+        except Exception as e:
+            # 回呼的錯誤只影響這一幀，不讓送幀執行緒結束
+            raise OSError(f"callback failed: {e!r}") from e
+
+    def _failed(self, error):
+        logger.error(f"Sink {self.name} failed: {error}")
+
+    def stats(self):
+        stats = super().stats()
+        stats['name'] = self.name
+        return stats
+
+
+class FanoutPipeline:
+    def __init__(self, camera_index, width: int, height: int, fps: int, model_path: str = None,
+                 imgsz_ladder: str = "640", infer_budget_ms: float = 0, flip: int = 1, i420: bool = True,
+                 pacing: str = 'realtime', loop: bool = False):
+        # camera_index：攝影機索引或 frame_source.open_source 的來源字串（影片檔 / http:// / synthetic）
+        self.camera_index = camera_index
+        self.pacing = pacing
+        self.loop = loop
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.flip = flip
+        self.i420 = i420
+        self.model = None
+        self.overlay = None
+        if model_path:
+            from ultralytics import YOLO
+            self.model = YOLO(model_path)
+            self.overlay = OverlayRenderer(self.model.names)
+            logger.info(f"YOLO model loaded: {model_path}")
+        self.ladder = ResolutionLadder(parse_ladder(imgsz_ladder, 640), (infer_budget_ms or 1000.0 / fps) / 1000)
+        self.exchange = FrameExchange((height, width, 3), readers=2)
+        self.sinks = []       # [(name, sink)]
+        self._encoders = {}   # SharedEncoder.encoder_key(...) -> SharedEncoder
+        self._stop = threading.Event()
+        self._started = None
+        self._source = None
+        self._thread = None
+        self.inferences = 0
+
+    def add_sink(self, sink, name: str = None):
+        """
+        任何有 submit(frame, timestamp, draw) / stats() / close() 的物件（FFmpegFeeder、SharedEncoder、CallbackSink ...）；
+        submit 必須在返回前把 frame 複製走，draw（可能為 None）畫在自己的複本上
+        """
+        self.sinks.append((name or type(sink).__name__, sink))
+        return sink
+
+    def add_callback(self, fn, name: str = "callback", max_queue: int = 1, i420: bool = False):
+        return self.add_sink(CallbackSink(fn, self.width, self.height, name, max_queue, i420), name)
+
+    def add_output(self, url: str, bitrate: str = "3000k", bufsize: str = None, gop: int = None,
+                   preset: str = "veryfast", backend: str = "pyav"):
+        """推到網址或寫檔；PyAV 輸出中編碼設定相同的共用一個編碼器"""
+        if backend == "ffmpeg":
+            # 每個 ffmpeg 子行程自己編碼，無法共用
+            return self.add_sink(FFmpegOutput(url, self.width, self.height, self.fps, bitrate, bufsize, gop, preset,
+                                              i420=self.i420), url)
+        if backend != "pyav":
+            raise ValueError(f"Unknown output backend {backend!r} (expected pyav or ffmpeg)")
+        from av_output import SharedEncoder
+        key = SharedEncoder.encoder_key(self.width, self.height, self.fps, bitrate, bufsize, gop, preset)
+        encoder = self._encoders.get(key)
+        if encoder is None:
+            encoder = SharedEncoder(self.width, self.height, self.fps, bitrate=bitrate, bufsize=bufsize, gop=gop,
+                                    preset=preset, i420=self.i420)
+            self._encoders[key] = encoder
+            self.add_sink(encoder, f"encoder-{bitrate}")
+        return encoder.add_output(url)
+
+    def _capture_loop(self, cap):
+        while not self._stop.is_set():
+            if not self.exchange.capture(cap, flip=self.flip):
+                if cap.ended:
+                    # 影片檔 / synthetic:N 讀完：結束整條管線（離線測試跑完即停）
+                    logger.info(f"Source ended: {cap.stats()}")
+                    self._stop.set()
+                    break
+                logger.warning("Failed to read from camera")
+                time.sleep(0.01)
+        self.exchange.close()
+
+    def _inference_loop(self, reader):
+        while not self._stop.is_set():
+            frame = reader.get(timeout=1.0)
+            if frame is None:
+                continue
+            try:
+                size = self.ladder.size
+                start = time.monotonic()
+                result = self.model(frame.array, imgsz=size, verbose=False)
+                self.ladder.record(time.monotonic() - start, size)
+                self.overlay.update(result_detections(result[0]))
+                self.inferences += 1
+            except Exception as e:
+                logger.error(f"YOLO processing error: {e}")
+            finally:
+                frame.release()
+
+    def _open_camera(self):
+        if not self.sinks:
+            raise ValueError("No outputs configured")
+        # 影片檔 / ESP32-CAM 的解析度由來源決定，和 width x height 不同時 FrameExchange 會縮放
+        cap = open_source(self.camera_index, self.width, self.height, self.fps, pacing=self.pacing, loop=self.loop)
+        if not cap.isOpened():
+            raise RuntimeError(f"Failed to open source {self.camera_index}")
+        self._source = cap
+        logger.info(f"Capturing {cap.name} ({cap.width}x{cap.height}) at {self.width}x{self.height}@{self.fps} "
+                    f"once for {len(self.sinks)} sinks: {[name for name, _ in self.sinks]}")
+        return cap
+
+    def run(self):
+        """阻塞到 stop() 或 Ctrl+C"""
+        self._run(self._open_camera())
+
+    def start(self):
+        """攝影機在呼叫端開啟（失敗直接拋出），其餘在背景執行緒執行；給 asyncio 程式用，結束時呼叫 stop()"""
+        cap = self._open_camera()
+        self._thread = threading.Thread(target=self._run, args=(cap,), name='fanout', daemon=True)
+        self._thread.start()
+
+    def _overlay_drawer(self):
+        """這一幀的 draw(image)：所有 sink 畫同一份偵測結果；沒有 overlay 時為 None"""
+        if self.overlay is None:
+            return None
+        detections = self.overlay.latest
+        return lambda image: self.overlay.draw(image, detections)
+
+    def _run(self, cap):
+        stream_reader = self.exchange.reader('stream')
+        threads = [threading.Thread(target=self._capture_loop, args=(cap,), name='capture', daemon=True)]
+        if self.model is not None:
+            threads.append(threading.Thread(target=self._inference_loop, args=(self.exchange.reader('inference'),),
+                                            name='inference', daemon=True))
+        for t in threads:
+            t.start()
+
+        pacer = Pacer(self.fps)
+        self._started = last_stats_log = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                pacer.wait()
+                frame = stream_reader.get(wait=False) or stream_reader.get(timeout=1.0)
+                if frame is None:
+                    continue
+                captured_at = frame.timestamp
+                draw = self._overlay_drawer()
+                # 每個 sink 從共用緩衝區直接複製進自己的佇列，偵測框畫在佇列中的複本上；送不出去的只影響它自己
+                for name, sink in self.sinks:
+                    sink.submit(frame.array, captured_at, draw)
+                frame.release()
+
+                if time.monotonic() - last_stats_log >= STATS_LOG_INTERVAL:
+                    logger.info(f"Fan-out stats: {self.stats()}")
+                    last_stats_log = time.monotonic()
+        except KeyboardInterrupt:
+            logger.info("User interrupted")
+        finally:
+            self._stop.set()
+            self.exchange.close()
+            for t in threads:
+                t.join()
+            for name, sink in self.sinks:
+                sink.close()
+            cap.release()
+            logger.info(f"Fan-out stats: {self.stats()}")
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started if self._started else 0
+        stats = {
+            'source': self._source.stats() if self._source is not None else None,
+            'exchange': self.exchange.stats(),
+            'sinks': {name: sink.stats() for name, sink in self.sinks},
+        }
+        if self.model is not None:
+            stats['inferenceFps'] = round(self.inferences / elapsed, 1) if elapsed else None
+            stats['detectionAgeMs'] = round(self.overlay.age * 1000, 1) if self.overlay.age is not None else None
+            stats['resolution'] = self.ladder.stats()
+        return stats
+
+
+def main():
+    import argparse
+    import asyncio
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+    parser = argparse.ArgumentParser(description="Capture and run YOLO once, publish to many outputs")
+    parser.add_argument("--camera", type=str, default="0",
+                        help="Camera index, ESP32-CAM http://.../stream URL, video file or synthetic[:frames]")
+    parser.add_argument("--pacing", choices=("realtime", "fast"), default="realtime",
+                        help="Video file / synthetic source: play at its own fps, or read as fast as possible "
+                             "(outputs still run at --fps)")
+    parser.add_argument("--loop", action="store_true", help="Loop the video file source")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=int, default=15)
+    parser.add_argument("--model", type=str, default="models/best.pt", help="YOLO model path ('' to disable)")
+    parser.add_argument("--imgsz-ladder", type=str, default="640",
+                        help="Comma-separated inference sizes, largest first (e.g. 960,640,480,320)")
+    parser.add_argument("--infer-budget-ms", type=float, default=0)
+    parser.add_argument("--no-flip", action="store_true", help="Don't mirror the camera image")
+    parser.add_argument("--output", action="append", default=[],
+                        help="Output URL or file, optionally followed by ;bitrate=...;gop=...;backend=ffmpeg "
+                             "(repeatable)")
+    parser.add_argument("--bitrate", type=str, default="3000k", help="Default bitrate for outputs")
+    parser.add_argument("--livekit-ingress", action="store_true",
+                        help="Create (or reuse) a LiveKit RTMP ingress and add it as an output")
+    parser.add_argument("--room", type=str, default="my-room", help="LiveKit room for --livekit-ingress")
+    args = parser.parse_args()
+
+    outputs = [parse_output(spec) for spec in args.output]
+    if args.livekit_ingress:
+        # 與 rtc.py 相同的 Ingress 建立 / 重用流程
+        import rtc
+        ingress = asyncio.run(rtc.get_or_create_rtmp_ingress(
+            name=rtc.DEFAULT_INGRESS_NAME, room_name=args.room,
+            participant_identity=rtc.DEFAULT_PARTICIPANT_IDENTITY, participant_name=rtc.DEFAULT_PARTICIPANT_NAME))
+        outputs.append((f"{ingress.url}/{ingress.stream_key}", {}))
+    if not outputs:
+        parser.error("at least one --output (or --livekit-ingress) is required")
+
+    pipeline = FanoutPipeline(args.camera, args.width, args.height, args.fps, model_path=args.model or None,
+                              imgsz_ladder=args.imgsz_ladder, infer_budget_ms=args.infer_budget_ms,
+                              flip=None if args.no_flip else 1, pacing=args.pacing, loop=args.loop)
+    for url, options in outputs:
+        options.setdefault('bitrate', args.bitrate)
+        pipeline.add_output(url, **options)
+    pipeline.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+# ffmpeg_feeder.py - 把幀送進 FFmpeg stdin 的獨立執行緒：有上限的佇列、滿了丟最舊的幀，可先轉成 I420
+#
+# 推流迴圈只呼叫 submit(frame)（複製進預先配置的槽位，不會卡在管道上）；
+# RTMP / SRT 連線卡住時，阻塞的是送幀執行緒，佇列滿了就丟掉最舊的幀，畫面維持最新。
+# i420=True 時在送幀執行緒轉成 yuv420p（每像素 1.5 bytes，bgr24 的一半），FFmpeg 輸入需用 -pix_fmt yuv420p。
+import collections
+import logging
+import subprocess
+import threading
+import time
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def container_format(url: str):
+    """依網址決定封裝格式；檔案回傳 None（由副檔名判斷）"""
+    scheme = url.split('://', 1)[0].lower() if '://' in url else ''
+    if scheme in ('rtmp', 'rtmps'):
+        return 'flv'  # RTMP 只接受 FLV
+    if scheme in ('srt', 'udp', 'tcp'):
+        return 'mpegts'
+    return None
+
+
+def ffmpeg_command(url: str, width: int, height: int, fps: int, bitrate: str = "3000k", bufsize: str = None,
+                   gop: int = None, preset: str = "veryfast", pix_fmt: str = "bgr24"):
+    """原始幀從 stdin 進、libx264 低延遲編碼後推到 url 的 ffmpeg 命令（同 ingross.py）"""
+    kbps = int(bitrate.lower().rstrip('k'))
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-f", "rawvideo",
+        "-pix_fmt", pix_fmt,
+        "-s", f"{width}x{height}",
+        "-r", str(fps),
+        "-i", "pipe:0",
+        "-c:v", "libx264",
+        "-preset", preset,
+        "-tune", "zerolatency",
+        "-b:v", f"{kbps}k",
+        "-maxrate", f"{kbps}k",
+        "-bufsize", bufsize or f"{kbps * 2}k",
+        "-pix_fmt", "yuv420p",
+        "-g", str(gop or fps),
+        "-bf", "0",
+    ]
+    fmt = container_format(url)
+    if fmt:
+        cmd += ["-f", fmt]
+    return cmd + [url]
+
+
+class FFmpegFeeder:
+    """
+    get_process：回傳目前 FFmpeg Popen 的函式（重啟後回傳新的行程）。
+    on_error(exc)：寫入失敗或 FFmpeg 已結束時在送幀執行緒呼叫（例如 restart_ffmpeg）；未提供時停止送幀。
+    """
+
+    def __init__(self, get_process, width: int, height: int, i420: bool = False, max_queue: int = 2,
+                 on_error=None, stall_threshold: float = 0.05):
+        if i420 and (width % 2 or height % 2):
+            raise ValueError(f"I420 piping needs an even frame size, got {width}x{height}")
+        self.get_process = get_process
+        self.width = width
+        self.height = height
+        self.i420 = i420
+        self.max_queue = max_queue
+        self.on_error = on_error
+        self.stall_threshold = stall_threshold
+        # 佇列中的槽位 + 正在寫入的一個 + 正在 submit 的一個
+        self._slots = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(max_queue + 2)]
+        self._timestamps = [0.0] * len(self._slots)
+        self._free = list(range(len(self._slots)))
+        self._queue = collections.deque()
+        self._i420 = np.empty((height * 3 // 2, width), dtype=np.uint8) if i420 else None
+        self._cond = threading.Condition()
+        self._closed = False
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.write_seconds = 0.0
+        self.max_write = 0.0
+        self.stalls = 0
+        self.timestamp = None  # 正在送出的這一幀的擷取時間（time.monotonic()），只在送幀執行緒中有效
+        self._thread = threading.Thread(target=self._run, name='ffmpeg-feeder', daemon=True)
+        self._thread.start()
+
+    @property
+    def pix_fmt(self) -> str:
+        """FFmpeg rawvideo 輸入的 -pix_fmt"""
+        return 'yuv420p' if self.i420 else 'bgr24'
+
+    @property
+    def frame_bytes(self) -> int:
+        return self.width * self.height * 3 // 2 if self.i420 else self.width * self.height * 3
+
+    def submit(self, frame, timestamp: float = None, draw=None) -> bool:
+        """
+        複製一幀（BGR，width x height）進佇列；佇列滿時丟掉最舊的一幀。已關閉時回傳 False。
+        timestamp：擷取時間（time.monotonic()），省略時使用呼叫的時間。
+        draw：複製後對佇列中的這一幀呼叫 draw(slot)（例如疊加偵測框），呼叫端不需要另外複製一份來畫。
+        """
+        with self._cond:
+            if self._closed:
+                return False
+            if self._free:
+                index = self._free.pop()
+            else:
+                index = self._queue.popleft()
+                self.dropped += 1
+        np.copyto(self._slots[index], frame)
+        if draw is not None:
+            draw(self._slots[index])
+        self._timestamps[index] = time.monotonic() if timestamp is None else timestamp
+        with self._cond:
+            if self._closed:
+                self._free.append(index)
+                return False
+            # 佇列上限以外的舊幀也丟掉（槽位比上限多兩個）
+            while len(self._queue) >= self.max_queue:
+                self._free.append(self._queue.popleft())
+                self.dropped += 1
+            self._queue.append(index)
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                index = self._queue.popleft()
+            try:
+                frame = self._slots[index]
+                self.timestamp = self._timestamps[index]
+                if self.i420:
+                    cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420, dst=self._i420)
+                    frame = self._i420
+                self._write(frame)
+            finally:
+                with self._cond:
+                    self._free.append(index)
+
+    def _write(self, frame):
+        start = time.monotonic()
+        try:
+            self._send(frame)
+        except (BrokenPipeError, OSError, ValueError) as e:
+            # ValueError：stdin 已被關閉（例如重啟中）
+            self.errors += 1
+            self._failed(e)
+            return
+        elapsed = time.monotonic() - start
+        self.written += 1
+        self.write_seconds += elapsed
+        self.max_write = max(self.max_write, elapsed)
+        if elapsed >= self.stall_threshold:
+            self.stalls += 1
+
+    def _send(self, frame):
+        """把一幀（pix_fmt 排列）送出；子類別可改成其他輸出方式"""
+        process = self.get_process()
+        if process is None or process.poll() is not None:
+            raise BrokenPipeError("FFmpeg process has exited")
+        # stdin 沒有緩衝（bufsize=0）時 write() 可能只寫入一部分（例如被訊號中斷），
+        # 沒寫完的部分要補寫，否則之後每一幀在 rawvideo 串流中的位置都會錯開
+        view = frame.data.cast('B')
+        while view:
+            view = view[process.stdin.write(view):]
+        process.stdin.flush()
+
+    def _failed(self, error):
+        if self.on_error is None:
+            logger.error(f"FFmpeg write failed, stopping feeder: {error}")
+            self._close()
+        else:
+            self.on_error(error)
+
+    def _close(self):
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+
+    def close(self, timeout: float = 2.0):
+        """停止送幀（佇列中尚未寫入的幀直接捨棄）；正在寫入的一幀最多等 timeout 秒"""
+        self._close()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def stats(self):
+        return {
+            'pixFmt': self.pix_fmt,
+            'submitted': self.submitted,
+            'written': self.written,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'queueDepth': len(self._queue),
+            'maxQueueDepth': self.max_depth,
+            'writeMs': {
+                'mean': round(self.write_seconds / self.written * 1000, 2) if self.written else None,
+                'max': round(self.max_write * 1000, 2),
+            },
+            'stalls': self.stalls,
+        }
+
+
+class FFmpegOutput(FFmpegFeeder):
+    """自己管理 ffmpeg 子行程的 FFmpegFeeder：FFmpeg 結束或管道斷掉時重啟（同 ingross.py 的 restart_ffmpeg）"""
+
+    def __init__(self, url: str, width: int, height: int, fps: int, bitrate: str = "3000k", bufsize: str = None,
+                 gop: int = None, preset: str = "veryfast", i420: bool = True, max_queue: int = 2,
+                 restart_delay: float = 1.0):
+        self.url = url
+        self.command = ffmpeg_command(url, width, height, fps, bitrate, bufsize, gop, preset,
+                                      'yuv420p' if i420 else 'bgr24')
+        self.restart_delay = restart_delay
+        self.restarts = 0
+        self._process = None
+        self._start_process()
+        super().__init__(lambda: self._process, width, height, i420=i420, max_queue=max_queue,
+                         on_error=self._restart, stall_threshold=1.0 / fps)
+
+    def _start_process(self):
+        logger.info("FFmpeg command: " + " ".join(self.command))
+        self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL, bufsize=0)
+
+    def _stop_process(self):
+        process, self._process = self._process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.terminate()
+            process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error(f"Stopping FFmpeg failed: {e}")
+
+    def _restart(self, error):
+        logger.error(f"FFmpeg for {self.url} exited ({error}), restarting in {self.restart_delay}s")
+        self._stop_process()
+        time.sleep(self.restart_delay)
+        if not self.closed:
+            self.restarts += 1
+            self._start_process()
+
+    def close(self, timeout: float = 2.0):
+        super().close(timeout)
+        self._stop_process()
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({'backend': 'ffmpeg', 'url': self.url, 'restarts': self.restarts})
+        return stats
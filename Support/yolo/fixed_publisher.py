@@ -1,96 +1,23 @@
 import argparse
 import asyncio
-import cv2
 import json
 import logging
 import sys
 import time
-from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
-from aiortc.contrib.media import MediaPlayer, MediaRelay
-from av import VideoFrame
-import numpy as np
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
 import websockets
-from ultralytics import YOLO
+
+from webrtc_track import start_pipeline_track
 
 # 配置日誌
 logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(name)s:%(message)s')
 logger = logging.getLogger('yolo-publisher')
 
-class YOLOVideoStreamTrack(VideoStreamTrack):
-    """
-    使用 YOLO 進行物件檢測的視頻源
-    """
-    def __init__(self, camera_index, width, height, fps, model_path):
-        super().__init__()
-        self.camera = cv2.VideoCapture(camera_index)
-        self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-        self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-        self.camera.set(cv2.CAP_PROP_FPS, fps)
-        self.fps = fps
-        self.frame_interval = 1 / fps
-        self.last_frame_time = time.time()
-        
-        # 檢查攝像頭是否成功開啟
-        if not self.camera.isOpened():
-            raise ValueError(f"無法打開攝像頭 {camera_index}")
-        
-        logger.info(f"攝像頭初始化成功: {int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT))}")
-        
-        # 載入 YOLO 模型
-        self.model = YOLO(model_path)
-        logger.info(f"YOLO模型已加載: {model_path}")
-        
-        # 初始化 VideoFrame 計數器
-        self.counter = 0
-    
-    async def recv(self):
-        # 調整幀率
-        now = time.time()
-        wait_time = max(0, self.frame_interval - (now - self.last_frame_time))
-        if wait_time > 0:
-            await asyncio.sleep(wait_time)
-            
-        # 捕獲幀
-        ret, frame = self.camera.read()
-        if not ret:
-            # 如果讀取失敗，嘗試重新開啟攝像頭
-            logger.warning("攝像頭讀取失敗，嘗試重新開啟")
-            self.camera.release()
-            self.camera = cv2.VideoCapture(self.camera_index)
-            ret, frame = self.camera.read()
-            if not ret:
-                logger.error("無法讀取攝像頭")
-                # 返回黑色幀
-                frame = np.zeros((480, 640, 3), dtype=np.uint8)
-        
-        # 使用 YOLO 進行物件檢測
-        results = self.model(frame)
-        
-        # 在幀上繪製檢測結果
-        annotated_frame = results[0].plot()
-        
-        # 將 OpenCV 格式 (BGR) 轉換為 PyAV 格式 (RGB)
-        annotated_frame = cv2.cvtColor(annotated_frame, cv2.COLOR_BGR2RGB)
-        
-        # 創建 VideoFrame
-        video_frame = VideoFrame.from_ndarray(annotated_frame, format="rgb24")
-        video_frame.pts = self.counter
-        video_frame.time_base = "1/" + str(self.fps)
-        self.counter += 1
-        self.last_frame_time = time.time()
-        
-        return video_frame
-        
-    def stop(self):
-        """釋放攝像頭資源"""
-        if self.camera.isOpened():
-            self.camera.release()
-            logger.info("攝像頭已釋放")
-
 async def run_yolo_publisher(args):
-    # 創建 VideoStreamTrack
+    # 擷取 + YOLO 在背景執行緒，視頻軌的 recv() 只等待做好的幀，不卡住 ICE / DTLS
     try:
-        video_track = YOLOVideoStreamTrack(
+        pipeline, video_track = start_pipeline_track(
             camera_index=args.camera,
             width=args.width,
             height=args.height,
@@ -100,13 +27,17 @@ async def run_yolo_publisher(args):
     except Exception as e:
         logger.error(f"初始化視頻流失敗: {e}")
         return
+    logger.info(f"YOLO模型已加載: {args.model}")
+
+    # 透過 MediaRelay 訂閱：之後加入的 PeerConnection 共用同一次擷取與推理
+    relay = MediaRelay()
 
     # 創建 PeerConnection
     pc = RTCPeerConnection()
     pc_initialized = False
     
     # 添加視頻軌道
-    pc.addTrack(video_track)
+    pc.addTrack(relay.subscribe(video_track, buffered=False))
     
     # 監控連接狀態
     @pc.on("iceconnectionstatechange")
@@ -191,13 +122,15 @@ async def run_yolo_publisher(args):
         if pc_initialized:
             await pc.close()
         video_track.stop()
+        pipeline.stop()
+        logger.info(f"視頻軌統計: {video_track.stats()}")
         logger.info("已關閉連接")
 
 def main():
     parser = argparse.ArgumentParser(description='YOLO WebRTC 推流器')
     parser.add_argument('--sfu', type=str, default="ws://localhost:7000", help='SFU WebSocket URL')
     parser.add_argument('--model', type=str, required=True, help='YOLO 模型路徑')
-    parser.add_argument('--camera', type=int, default=0, help='攝像頭索引')
+    parser.add_argument('--camera', type=str, default="0", help='攝像頭索引、影片檔、ESP32-CAM 網址或 synthetic')
     parser.add_argument('--width', type=int, default=640, help='視頻寬度')
     parser.add_argument('--height', type=int, default=480, help='視頻高度')
     parser.add_argument('--fps', type=int, default=15, help='幀率')
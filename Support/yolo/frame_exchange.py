@@ -0,0 +1,188 @@
+# frame_exchange.py - 擷取 / 推理 / 推流執行緒之間交換幀：預先配置的緩衝區池，零複製交付，不忙等
+#
+# 單一生產者（攝影機執行緒）把幀直接讀進空的緩衝區（cap.read(image=...)），publish() 後成為「最新幀」；
+# 每個消費者（推理、推流 ...）用自己的 FrameReader 取得最新幀的參考，用完 release()。
+# 緩衝區數量 = 讀者數 + 2（最新幀 + 正在寫入的），所以生產者永遠拿得到空的緩衝區，不必等讀者。
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class FrameRef:
+    """某一幀的唯讀參考（array 為池中的緩衝區本身，不可修改）；可用 with 自動 release"""
+    __slots__ = ('array', 'seq', 'timestamp', '_exchange', '_index')
+
+    def __init__(self, exchange, index, seq, timestamp):
+        self._exchange = exchange
+        self._index = index
+        self.array = exchange._buffers[index]
+        self.seq = seq
+        self.timestamp = timestamp
+
+    def release(self):
+        if self._exchange is not None:
+            self._exchange._release(self._index)
+            self._exchange = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class FrameReader:
+    """單一消費者；同一時間最多持有一幀，下一次 get() 會先釋放上一幀"""
+
+    def __init__(self, exchange, name: str):
+        self.exchange = exchange
+        self.name = name
+        self.last_seq = 0
+        self.received = 0
+        self.dropped = 0      # 沒看到就被更新的幀
+        self.duplicated = 0   # 沒有新幀時重複拿到同一幀（wait=False）
+        self._held = None
+
+    def get(self, wait: bool = True, timeout: float = None):
+        """
+        wait=True：等到比上次更新的幀（逾時或關閉時回傳 None）。
+        wait=False：立即回傳最新幀，即使與上次相同（計入 duplicated）；尚無任何幀時回傳 None。
+        """
+        if self._held is not None:
+            self._held.release()
+            self._held = None
+        ref = self.exchange._acquire(self.last_seq if wait else None, timeout)
+        if ref is None:
+            return None
+        if ref.seq == self.last_seq:
+            self.duplicated += 1
+        else:
+            if self.last_seq:
+                self.dropped += ref.seq - self.last_seq - 1
+            self.received += 1
+            self.last_seq = ref.seq
+        self._held = ref
+        return ref
+
+    def stats(self):
+        return {'received': self.received, 'dropped': self.dropped, 'duplicated': self.duplicated}
+
+
+class FrameExchange:
+    def __init__(self, shape, dtype=np.uint8, readers: int = 2):
+        self.shape = tuple(shape)
+        self._buffers = [np.empty(self.shape, dtype=dtype) for _ in range(readers + 2)]
+        self._refs = [0] * len(self._buffers)
+        self._read = [True] * len(self._buffers)  # 最新幀是否被任何讀者拿過
+        self._latest = None
+        self._latest_seq = 0
+        self._latest_time = None
+        self._writing = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._readers = []
+        self.published = 0
+        self.overwritten = 0  # 沒有任何讀者拿過就被新幀取代
+
+    def reader(self, name: str) -> FrameReader:
+        if len(self._readers) >= len(self._buffers) - 2:
+            raise ValueError(f"FrameExchange was created for {len(self._buffers) - 2} readers")
+        reader = FrameReader(self, name)
+        self._readers.append(reader)
+        return reader
+
+    def writable(self):
+        """取得一個可寫入的空緩衝區（不是最新幀、也沒有讀者持有）"""
+        with self._cond:
+            for index, refs in enumerate(self._refs):
+                if refs == 0 and index != self._latest:
+                    self._writing = index
+                    return self._buffers[index]
+        raise RuntimeError("No free frame buffer; each reader must release before getting the next frame")
+
+    def publish(self, timestamp: float = None) -> int:
+        """把 writable() 取得的緩衝區設為最新幀並喚醒等待的讀者，回傳序號"""
+        with self._cond:
+            if self._writing is None:
+                raise RuntimeError("publish() without writable()")
+            if self._latest is not None and not self._read[self._latest]:
+                self.overwritten += 1
+            self._latest, self._writing = self._writing, None
+            self._read[self._latest] = False
+            self._latest_seq += 1
+            self._latest_time = time.monotonic() if timestamp is None else timestamp
+            self.published += 1
+            self._cond.notify_all()
+            return self._latest_seq
+
+    def capture(self, cap, flip: int = None) -> bool:
+        """
+        從 cv2.VideoCapture（或 frame_source 的來源）直接讀進緩衝區並發布；flip 同 cv2.flip 的 flipCode（None = 不翻轉）。
+        來源有 captured_at 時以它作為幀的時間戳記。
+        """
+        buffer = self.writable()
+        ok, image = cap.read(image=buffer)
+        if not ok or image is None:
+            return False
+        if image is not buffer:
+            # 攝影機實際尺寸與設定不同時 OpenCV 會另外配置，縮放進緩衝區
+            cv2.resize(image, (self.shape[1], self.shape[0]), dst=buffer)
+        if flip is not None:
+            cv2.flip(buffer, flip, dst=buffer)
+        self.publish(getattr(cap, 'captured_at', None))
+        return True
+
+    def _acquire(self, after_seq, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self._closed and (self._latest is None or
+                                        (after_seq is not None and self._latest_seq <= after_seq)):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            if self._closed or self._latest is None:
+                return None
+            self._refs[self._latest] += 1
+            self._read[self._latest] = True
+            return FrameRef(self, self._latest, self._latest_seq, self._latest_time)
+
+    def _release(self, index):
+        with self._cond:
+            self._refs[index] -= 1
+
+    def close(self):
+        """喚醒所有等待中的讀者（之後 get() 一律回傳 None）"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def stats(self):
+        return {
+            'published': self.published,
+            'overwritten': self.overwritten,
+            'readers': {reader.name: reader.stats() for reader in self._readers},
+        }
+
+
+class Pacer:
+    """固定速率的迴圈節拍：以排程時間累加，處理耗時不會讓實際速率漂移；落後太多時重新對齊"""
+
+    def __init__(self, fps: float):
+        self.period = 1.0 / fps
+        self._next = None
+
+    def wait(self):
+        now = time.monotonic()
+        if self._next is None or now - self._next > self.period:
+            self._next = now
+        elif self._next > now:
+            time.sleep(self._next - now)
+        self._next += self.period
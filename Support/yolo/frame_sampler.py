@@ -0,0 +1,89 @@
+# frame_sampler.py - 以延遲目標自動調整抽樣間隔
+import logging
+import math
+import threading
+import time
+
+
+class AdaptiveFrameSampler:
+    """
+    依據「推理耗時」與「進幀速率」動態決定每 N 幀處理一次。
+
+    端到端延遲估計：物件出現後最多等 interval 幀才被抽中，再加上推理時間
+        latency ≈ interval / fps + infer_time
+    另外抽樣速率不能超過推理能力，否則會堆積：
+        interval / fps >= infer_time * (1 + headroom)
+    在滿足推理能力的前提下，取「仍能達到延遲目標」的最大間隔，節省運算。
+    若目標無法達成，則以推理能力允許的最小間隔運作。
+    """
+
+    def __init__(self, target_latency: float, initial_interval: int = 2,
+                 min_interval: int = 1, max_interval: int = 30,
+                 headroom: float = 0.2, smoothing: float = 0.2):
+        self.target_latency = target_latency
+        self.min_interval = max(1, min_interval)
+        self.max_interval = max(self.min_interval, max_interval)
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.interval = min(max(initial_interval, self.min_interval), self.max_interval)
+
+        self._lock = threading.Lock()
+        self._frame_count = 0
+        self._last_frame_time = None
+        self._frame_period = None   # 平滑後的進幀間隔（秒）
+        self._infer_time = None     # 平滑後的推理耗時（秒）
+
+    def _ema(self, old, new):
+        return new if old is None else old + self.smoothing * (new - old)
+
+    def should_process(self, now: float = None) -> bool:
+        """每收到一幀呼叫一次，回傳這一幀是否要送去推理"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._last_frame_time is not None:
+                self._frame_period = self._ema(self._frame_period, now - self._last_frame_time)
+            self._last_frame_time = now
+            self._frame_count += 1
+            return self._frame_count % self.interval == 0
+
+    def record_inference(self, duration: float):
+        """回報一次推理耗時（秒），並重新計算抽樣間隔"""
+        with self._lock:
+            self._infer_time = self._ema(self._infer_time, duration)
+            self._update_interval()
+
+    def _update_interval(self):
+        if not self._frame_period or self._infer_time is None:
+            return
+        fps = 1.0 / self._frame_period
+
+        # 推理能力下限：每次抽樣之間要有足夠時間完成推理
+        capacity_min = math.ceil(self._infer_time * (1 + self.headroom) * fps)
+        # 延遲目標上限：抽樣等待 + 推理不可超過目標
+        latency_max = math.floor((self.target_latency - self._infer_time) * fps)
+
+        interval = max(capacity_min, min(latency_max, self.max_interval))
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        if interval != self.interval:
+            logging.info(f"Frame interval {self.interval} -> {interval} "
+                         f"(fps={fps:.1f}, infer={self._infer_time * 1000:.0f}ms, "
+                         f"target={self.target_latency * 1000:.0f}ms)")
+            self.interval = interval
+
+    @property
+    def input_fps(self) -> float:
+        return 1.0 / self._frame_period if self._frame_period else 0.0
+
+    @property
+    def detection_rate(self) -> float:
+        """實際偵測速率（次/秒）"""
+        return self.input_fps / self.interval
+
+    def stats(self):
+        return {
+            'frameInterval': self.interval,
+            'inputFps': round(self.input_fps, 2),
+            'detectionRate': round(self.detection_rate, 2),
+            'inferenceMs': round(self._infer_time * 1000, 1) if self._infer_time is not None else None,
+            'targetLatencyMs': round(self.target_latency * 1000),
+        }
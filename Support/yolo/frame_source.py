@@ -0,0 +1,366 @@
+# frame_source.py - 影像來源：攝影機 / 影片檔 / ESP32-CAM MJPEG / 合成畫面，共用 cv2.VideoCapture 相容介面
+#
+# 各推流腳本原本都寫死 cv2.VideoCapture(camera_index)，沒有攝影機的機器（CI、伺服器）跑不起來，吞吐量也無法重現。
+# open_source(spec) 依字串選來源，回傳的物件有 read(image=None) / isOpened() / get() / set() / release()，
+# 可以直接取代 cv2.VideoCapture（FrameExchange.capture、cap.get(cv2.CAP_PROP_FRAME_WIDTH) ... 都不用改）：
+#   "0"、"1"                      攝影機索引（width / height / fps 會設定後讀回實際值）
+#   "http://172.30.71.19/stream"  ESP32-CAM MJPEG（mjpeg_source.py，斷線自動重連、只保留最新一幀）
+#   "video.mp4"                   影片檔；pacing="realtime" 依影片 fps 播放，"fast" 不等待（量測吞吐量用），loop=True 循環
+#   "synthetic"、"synthetic:300"  合成畫面（漸層背景上移動的方塊 / 圓形），內容只由幀序號決定，每次執行都相同；
+#                                 ":300" 表示 300 幀後結束
+# 每次 read() 成功後 captured_at 為該幀的擷取時間（time.monotonic()；ESP32-CAM 為收到 JPEG 的時間），
+# 有限的來源（影片檔不循環、synthetic:N）讀完後 ended 為 True。
+#   python frame_source.py synthetic --pacing fast --frames 300      量測來源本身的讀取速度
+#   python frame_source.py --selftest
+import time
+
+import cv2
+import numpy as np
+
+from frame_exchange import Pacer
+
+PACINGS = ('realtime', 'fast')
+SYNTHETIC = 'synthetic'
+
+
+class FrameSource:
+    """來源基底：子類別實作 _read(image) -> (frame, captured_at)，讀不到回傳 (None, None)"""
+
+    def __init__(self, name: str, width: int = 0, height: int = 0, fps: float = 0.0):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.captured_at = None  # 最近一幀的擷取時間（time.monotonic()）
+        self.ended = False       # 有限的來源已經讀完
+        self.frames = 0
+        self.failures = 0
+        self._started = None
+        self._released = False
+
+    def _read(self, image):
+        raise NotImplementedError
+
+    def read(self, image=None):
+        """回傳 (ok, frame)；image 尺寸相同時讀進 image 並回傳它（同 cv2.VideoCapture.read(image=...)）"""
+        if self._released or self.ended:
+            return False, None
+        frame, captured_at = self._read(image)
+        if frame is None:
+            if not self.ended:
+                self.failures += 1
+            return False, None
+        self.captured_at = time.monotonic() if captured_at is None else captured_at
+        if self._started is None:
+            self._started = self.captured_at
+        self.frames += 1
+        return True, frame
+
+    def isOpened(self) -> bool:
+        return not self._released
+
+    def get(self, prop_id) -> float:
+        if prop_id == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop_id == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop_id == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        return 0.0
+
+    def set(self, prop_id, value) -> bool:
+        return False
+
+    def release(self):
+        self._released = True
+
+    def stats(self):
+        elapsed = (self.captured_at or 0) - (self._started or 0)
+        return {
+            'source': self.name,
+            'size': f"{self.width}x{self.height}",
+            'fps': round((self.frames - 1) / elapsed, 1) if elapsed > 0 else None,
+            'frames': self.frames,
+            'failures': self.failures,
+            'ended': self.ended,
+        }
+
+
+class CameraSource(FrameSource):
+    """cv2.VideoCapture(index)；設定解析度 / 幀率後讀回攝影機實際採用的值"""
+
+    def __init__(self, index: int, width: int = None, height: int = None, fps: float = None):
+        super().__init__(f"camera:{index}")
+        self.cap = cv2.VideoCapture(index)
+        if width:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height:
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if fps:
+            self.cap.set(cv2.CAP_PROP_FPS, fps)
+        self._update_size()
+
+    def _update_size(self):
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+
+    def _read(self, image):
+        ok, frame = self.cap.read(image)
+        return (frame, None) if ok else (None, None)
+
+    def isOpened(self) -> bool:
+        return not self._released and self.cap.isOpened()
+
+    def get(self, prop_id) -> float:
+        return self.cap.get(prop_id)
+
+    def set(self, prop_id, value) -> bool:
+        ok = self.cap.set(prop_id, value)
+        self._update_size()
+        return ok
+
+    def release(self):
+        super().release()
+        self.cap.release()
+
+
+class FileSource(FrameSource):
+    """影片檔：realtime 依影片 fps 送出（與攝影機相同節奏），fast 盡快送出；loop=True 讀到結尾從頭開始"""
+
+    def __init__(self, path: str, pacing: str = 'realtime', loop: bool = False):
+        if pacing not in PACINGS:
+            raise ValueError(f"pacing must be one of {PACINGS}, got {pacing!r}")
+        super().__init__(f"file:{path}")
+        self.cap = cv2.VideoCapture(path)
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.loop = loop
+        self.loops = 0
+        self._pacer = Pacer(self.fps) if pacing == 'realtime' else None
+
+    def _read(self, image):
+        if self._pacer is not None:
+            self._pacer.wait()
+        ok, frame = self.cap.read(image)
+        if not ok and self.loop and self.frames:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.loops += 1
+            ok, frame = self.cap.read(image)
+        if not ok:
+            self.ended = True
+            return None, None
+        return frame, None
+
+    def isOpened(self) -> bool:
+        return not self._released and self.cap.isOpened()
+
+    def get(self, prop_id) -> float:
+        if prop_id == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        return self.cap.get(prop_id)
+
+    def release(self):
+        super().release()
+        self.cap.release()
+
+    def stats(self):
+        stats = super().stats()
+        stats['loops'] = self.loops
+        return stats
+
+
+class SyntheticSource(FrameSource):
+    """
+    漸層背景上幾個移動的方塊 / 圓形與幀序號；第 n 幀的內容只由 n、尺寸與 seed 決定，不依賴時間，
+    所以同樣的參數每次執行得到完全相同的畫面（可重現的離線基準測試）。frames 為總幀數（None = 不結束）。
+    """
+
+    def __init__(self, width: int = 640, height: int = 480, fps: float = 30.0, pacing: str = 'realtime',
+                 frames: int = None, seed: int = 0, shapes: int = 4):
+        if pacing not in PACINGS:
+            raise ValueError(f"pacing must be one of {PACINGS}, got {pacing!r}")
+        super().__init__(SYNTHETIC if frames is None else f"{SYNTHETIC}:{frames}", width, height, fps)
+        self.limit = frames
+        self._pacer = Pacer(fps) if pacing == 'realtime' else None
+        x = np.linspace(40, 120, width, dtype=np.float32)
+        y = np.linspace(0, 60, height, dtype=np.float32)[:, None]
+        gray = (x + y).astype(np.uint8)
+        self._background = np.dstack([gray, gray, (gray * 0.8).astype(np.uint8)])
+        rng = np.random.default_rng(seed)
+        size = max(min(width, height) // 8, 8)
+        self._shapes = [(int(rng.integers(size // 2, size * 2)),                # 邊長 / 直徑
+                         rng.uniform(0.2, 1.0, 2) * rng.choice((-1, 1), 2),    # 每幀移動的比例（x, y）
+                         rng.uniform(0, 1, 2),                                 # 起點
+                         tuple(int(c) for c in rng.integers(0, 256, 3)))       # 顏色
+                        for _ in range(shapes)]
+
+    def render(self, index: int, image=None):
+        """畫出第 index 幀（BGR）；image 尺寸相同時畫在 image 上"""
+        if image is None or image.shape != self._background.shape:
+            image = np.empty_like(self._background)
+        np.copyto(image, self._background)
+        for k, (size, velocity, start, color) in enumerate(self._shapes):
+            # 在畫面內來回反彈：位置是幀序號的三角波
+            span = np.array([self.width - size, self.height - size], dtype=np.float64)
+            travel = (start * span + index * velocity * span / 90) % (2 * span)
+            x, y = np.where(travel > span, 2 * span - travel, travel).astype(int)
+            if k % 2:
+                cv2.circle(image, (x + size // 2, y + size // 2), size // 2, color, -1)
+            else:
+                cv2.rectangle(image, (x, y), (x + size, y + size), color, -1)
+        cv2.putText(image, str(index), (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+        return image
+
+    def _read(self, image):
+        if self.limit is not None and self.frames >= self.limit:
+            self.ended = True
+            return None, None
+        if self._pacer is not None:
+            self._pacer.wait()
+        return self.render(self.frames, image), None
+
+
+class ESP32Source(FrameSource):
+    """ESP32-CAM MJPEG 串流（MJPEGCapture）；開啟時等第一幀以得知解析度，timeout 內沒有畫面則 isOpened() 為 False"""
+
+    def __init__(self, url: str, scale: int = 1, timeout: float = 5.0):
+        super().__init__(url)
+        from mjpeg_source import MJPEGCapture
+        self.cap = MJPEGCapture(url, scale=scale, timeout=timeout)
+        ok, self._first = self.cap.read()
+        self._first_at = self.cap.captured_at
+        if ok:
+            self.height, self.width = self._first.shape[:2]
+        else:
+            self.cap.release()
+
+    def _read(self, image):
+        if self._first is not None:
+            frame, self._first = self._first, None
+            if image is not None and image.shape == frame.shape:
+                np.copyto(image, frame)
+                frame = image
+            return frame, self._first_at
+        ok, frame = self.cap.read(image)
+        return (frame, self.cap.captured_at) if ok else (None, None)
+
+    def isOpened(self) -> bool:
+        return not self._released and self.cap.isOpened()
+
+    def release(self):
+        super().release()
+        self.cap.release()
+
+    def stats(self):
+        stats = super().stats()
+        stats['stream'] = self.cap.stats()
+        return stats
+
+
+def open_source(spec, width: int = None, height: int = None, fps: float = None, pacing: str = 'realtime',
+                loop: bool = False, **kwargs) -> FrameSource:
+    """
+    依 spec 開啟來源（見檔頭）。width / height / fps 用於攝影機設定與合成畫面；影片檔與 ESP32-CAM 用來源本身的值
+    （尺寸不同時 FrameExchange.capture 會縮放）。其餘參數傳給 ESP32Source（scale / timeout）。
+    開啟失敗不會拋出，呼叫端和 cv2.VideoCapture 一樣檢查 isOpened()。
+    """
+    spec = str(spec)
+    if spec.isdigit():
+        return CameraSource(int(spec), width, height, fps)
+    if spec.startswith('http://'):
+        return ESP32Source(spec, **kwargs)
+    name, _, count = spec.partition(':')
+    if name == SYNTHETIC:
+        return SyntheticSource(width or 640, height or 480, fps or 30.0, pacing, frames=int(count) if count else None)
+    return FileSource(spec, pacing, loop)
+
+
+def _benchmark(spec, frames=300, pacing='fast', show=False):
+    """讀 frames 幀，回報來源本身的讀取速度（不含推理 / 編碼）"""
+    source = open_source(spec, pacing=pacing, loop=True)
+    if not source.isOpened():
+        raise SystemExit(f"Failed to open {spec}")
+    image = None
+    start = time.perf_counter()
+    while source.frames < frames:
+        ok, frame = source.read(image)
+        if not ok:
+            if source.ended:
+                break
+            continue
+        image = frame
+        if show:
+            cv2.imshow(source.name, frame)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    elapsed = time.perf_counter() - start
+    source.release()
+    print(f"{source.name}: {source.frames} frames in {elapsed:.2f}s ({source.frames / elapsed:.0f} fps) {source.stats()}")
+
+
+def _selftest():
+    import os
+    import tempfile
+    # 合成畫面可重現：兩個來源同一幀序號的畫面完全相同
+    a, b = SyntheticSource(320, 240, pacing='fast', frames=20), SyntheticSource(320, 240, pacing='fast', frames=20)
+    image = None
+    frames = []
+    while True:
+        ok, image = a.read(image)
+        if not ok:
+            break
+        ok, other = b.read()
+        assert ok and np.array_equal(image, other)
+        frames.append(image.copy())
+    assert a.ended and len(frames) == 20 and not np.array_equal(frames[0], frames[1])
+    print(f"synthetic: deterministic, {a.stats()}")
+
+    # realtime 依 fps 送出，captured_at 為單調時間
+    source = open_source("synthetic:10", 160, 120, 50)
+    stamps = []
+    while source.read()[0]:
+        stamps.append(source.captured_at)
+    period = (stamps[-1] - stamps[0]) / (len(stamps) - 1)
+    assert abs(period - 0.02) < 0.005 and stamps == sorted(stamps), period
+    print(f"synthetic realtime: {period * 1000:.1f} ms/frame at 50 fps")
+
+    # 影片檔：fast 盡快讀完、loop 循環、realtime 依影片 fps
+    path = os.path.join(tempfile.mkdtemp(), "synthetic.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 25, (320, 240))
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+    source = open_source(path, pacing='fast')
+    assert source.isOpened() and (source.width, source.height, source.get(cv2.CAP_PROP_FPS)) == (320, 240, 25)
+    while source.read()[0]:
+        pass
+    assert source.ended and source.frames == 20, source.stats()
+    source = open_source(path, pacing='fast', loop=True)
+    for _ in range(50):
+        assert source.read()[0]
+    assert source.loops == 2, source.stats()
+    source = open_source(path)
+    start = time.monotonic()
+    for _ in range(10):
+        source.read()
+    assert time.monotonic() - start > 9 / 25 * 0.9
+    print(f"file: {open_source(path, pacing='fast').stats()['size']}, fast / loop / realtime ok")
+    os.remove(path)
+    print("selftest ok")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Read frames from a camera, video file, ESP32-CAM URL or synthetic source")
+    parser.add_argument("source", nargs='?', default=SYNTHETIC, help="Camera index, file path, http:// URL or synthetic[:N]")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--pacing", choices=PACINGS, default='fast')
+    parser.add_argument("--show", action="store_true")
+    parser.add_argument("--selftest", action="store_true")
+    args = parser.parse_args()
+    if args.selftest:
+        _selftest()
+    else:
+        _benchmark(args.source, args.frames, args.pacing, args.show)
@@ -0,0 +1,189 @@
+# inference_worker.py - 將 YOLO 推理移出 asyncio 事件迴圈
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+
+class TrackSlot:
+    """單一軌道的 latest-frame 槽、速率限制與統計"""
+
+    def __init__(self, key, max_fps: float = 0.0):
+        self.key = key
+        self.item = None
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self.last_dispatch = float('-inf')
+        self.in_flight = False
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0  # 所在批次推理失敗的幀（不計入 processed）
+        self.dropped = 0
+
+    def ready(self, now: float) -> bool:
+        return self.item is not None and not self.in_flight and now - self.last_dispatch >= self.min_interval
+
+    def stats(self):
+        return {'submitted': self.submitted, 'processed': self.processed, 'failed': self.failed,
+                'dropped': self.dropped}
+
+
+class BatchScheduler:
+    """
+    多個軌道共用一個模型。
+    每個軌道只保留最新一幀，排程執行緒以 round-robin 輪流取各軌道的最新幀，
+    組成一個批次推理後再把結果依軌道送回事件迴圈。
+    infer_batch_fn(batch) 接收 [(key, item), ...]，回傳同順序的結果列表；
+    也可以回傳 concurrent.futures.Future（多行程後端），排程器不等待就繼續組下一批，
+    但同一軌道在前一批完成前不會再被送出，因此各軌道的結果仍依序發布。
+    on_result(key, result) 為協程，在事件迴圈中發布結果。
+    """
+
+    def __init__(self, infer_batch_fn, on_result, loop: asyncio.AbstractEventLoop,
+                 max_batch: int = 4, max_fps: float = 0.0, name: str = 'yolo-batch',
+                 stats_interval: float = 10.0):
+        self.infer_batch_fn = infer_batch_fn
+        self.on_result = on_result
+        self.loop = loop
+        self.max_batch = max(1, max_batch)
+        self.max_fps = max_fps
+        self.name = name
+        self.stats_interval = stats_interval
+        self.batches = 0
+        self.errors = 0
+        self._slots = {}
+        self._order = []
+        self._rr = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        logging.info(f"Batch scheduler '{self.name}' started (max_batch={self.max_batch})")
+
+    def stop(self, timeout: float = 5.0):
+        if not self._running:
+            return
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        logging.info(f"Batch scheduler '{self.name}' stopped: {self.stats()}")
+
+    def add_track(self, key, max_fps: float = None):
+        with self._cond:
+            if key not in self._slots:
+                self._slots[key] = TrackSlot(key, self.max_fps if max_fps is None else max_fps)
+                self._order.append(key)
+        logging.info(f"Track added to scheduler: {key}")
+
+    def remove_track(self, key):
+        with self._cond:
+            slot = self._slots.pop(key, None)
+            if slot is None:
+                return
+            self._order.remove(key)
+            self._rr = self._rr % len(self._order) if self._order else 0
+        logging.info(f"Track removed from scheduler: {key} ({slot.stats()})")
+
+    def submit(self, key, item):
+        """交付某軌道的一幀（不阻塞）；該軌道前一幀尚未處理則直接覆蓋"""
+        with self._cond:
+            slot = self._slots.get(key)
+            if slot is None:
+                return
+            slot.submitted += 1
+            if slot.item is not None:
+                slot.dropped += 1
+            slot.item = item
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'batches': self.batches,
+                'errors': self.errors,
+                'tracks': {key: slot.stats() for key, slot in self._slots.items()},
+            }
+
+    def _next_batch(self):
+        """等待並取出下一個批次：從 round-robin 指標開始，最多 max_batch 個軌道"""
+        with self._cond:
+            while self._running:
+                now = time.monotonic()
+                count = len(self._order)
+                batch = []
+                last_index = None
+                for offset in range(count):
+                    index = (self._rr + offset) % count
+                    slot = self._slots[self._order[index]]
+                    if slot.ready(now):
+                        batch.append((slot.key, slot.item))
+                        slot.item = None
+                        slot.last_dispatch = now
+                        slot.in_flight = True
+                        last_index = index
+                        if len(batch) >= self.max_batch:
+                            break
+                if batch:
+                    self._rr = (last_index + 1) % count
+                    return batch
+
+                # 有幀但被速率限制時，只等到最早可以送出的時間
+                waits = [slot.last_dispatch + slot.min_interval - now
+                         for slot in self._slots.values() if slot.item is not None and not slot.in_flight]
+                self._cond.wait(min(waits) if waits else 0.5)
+            return None
+
+    def _run(self):
+        last_stats_time = time.monotonic()
+        while self._running:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    results = self.infer_batch_fn(batch)
+                except Exception as e:
+                    results = e
+                if isinstance(results, concurrent.futures.Future):
+                    results.add_done_callback(lambda future, batch=batch: self._complete(batch, future))
+                else:
+                    self._complete(batch, results)
+
+            now = time.monotonic()
+            if self.stats_interval and now - last_stats_time >= self.stats_interval:
+                logging.info(f"Batch scheduler '{self.name}' stats: {self.stats()}")
+                last_stats_time = now
+
+    def _complete(self, batch, results):
+        """批次完成：更新統計、放行這些軌道的下一幀並發布結果（可能在其他執行緒呼叫）"""
+        if isinstance(results, concurrent.futures.Future):
+            try:
+                results = results.result()
+            except Exception as e:
+                results = e
+        failed = isinstance(results, Exception)
+        with self._cond:
+            self.batches += 1
+            if failed:
+                self.errors += 1
+                logging.error(f"Batch inference error in '{self.name}': {results}")
+                results = [None] * len(batch)
+            for key, _ in batch:
+                slot = self._slots.get(key)
+                if slot is not None:
+                    if failed:
+                        slot.failed += 1
+                    else:
+                        slot.processed += 1
+                    slot.in_flight = False
+            self._cond.notify()
+
+        for (key, _), result in zip(batch, results):
+            if result is not None and self.on_result is not None and not self.loop.is_closed():
+                asyncio.run_coroutine_threadsafe(self.on_result(key, result), self.loop)
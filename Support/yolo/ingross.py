@@ -14,6 +14,11 @@ from datetime import datetime
 from dotenv import load_dotenv
 from ultralytics import YOLO
 
+from ffmpeg_feeder import FFmpegFeeder
+from frame_source import open_source
+from overlay import OverlayRenderer, result_detections
+from preview import Preview
+
 # 配置日志（别再瞎BB了，日志能帮你找问题）
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 logger = logging.getLogger("yolo-rtmp-publisher")
@@ -24,18 +29,26 @@ load_dotenv('development.env')
 class YOLORTMPPusher:
     def __init__(self):
         # 配置参数
-        self.camera_index = 0
+        # 摄像头索引，也可以是视频文件、ESP32-CAM网址或synthetic（见frame_source.py），没有摄像头时也能测试
+        self.camera_index = os.getenv("FRAME_SOURCE", "0")
         self.width = 1280
         self.height = 720
         self.fps = 15
         self.bitrate = "3000k"
         self.model_path = "models/best.pt"
         self.room_name = os.getenv("ROOM_NAME", "my-room")
+        self.pipe_i420 = True  # 送进FFmpeg前先转成I420（每帧字节数减半），False则送bgr24
+        self.feeder_queue = 2  # 送帧队列上限，推流卡住时丢最旧的帧
+        # 输出方式：ffmpeg（子进程+管道）或 pyav（进程内编码，断线只重连输出，不用重启进程）
+        self.output_backend = os.getenv("OUTPUT_BACKEND", "ffmpeg")
+        # 本地预览默认关闭（PREVIEW=window|http），开启时在自己的线程显示，推流循环不等GUI事件
+        self.preview = Preview.from_env("YOLO RTMP Publisher")
         
         self.rtpm_url = None  # 将从 LiveKit Ingress 创建后获得 RTMP 推流 URL
         self.running = False
         self.cap = None
         self.ffmpeg_process = None
+        self.feeder = None
         self.ingress_info = None
         
         # LiveKit API 配置
@@ -55,6 +68,7 @@ class YOLORTMPPusher:
         try:
             logger.info(f"正在加载YOLO模型: {self.model_path}")
             self.model = YOLO(self.model_path)
+            self.overlay = OverlayRenderer(self.model.names)
             logger.info("YOLO模型加载成功")
         except Exception as e:
             logger.error(f"加载YOLO模型时出错: {e}")
@@ -134,13 +148,10 @@ class YOLORTMPPusher:
 
     def start_camera(self):
         logger.info(f"初始化摄像头 #{self.camera_index}")
-        self.cap = cv2.VideoCapture(self.camera_index)
+        self.cap = open_source(self.camera_index, self.width, self.height, self.fps)
         if not self.cap.isOpened():
             logger.error(f"无法打开摄像头 #{self.camera_index}")
             return False
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
-        self.cap.set(cv2.CAP_PROP_FPS, self.fps)
         actual_width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         actual_height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         actual_fps = int(self.cap.get(cv2.CAP_PROP_FPS))
@@ -162,7 +173,7 @@ class YOLORTMPPusher:
             "ffmpeg",
             "-hide_banner",
             "-f", "rawvideo",
-            "-pix_fmt", "bgr24",
+            "-pix_fmt", "yuv420p" if self.pipe_i420 else "bgr24",
             "-s", f"{self.width}x{self.height}",
             "-r", str(self.fps),
             "-i", "pipe:0",
@@ -184,7 +195,8 @@ class YOLORTMPPusher:
                 stdin=subprocess.PIPE,
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.DEVNULL,
-                bufsize=10**8
+                # 不在Python端缓冲，积压交给送帧队列处理（满了丢最旧的帧）
+                bufsize=0
             )
             logger.info("FFmpeg进程启动成功")
             return True
@@ -192,8 +204,8 @@ class YOLORTMPPusher:
             logger.error(f"启动FFmpeg失败: {e}")
             return False
 
-    def restart_ffmpeg(self):
-        logger.error("FFmpeg进程挂了，重启它！")
+    def restart_ffmpeg(self, error=None):
+        logger.error(f"FFmpeg进程挂了，重启它！{error or ''}")
         if self.ffmpeg_process:
             try:
                 self.ffmpeg_process.stdin.close()
@@ -209,12 +221,14 @@ class YOLORTMPPusher:
             self.running = False
 
     def process_frame(self, frame):
+        # 摄像头不一定给出设定的分辨率，推流前统一尺寸（一致时不复制）
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            frame = cv2.resize(frame, (self.width, self.height))
         if self.model:
             try:
-                results = self.model(frame)
-                processed = results[0].plot()
-                processed = cv2.resize(processed, (self.width, self.height))
-                return processed
+                results = self.model(frame, verbose=False)
+                # 直接在要推流的帧上画框，不再复制整张画面
+                return self.overlay.draw(frame, result_detections(results[0]))
             except Exception as e:
                 logger.error(f"YOLO处理错误: {e}")
                 return frame
@@ -229,38 +243,31 @@ class YOLORTMPPusher:
         while self.running:
             ret, frame = self.cap.read()
             if not ret:
+                if self.cap.ended:
+                    logger.info(f"视频源已读完: {self.cap.stats()}")
+                    self.running = False
+                    break
                 logger.error("无法从摄像头读取帧")
                 time.sleep(0.1)
                 continue
             processed = self.process_frame(frame)
-            cv2.imshow("YOLO RTMP Publisher", processed)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
+            self.preview.submit(processed)
+            if self.preview.quit_requested:
                 logger.info("用户按下q键，停止推流")
                 self.running = False
                 break
 
-            # 检查FFmpeg是否挂了，挂了就重启它
-            if self.ffmpeg_process.poll() is not None:
-                logger.error("检测到FFmpeg进程异常退出，重启推流进程...")
-                self.restart_ffmpeg()
-                continue
-
-            try:
-                self.ffmpeg_process.stdin.write(processed.tobytes())
-            except BrokenPipeError:
-                logger.error("发送帧时遇到BrokenPipeError，重启FFmpeg进程")
-                self.restart_ffmpeg()
-                continue
-            except Exception as e:
-                logger.error(f"发送帧到FFmpeg时出错: {e}")
-                continue
+            # 交给送帧线程，推流卡住时不会阻塞摄像头和推理；
+            # FFmpeg挂了（BrokenPipe或进程退出）由送帧线程调用restart_ffmpeg重启
+            if not self.feeder.submit(processed, self.cap.captured_at):
+                break
             
             frame_count += 1
             current_time = time.time()
             if current_time - last_log_time >= 1.0:
                 elapsed = current_time - start_time
                 actual_fps = frame_count / elapsed
-                logger.info(f"已发送 {frame_count} 帧, 实际FPS: {actual_fps:.2f}")
+                logger.info(f"已发送 {frame_count} 帧, 实际FPS: {actual_fps:.2f}, 送帧: {self.feeder.stats()}")
                 last_log_time = current_time
 
     def start(self):
@@ -282,10 +289,20 @@ class YOLORTMPPusher:
             logger.error("摄像头初始化失败，退出")
             return False
         
-        if not self.start_ffmpeg():
-            logger.error("FFmpeg启动失败，退出")
-            self.cap.release()
-            return False
+        if self.output_backend == "pyav":
+            from av_output import AVOutput
+            self.feeder = AVOutput(self.rtpm_url, self.width, self.height, self.fps, bitrate=self.bitrate,
+                                   gop=self.fps * 2, preset="veryfast", i420=self.pipe_i420,
+                                   max_queue=self.feeder_queue)
+            logger.info("使用PyAV进程内编码推流")
+        else:
+            if not self.start_ffmpeg():
+                logger.error("FFmpeg启动失败，退出")
+                self.cap.release()
+                return False
+            self.feeder = FFmpegFeeder(lambda: self.ffmpeg_process, self.width, self.height, i420=self.pipe_i420,
+                                       max_queue=self.feeder_queue, on_error=self.restart_ffmpeg,
+                                       stall_threshold=1.0 / self.fps)
         
         self.running = True
         logger.info("所有组件已启动，开始推流")
@@ -303,6 +320,11 @@ class YOLORTMPPusher:
         
         if self.cap and self.cap.isOpened():
             self.cap.release()
+
+        if self.feeder:
+            self.feeder.close()
+            logger.info(f"送帧统计: {self.feeder.stats()}")
+            self.feeder = None
             
         if self.ffmpeg_process:
             try:
@@ -312,7 +334,7 @@ class YOLORTMPPusher:
             except Exception as e:
                 logger.error(f"关闭FFmpeg时出错: {e}")
                 
-        cv2.destroyAllWindows()
+        self.preview.close()
         logger.info("所有资源已释放")
 
 if __name__ == "__main__":
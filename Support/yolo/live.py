@@ -9,6 +9,11 @@ from livekit import rtc, api
 from dotenv import load_dotenv
 import os
 
+from frame_source import open_source
+from overlay import OverlayRenderer, result_detections
+from livekit_frames import VideoFramePool, SnapshotWriter
+from preview import Preview
+
 # 載入環境變數
 load_dotenv('development.env')
 
@@ -16,6 +21,12 @@ load_dotenv('development.env')
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 logger = logging.getLogger("livekit-publisher")
 
+# 推流緩衝區格式：rgba（預設，較快）或 i420；見 livekit_frames.py 的量測
+PUBLISH_FORMAT = os.getenv("LIVE_PUBLISH_FORMAT", "rgba")
+# 除錯 JPEG 的最短間隔（秒），0 表示不存
+DEBUG_SNAPSHOT_INTERVAL = float(os.getenv("DEBUG_SNAPSHOT_INTERVAL", "0"))
+STATS_LOG_INTERVAL = 300  # 每幾幀記錄一次轉換耗時
+
 # 生成存取 Token
 def generate_token():
     token = api.AccessToken() \
@@ -27,73 +38,84 @@ def generate_token():
 
 # 定義異步生成器，持續輸出經 YOLO 處理的視頻幀
 async def video_generator(cap, model, target_fps):
+    overlay = OverlayRenderer(model.names)
+    # 本地預覽預設關閉（PREVIEW=window 或 http），開啟時在自己的執行緒顯示，不佔用事件迴圈
+    preview = Preview.from_env("Processed Frame")
+    raw = frame = None  # 第一幀之後重用同一組緩衝區
     while True:
-        ret, frame = await asyncio.to_thread(cap.read)
+        ret, raw = await asyncio.to_thread(cap.read, raw)
         if not ret:
+            if cap.ended:
+                logger.info("來源已讀完: %s", cap.stats())
+                break
             logger.error("無法從攝影機讀取幀")
             continue
         # 翻轉畫面（可根據需求調整）
-        frame = cv2.flip(frame, 1)
+        frame = cv2.flip(raw, 1, dst=frame)
         try:
-            # 使用 YOLO 模型處理並疊加檢測結果
-            results = await asyncio.to_thread(model, frame)
-            processed = results[0].plot()
-            # 確保處理後的幀尺寸與原始幀一致
-            processed = cv2.resize(processed, (frame.shape[1], frame.shape[0]))
-            # 將 BGR 轉換為 RGB
-            processed = cv2.cvtColor(processed, cv2.COLOR_BGR2RGB)
+            # 使用 YOLO 模型處理，偵測框直接畫在 BGR 幀上（轉成推流格式由 CustomVideoSource 一次完成）
+            results = await asyncio.to_thread(model, frame, verbose=False)
+            overlay.draw(frame, result_detections(results[0]))
         except Exception as e:
             logger.error("YOLO 處理錯誤: %s", e)
-            processed = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         # 顯示處理後的畫面供本地調試
-        cv2.imshow("Processed Frame", cv2.cvtColor(processed, cv2.COLOR_RGB2BGR))
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        preview.submit(frame)
+        if preview.quit_requested:
             break
-        yield processed  # 傳出處理後的幀 (numpy array)
+        yield frame  # 傳出處理後的 BGR 幀；下一次迭代會覆寫，使用端需在要下一幀前用完
         await asyncio.sleep(1 / target_fps)
     cap.release()
-    cv2.destroyAllWindows()
+    preview.close()
 
 # 自訂視頻來源
 class CustomVideoSource(rtc.VideoSource):
-    def __init__(self, generator, width, height):
+    def __init__(self, generator, width, height, buffer_type=PUBLISH_FORMAT, snapshot_interval=DEBUG_SNAPSHOT_INTERVAL):
         super().__init__(width, height)
+        self.width = width
+        self.height = height
         self._generator = generator
         self._running = True
+        # 預先配置的 VideoFrame：每幀只做一次 BGR -> RGBA / I420，不再 tobytes()
+        self._pool = VideoFramePool(width, height, buffer_type)
+        # 除錯 JPEG 在背景執行緒寫，不佔用事件迴圈
+        self._snapshots = SnapshotWriter(interval=snapshot_interval) if snapshot_interval > 0 else None
 
     async def capture_frames(self):
         frame_count = 0
         async for frame in self._generator:
             if not self._running:
                 break
-            # 每 10 幀保存一次以供調試
-            if frame_count % 10 == 0:
-                cv2.imwrite(f"frame_{frame_count}.jpg", cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
-            # 將 numpy array 轉換為 LiveKit 的 VideoFrame
-            from livekit.rtc.video_frame import VideoFrame, VideoBufferType
-            video_frame = VideoFrame(width=self.width, height=self.height,
-                                     type=VideoBufferType.RGB24,
-                                     data=frame.tobytes())
+            if self._snapshots is not None:
+                self._snapshots.offer(frame, frame_count)
+            video_frame = self._pool.fill(frame)
             # 使用 monotonic 時間生成時間戳
             timestamp_us = int(time.monotonic() * 1e6)
             self.capture_frame(video_frame, timestamp_us=timestamp_us, rotation=0)
             frame_count += 1
+            if frame_count % STATS_LOG_INTERVAL == 0:
+                logger.info("推流統計: %s", self.stats())
             await asyncio.sleep(0)  # 讓出控制權
 
+    def stats(self):
+        stats = self._pool.stats()
+        if self._snapshots is not None:
+            stats['snapshots'] = self._snapshots.stats()
+        return stats
+
     def stop(self):
         self._running = False
+        if self._snapshots is not None:
+            self._snapshots.close()
 
 async def main():
     # 初始化 YOLO 模型
     model = YOLO("models/best.pt")
     
-    # 開啟攝影機
-    cap = cv2.VideoCapture(0)
+    # 開啟攝影機（FRAME_SOURCE 可改成影片檔、ESP32-CAM 網址或 synthetic，見 frame_source.py）
+    cap = open_source(os.getenv("FRAME_SOURCE", "0"), 640, 480)
     if not cap.isOpened():
         logger.error("無法開啟攝影機")
         return
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
     target_fps = 15
     logger.info("攝影機初始化成功：640x480，目標 FPS: %d", target_fps)
     
@@ -0,0 +1,212 @@
+# livekit_frames.py - 把 BGR 幀一次轉色寫進預先配置的 LiveKit VideoFrame（I420 / RGBA），不再每幀 tobytes()
+#
+# 原本 live.py 每幀：BGR->RGB 一次、imshow 前 RGB->BGR 再一次、frame.tobytes() 複製一次，
+# 每 10 幀還在事件迴圈裡同步寫一張 JPEG。
+# 這裡每個 VideoFrame 只建立一次，資料就是它自己的 bytearray；np.frombuffer 取得可寫的視圖，
+# cv2.cvtColor(..., dst=視圖) 直接把 BGR 轉進去。capture_frame() 是同步的（LiveKit 當場複製到原生緩衝區），
+# 送出後就能重用同一個 VideoFrame。
+# I420 是 WebRTC 編碼器的原生格式，capture_frame() 不用再轉；RGBA 會由 LiveKit（libyuv）再轉成 I420。
+# 實測 640x480 每幀（含 capture_frame()）：舊路徑 1.17 ms、RGBA 0.41 ms、I420 0.52 ms；
+# OpenCV 的 BGR->I420 比 BGR->RGBA + libyuv 慢，所以 live.py 預設用 RGBA。
+# 除錯用的 JPEG 改由 SnapshotWriter 在背景執行緒寫，最多每 interval 秒一張，上一張還沒寫完就略過。
+#
+#   python livekit_frames.py --width 640 --height 480      比較舊 / 新路徑每幀耗時
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+from livekit import rtc
+
+logger = logging.getLogger(__name__)
+
+_CONVERSIONS = {
+    'i420': (rtc.VideoBufferType.I420, cv2.COLOR_BGR2YUV_I420),
+    'rgba': (rtc.VideoBufferType.RGBA, cv2.COLOR_BGR2RGBA),
+}
+
+
+class VideoFramePool:
+    """
+    pool_size 個 VideoFrame 輪流使用；fill() 回傳的幀在之後第 pool_size 次 fill() 前內容不變。
+    輸入尺寸和 width x height 不同時先縮放（計入 resized）。
+    """
+
+    def __init__(self, width: int, height: int, buffer_type: str = 'rgba', pool_size: int = 2):
+        if buffer_type not in _CONVERSIONS:
+            raise ValueError(f"buffer_type must be one of {sorted(_CONVERSIONS)}, got {buffer_type!r}")
+        if buffer_type == 'i420' and (width % 2 or height % 2):
+            raise ValueError(f"I420 needs an even frame size, got {width}x{height}")
+        self.width = width
+        self.height = height
+        self.buffer_type = buffer_type
+        video_type, self._code = _CONVERSIONS[buffer_type]
+        shape = (height * 3 // 2, width) if buffer_type == 'i420' else (height, width, 4)
+        self._frames = []
+        self._views = []
+        for _ in range(pool_size):
+            frame = rtc.VideoFrame(width, height, video_type, bytearray(int(np.prod(shape))))
+            self._frames.append(frame)
+            self._views.append(np.frombuffer(frame.data, dtype=np.uint8).reshape(shape))
+        self._scaled = np.empty((height, width, 3), dtype=np.uint8)
+        self._next = 0
+        self.filled = 0
+        self.resized = 0
+        self.convert_seconds = 0.0
+        self.max_convert = 0.0
+
+    def fill(self, frame) -> rtc.VideoFrame:
+        """把一幀 BGR 轉進下一個 VideoFrame 並回傳它"""
+        start = time.perf_counter()
+        if frame.shape[:2] != (self.height, self.width):
+            frame = cv2.resize(frame, (self.width, self.height), dst=self._scaled)
+            self.resized += 1
+        index = self._next
+        self._next = (index + 1) % len(self._frames)
+        cv2.cvtColor(frame, self._code, dst=self._views[index])
+        elapsed = time.perf_counter() - start
+        self.filled += 1
+        self.convert_seconds += elapsed
+        self.max_convert = max(self.max_convert, elapsed)
+        return self._frames[index]
+
+    def stats(self):
+        return {
+            'bufferType': self.buffer_type,
+            'filled': self.filled,
+            'resized': self.resized,
+            'convertMs': {
+                'mean': round(self.convert_seconds / self.filled * 1000, 2) if self.filled else None,
+                'max': round(self.max_convert * 1000, 2),
+            },
+        }
+
+
+class SnapshotWriter:
+    """
+    offer(frame, index) 由推流迴圈呼叫：距上一張不到 interval 秒、或背景執行緒還在寫上一張時直接略過（不複製）；
+    否則複製一份，由背景執行緒寫成 pattern.format(index)。
+    """
+
+    def __init__(self, pattern: str = "frame_{}.jpg", interval: float = 1.0, quality: int = 90):
+        self.pattern = pattern
+        self.interval = interval
+        self.quality = quality
+        self._buffer = None
+        self._index = None
+        self._pending = False
+        self._last = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self.written = 0
+        self.skipped = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+        self._thread.start()
+
+    def offer(self, frame, index: int) -> bool:
+        now = time.monotonic()
+        if self._last is not None and now - self._last < self.interval:
+            return False
+        with self._cond:
+            if self._closed:
+                return False
+            if self._pending:
+                self.skipped += 1
+                return False
+            if self._buffer is None or self._buffer.shape != frame.shape:
+                self._buffer = np.empty_like(frame)
+            np.copyto(self._buffer, frame)
+            self._index = index
+            self._pending = True
+            self._last = now
+            self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                index = self._index
+            path = self.pattern.format(index)
+            # 寫檔期間 _pending 維持 True，offer() 不會動到 _buffer
+            if cv2.imwrite(path, self._buffer, [cv2.IMWRITE_JPEG_QUALITY, self.quality]):
+                self.written += 1
+            else:
+                self.errors += 1
+                logger.warning(f"Writing snapshot {path} failed")
+            with self._cond:
+                self._pending = False
+
+    def close(self, timeout: float = 2.0):
+        """寫完正在處理的那一張後結束"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {'written': self.written, 'skipped': self.skipped, 'errors': self.errors}
+
+
+def _benchmark(width=640, height=480, iterations=300):
+    """比較 live.py 舊路徑（BGR->RGB、RGB->BGR 給 imshow、tobytes()、每 10 幀同步寫 JPEG）與預先配置的 I420 / RGBA"""
+    import os
+    import tempfile
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    source = rtc.VideoSource(width, height)
+    tmpdir = tempfile.mkdtemp()
+    counter = [0]
+
+    def timed(fn):
+        fn()
+        start = time.perf_counter()
+        cpu = time.process_time()
+        for _ in range(iterations):
+            fn()
+        return ((time.perf_counter() - start) / iterations * 1000,
+                (time.process_time() - cpu) / iterations * 1000)
+
+    def old_path():
+        processed = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        cv2.cvtColor(processed, cv2.COLOR_RGB2BGR)  # imshow 用
+        if counter[0] % 10 == 0:
+            cv2.imwrite(os.path.join(tmpdir, "old.jpg"), cv2.cvtColor(processed, cv2.COLOR_RGB2BGR))
+        counter[0] += 1
+        video_frame = rtc.VideoFrame(width, height, rtc.VideoBufferType.RGB24, processed.tobytes())
+        source.capture_frame(video_frame)
+
+    def pooled_path(pool, snapshots=None):
+        def run():
+            if snapshots is not None:
+                snapshots.offer(frame, counter[0])
+            counter[0] += 1
+            source.capture_frame(pool.fill(frame))
+        return run
+
+    print(f"{width}x{height}, {iterations} frames (wall / process CPU per frame, capture_frame() included)")
+    old_ms, old_cpu = timed(old_path)
+    print(f"{'RGB24 + tobytes() (old)':<30}{old_ms:8.3f} ms {old_cpu:8.3f} ms")
+    for buffer_type in ('rgba', 'i420'):
+        pool = VideoFramePool(width, height, buffer_type)
+        ms, cpu = timed(pooled_path(pool))
+        print(f"{'pooled ' + buffer_type:<30}{ms:8.3f} ms {cpu:8.3f} ms  ({old_ms / ms:.1f}x)  {pool.stats()['convertMs']}")
+    snapshots = SnapshotWriter(os.path.join(tmpdir, "new_{}.jpg"), interval=1.0)
+    ms, cpu = timed(pooled_path(VideoFramePool(width, height), snapshots))
+    snapshots.close()
+    print(f"{'pooled rgba + snapshots 1/s':<30}{ms:8.3f} ms {cpu:8.3f} ms  ({old_ms / ms:.1f}x)  {snapshots.stats()}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark LiveKit frame publishing paths")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--iterations", type=int, default=300)
+    args = parser.parse_args()
+    _benchmark(args.width, args.height, args.iterations)
@@ -0,0 +1,253 @@
+# metrics.py - 各階段延遲的滾動直方圖、定期 p50/p95/p99 摘要與本機 HTTP metrics 端點
+import bisect
+import http.server
+import json
+import logging
+import threading
+import time
+
+# 直方圖邊界（秒）：0.1 ms ~ 10 s，每個數量級 10 格（對數等分）
+BUCKET_BOUNDS = tuple(10 ** (exp / 10) for exp in range(-40, 11))
+
+
+class RollingHistogram:
+    """
+    固定邊界的延遲直方圖，只保留最近 window 秒的資料。
+    以 slices 個時間片輪替，observe() 只做一次 bisect 與累加。
+    另外保留啟動以來的累計計數（total_buckets / total_count / total_sum），給 Prometheus 的 histogram 使用。
+    """
+
+    def __init__(self, window: float = 60.0, slices: int = 6, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.slice_seconds = window / slices
+        self._slices = [[0] * (len(bounds) + 1) for _ in range(slices)]
+        self._sums = [0.0] * slices
+        self._epochs = [None] * slices
+        self._lock = threading.Lock()
+        self.total_buckets = [0] * (len(bounds) + 1)
+        self.total_count = 0
+        self.total_sum = 0.0
+
+    def _slot(self, now):
+        epoch = int(now / self.slice_seconds)
+        index = epoch % len(self._slices)
+        if self._epochs[index] != epoch:
+            # 這個時間片已過期，清空後重新使用
+            self._slices[index] = [0] * (len(self.bounds) + 1)
+            self._sums[index] = 0.0
+            self._epochs[index] = epoch
+        return index
+
+    def observe(self, seconds: float, now: float = None):
+        now = time.monotonic() if now is None else now
+        bucket = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            index = self._slot(now)
+            self._slices[index][bucket] += 1
+            self._sums[index] += seconds
+            self.total_buckets[bucket] += 1
+            self.total_count += 1
+            self.total_sum += seconds
+
+    def snapshot(self, now: float = None):
+        """回傳視窗內的 (各格計數, 總和)"""
+        now = time.monotonic() if now is None else now
+        oldest = int(now / self.slice_seconds) - len(self._slices) + 1
+        counts = [0] * (len(self.bounds) + 1)
+        total = 0.0
+        with self._lock:
+            for index, epoch in enumerate(self._epochs):
+                if epoch is None or epoch < oldest:
+                    continue
+                for bucket, count in enumerate(self._slices[index]):
+                    counts[bucket] += count
+                total += self._sums[index]
+        return counts, total
+
+    def totals(self):
+        """回傳啟動以來的 (各格計數, 總和)，只會遞增"""
+        with self._lock:
+            return list(self.total_buckets), self.total_sum
+
+    def quantile(self, q: float, counts=None):
+        """在所在格內線性內插估計分位數（秒）；沒有資料時回傳 None"""
+        counts = self.snapshot()[0] if counts is None else counts
+        n = sum(counts)
+        if not n:
+            return None
+        rank = q * n
+        seen = 0
+        for bucket, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if bucket >= len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[bucket - 1] if bucket else 0.0
+                return lower + (self.bounds[bucket] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def summary(self):
+        counts, total = self.snapshot()
+        n = sum(counts)
+        if not n:
+            return {'count': 0}
+        return {
+            'count': n,
+            'meanMs': round(total / n * 1000, 2),
+            'p50Ms': round(self.quantile(0.50, counts) * 1000, 2),
+            'p95Ms': round(self.quantile(0.95, counts) * 1000, 2),
+            'p99Ms': round(self.quantile(0.99, counts) * 1000, 2),
+        }
+
+
+class _StageTimer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class StageMetrics:
+    """
+    依階段名稱收集延遲（receive / convert / infer / postprocess / serialize / publish / pipeline / e2e）。
+    可同時從事件迴圈與推理執行緒呼叫。
+    """
+
+    def __init__(self, name: str = 'yolo', window: float = 60.0):
+        self.name = name
+        self.window = window
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._reporter = None
+        self._stop = threading.Event()
+
+    def histogram(self, stage: str) -> RollingHistogram:
+        hist = self._histograms.get(stage)
+        if hist is None:
+            with self._lock:
+                hist = self._histograms.setdefault(stage, RollingHistogram(self.window))
+        return hist
+
+    def observe(self, stage: str, seconds: float):
+        self.histogram(stage).observe(seconds)
+
+    def time(self, stage: str):
+        """with metrics.time('infer'): ... 量測區塊耗時"""
+        return _StageTimer(self, stage)
+
+    def observe_e2e(self, timestamp_us: int):
+        """
+        以幀的擷取時間戳計算端到端延遲。
+        時間戳必須是 wall clock（epoch 微秒）才有意義；不在 0 ~ window 秒內的視為不同時鐘而忽略。
+        """
+        if not timestamp_us:
+            return
+        latency = time.time() - timestamp_us / 1e6
+        if 0 <= latency <= self.window:
+            self.observe('e2e', latency)
+
+    def summary(self):
+        with self._lock:
+            stages = list(self._histograms.items())
+        return {stage: hist.summary() for stage, hist in stages}
+
+    def render_prometheus(self) -> str:
+        """
+        Prometheus text exposition 格式：histogram 為啟動以來的累計值（只會遞增，rate() / histogram_quantile() 才正確），
+        視窗內的 p50 / p95 / p99 另外以 gauge 輸出。
+        """
+        metric = f"{self.name}_stage_latency_seconds"
+        window_metric = f"{self.name}_stage_latency_window_seconds"
+        lines = [f"# HELP {metric} Per-stage latency since start",
+                 f"# TYPE {metric} histogram"]
+        with self._lock:
+            stages = sorted(self._histograms.items())
+        for stage, hist in stages:
+            counts, total = hist.totals()
+            cumulative = 0
+            for bound, count in zip(hist.bounds, counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound:.6g}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {cumulative}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {cumulative}')
+        lines += [f"# HELP {window_metric} Per-stage latency quantiles over the last {self.window:.0f}s",
+                  f"# TYPE {window_metric} gauge"]
+        for stage, hist in stages:
+            counts = hist.snapshot()[0]
+            for q in (0.5, 0.95, 0.99):
+                value = hist.quantile(q, counts)
+                if value is not None:
+                    lines.append(f'{window_metric}{{stage="{stage}",quantile="{q:g}"}} {value:.6f}')
+        return "\n".join(lines) + "\n"
+
+    def start_http_server(self, port: int, host: str = '127.0.0.1', extra=None):
+        """
+        在背景執行緒提供 /metrics（Prometheus）與 /metrics.json（摘要）。
+        extra 為回傳額外 JSON 欄位的函式（例如排程器統計）。
+        """
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.render_prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    payload = {'stages': metrics.summary()}
+                    if extra is not None:
+                        payload.update(extra())
+                    body, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            # 端點只是輔助功能，埠被占用時不影響 Bot 運作
+            logging.warning(f"Metrics endpoint disabled, cannot bind {host}:{port}: {e}")
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics-http', daemon=True).start()
+        logging.info(f"Metrics endpoint: http://{host}:{self._server.server_port}/metrics")
+
+    def start_reporter(self, interval: float = 30.0):
+        """定期把各階段 p50/p95/p99 寫進日誌；interval <= 0 表示不寫"""
+        if interval <= 0:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                parts = [f"{stage} p50={s['p50Ms']} p95={s['p95Ms']} p99={s['p99Ms']} ms (n={s['count']})"
+                         for stage, s in self.summary().items() if s['count']]
+                if parts:
+                    logging.info("Latency: " + "; ".join(parts))
+
+        self._reporter = threading.Thread(target=run, name='metrics-reporter', daemon=True)
+        self._reporter.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
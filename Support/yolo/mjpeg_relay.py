@@ -0,0 +1,356 @@
+# mjpeg_relay.py - ESP32-CAM 轉送伺服器：每台相機只開一條上游連線，原始 JPEG 不解碼、不重新編碼直接分送給多個 HTTP 用戶端
+#
+# 每個觀看端各自連 ESP32-CAM 時，板子大約三個用戶端就撐不住。這裡：
+#   1. 每台相機由 MJPEGSource 維持一條上游連線（斷線自動重連）
+#   2. 收到的 JPEG bytes 原封不動交給每個用戶端；每個用戶端只保留最新一張待送，
+#      網路慢的用戶端送不完時新的直接取代舊的（drop-to-latest），不影響其他用戶端
+#   3. 只有抽樣的幀（detect_fps）才在執行緒池解碼，給推理執行緒跑 YOLO；
+#      偵測結果（與 bots 相同的 JSON 陣列：label / confidence / box / id）另外以 /detections、SSE /events 發布
+# 端點（{name} 為相機名稱，/stream 與 /capture 等同第一台相機，網址格式與 ESP32-CAM 相同，MJPEG 元件可直接使用）：
+#   GET /{name}/stream       multipart/x-mixed-replace 的 MJPEG
+#   GET /{name}/capture      最新一張 JPEG
+#   GET /{name}/detections   最新的偵測結果（JSON）
+#   GET /{name}/events       偵測結果的 Server-Sent Events
+#   GET /stats               上游 / 各用戶端 / 推理統計
+#
+#   python mjpeg_relay.py arm=http://172.30.71.19/stream --port 8080 --model models/best.pt --detect-fps 2
+#   python mjpeg_relay.py --selftest          本機模擬相機 + 快 / 慢用戶端，不需要模型
+import asyncio
+import json
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from detection_codec import DetectionSerializer
+from mjpeg_source import MJPEGSource, serve_jpegs, synthetic_jpegs
+
+logger = logging.getLogger("mjpeg-relay")
+
+BOUNDARY = "123456789000000000000987654321"  # 與 ESP32-CAM 相同
+SEND_TIMEOUT = 10.0        # 用戶端這麼久沒收完一筆資料就斷線
+WRITE_BUFFER_HIGH = 65536  # 傳輸層緩衝超過這個量才等待（約一張 JPEG），其餘交給 drop-to-latest
+SOCKET_SEND_BUFFER = 131072  # 核心送出緩衝也設小，慢的用戶端才會及早丟幀，而不是在緩衝裡積好幾秒的畫面
+STATS_LOG_INTERVAL = 30
+
+_CORS = "Access-Control-Allow-Origin: *\r\nCache-Control: no-cache\r\n"
+
+
+def _response_head(status: str, content_type: str, length: int = None) -> bytes:
+    head = f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n{_CORS}Connection: close\r\n"
+    if length is not None:
+        head += f"Content-Length: {length}\r\n"
+    return (head + "\r\n").encode('latin-1')
+
+
+def _jpeg_part(item) -> bytes:
+    jpeg, captured_at = item
+    head = (f"\r\n--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n"
+            f"X-Timestamp: {time.time() - (time.monotonic() - captured_at):.6f}\r\n\r\n")
+    return head.encode('latin-1') + jpeg
+
+
+def _sse_event(payload: bytes) -> bytes:
+    return b'data: ' + payload + b'\n\n'
+
+
+class _Client:
+    """一個串流用戶端：只保留最新一筆待送資料，前一筆還沒送出就被取代的計入 dropped"""
+
+    def __init__(self, writer, kind: str):
+        self.writer = writer
+        self.kind = kind
+        self.peer = writer.get_extra_info('peername')
+        self.connected_at = time.monotonic()
+        self._pending = None
+        self._event = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+
+    def offer(self, item):
+        if self._pending is not None:
+            self.dropped += 1
+        self._pending = item
+        self._event.set()
+
+    async def pump(self, encode):
+        """送出最新的資料直到用戶端斷線或 SEND_TIMEOUT 秒送不出去"""
+        self.writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        sock = self.writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SEND_BUFFER)
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            item, self._pending = self._pending, None
+            self.writer.write(encode(item))
+            await asyncio.wait_for(self.writer.drain(), SEND_TIMEOUT)
+            self.sent += 1
+
+    def stats(self):
+        return {'peer': f"{self.peer[0]}:{self.peer[1]}" if self.peer else None, 'kind': self.kind,
+                'seconds': round(time.monotonic() - self.connected_at), 'sent': self.sent, 'dropped': self.dropped}
+
+
+class RelayCamera:
+    """一台相機：上游連線、最新一張 JPEG、用戶端集合與最新的偵測結果"""
+
+    def __init__(self, name: str, url: str, executor, decode_fps: float, scale: int, on_frame, names=None):
+        self.name = name
+        self.source = MJPEGSource(url, name=name, scale=scale, executor=executor, on_jpeg=self._on_jpeg,
+                                  on_frame=on_frame, decode_fps=decode_fps)
+        self.serializer = DetectionSerializer(names, 'json', 'full') if names is not None else None
+        self.latest = None          # (jpeg, captured_at)
+        self.detections = b'[]'
+        self.detection_count = 0
+        self.clients = set()
+        self.subscribers = set()
+
+    def _on_jpeg(self, jpeg, captured_at):
+        self.latest = (jpeg, captured_at)
+        for client in self.clients:
+            client.offer(self.latest)
+
+    def publish_detections(self, payload: bytes):
+        """在事件迴圈中呼叫"""
+        self.detections = payload
+        self.detection_count += 1
+        for subscriber in self.subscribers:
+            subscriber.offer(payload)
+
+    def stats(self):
+        return {
+            'upstream': self.source.stats(),
+            'detections': self.detection_count,
+            'clients': [client.stats() for client in self.clients | self.subscribers],
+        }
+
+
+class MJPEGRelay:
+    """
+    cameras：{name: url}。engine：engine.create_engine() 建立的偵測引擎（None 時只轉送，不解碼）。
+    detect_fps：每台相機每秒最多解碼 / 推理幾張；scale：推理用的縮小解碼倍率（1 / 2 / 4 / 8）。
+    """
+
+    def __init__(self, cameras, engine=None, detect_fps: float = 2.0, scale: int = 1, decode_workers: int = 2):
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(decode_workers, thread_name_prefix='jpeg-decode')
+        self._frame_ready = threading.Event()
+        on_frame = (lambda frame, captured_at: self._frame_ready.set()) if engine is not None else None
+        self.cameras = {
+            name: RelayCamera(name, url, self.executor, detect_fps if engine is not None else 0, scale, on_frame,
+                              engine.names if engine is not None else None)
+            for name, url in cameras.items()
+        }
+        self.default_camera = next(iter(self.cameras))
+        self._loop = None
+        self._stop = threading.Event()
+        self._started = None
+        self.inferences = 0
+        self.infer_seconds = 0.0
+
+    async def serve(self, host: str = '0.0.0.0', port: int = 8080):
+        """執行到被取消（Ctrl+C）為止"""
+        self._loop = asyncio.get_running_loop()
+        self._started = time.monotonic()
+        tasks = [asyncio.create_task(camera.source.run()) for camera in self.cameras.values()]
+        detector = None
+        if self.engine is not None:
+            detector = threading.Thread(target=self._detect_loop, name='relay-detect', daemon=True)
+            detector.start()
+        server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Relaying {list(self.cameras)} at http://{host}:{port}/<name>/stream")
+        try:
+            async with server:
+                while True:
+                    await asyncio.sleep(STATS_LOG_INTERVAL)
+                    logger.info(f"Relay stats: {json.dumps(self.stats())}")
+        finally:
+            self._stop.set()
+            for camera in self.cameras.values():
+                camera.source.stop()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if detector is not None:
+                detector.join(2.0)
+            self.executor.shutdown(wait=False)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), SEND_TIMEOUT)
+            method, path, *_ = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ')
+            if method != 'GET':
+                writer.write(_response_head("405 Method Not Allowed", "text/plain", 0))
+                return
+            await self._route(path.split('?', 1)[0], writer)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass  # 用戶端斷線或送不出去
+        except asyncio.CancelledError:
+            pass  # 伺服器關閉
+        finally:
+            writer.close()
+
+    async def _route(self, path, writer):
+        if path == '/stats':
+            body = json.dumps(self.stats()).encode('utf-8')
+            writer.write(_response_head("200 OK", "application/json", len(body)) + body)
+            await writer.drain()
+            return
+        parts = path.strip('/').split('/')
+        name, endpoint = (self.default_camera, parts[0]) if len(parts) == 1 else parts[:2]
+        camera = self.cameras.get(name)
+        if camera is None or len(parts) > 2:
+            writer.write(_response_head("404 Not Found", "text/plain", 0))
+            return
+
+        if endpoint == 'stream':
+            writer.write(_response_head("200 OK", f"multipart/x-mixed-replace;boundary={BOUNDARY}"))
+            await self._pump(camera, camera.clients, _Client(writer, 'stream'), _jpeg_part, camera.latest)
+        elif endpoint == 'events':
+            writer.write(_response_head("200 OK", "text/event-stream"))
+            await self._pump(camera, camera.subscribers, _Client(writer, 'events'), _sse_event, camera.detections)
+        elif endpoint == 'capture' and camera.latest is not None:
+            jpeg = camera.latest[0]
+            writer.write(_response_head("200 OK", "image/jpeg", len(jpeg)) + jpeg)
+            await writer.drain()
+        elif endpoint == 'detections':
+            body = camera.detections
+            writer.write(_response_head("200 OK", "application/json", len(body)) + body)
+            await writer.drain()
+        else:
+            writer.write(_response_head("404 Not Found", "text/plain", 0))
+
+    @staticmethod
+    async def _pump(camera, clients, client, encode, initial):
+        clients.add(client)
+        logger.info(f"Client {client.peer} joined {camera.name}/{client.kind} ({len(clients)} connected)")
+        if initial is not None:
+            client.offer(initial)
+        try:
+            await client.pump(encode)
+        finally:
+            clients.discard(client)
+            logger.info(f"Client {client.peer} left {camera.name}/{client.kind}: {client.stats()}")
+
+    def _detect_loop(self):
+        """推理執行緒：把各相機新解碼的幀組成一個批次推理，結果交回事件迴圈發布"""
+        last_seq = {name: 0 for name in self.cameras}
+        while not self._stop.is_set():
+            if not self._frame_ready.wait(1.0):
+                continue
+            self._frame_ready.clear()
+            batch = []
+            for name, camera in self.cameras.items():
+                result = camera.source.wait_frame(last_seq[name], 0)
+                if result is not None:
+                    last_seq[name] = result[0]
+                    batch.append((camera, result))
+            if not batch:
+                continue
+            try:
+                start = time.monotonic()
+                results = self.engine.detect_images([frame for _, (_, frame, _) in batch])
+                self.infer_seconds += time.monotonic() - start
+                self.inferences += 1
+            except Exception as e:
+                logger.error(f"YOLO processing error: {e}")
+                continue
+            for (camera, (seq, _, captured_at)), rows in zip(batch, results):
+                detections = [{'label': self.engine.names[int(class_id)], 'confidence': confidence,
+                               'box': [x, y, width, height]}
+                              for x, y, width, height, confidence, class_id in rows.tolist()]
+                # bots 的時間戳為 wall clock 微秒
+                timestamp_us = int((time.time() - (time.monotonic() - captured_at)) * 1e6)
+                payload = camera.serializer.serialize(detections, seq, timestamp_us) or b'[]'
+                self._loop.call_soon_threadsafe(camera.publish_detections, payload)
+
+    def stats(self):
+        stats = {'cameras': {name: camera.stats() for name, camera in self.cameras.items()}}
+        if self.engine is not None:
+            elapsed = time.monotonic() - self._started if self._started else 0
+            stats['inferenceFps'] = round(self.inferences / elapsed, 2) if elapsed else None
+            stats['inferMs'] = round(self.infer_seconds / self.inferences * 1000, 1) if self.inferences else None
+        return stats
+
+
+def parse_cameras(specs):
+    """['arm=http://.../stream', 'http://...'] -> {'arm': ..., 'cam1': ...}"""
+    cameras = {}
+    for index, spec in enumerate(specs):
+        name, sep, url = spec.partition('=')
+        if not sep or name.startswith('http'):
+            name, url = f"cam{index}", spec
+        cameras[name] = url
+    return cameras
+
+
+async def _selftest(seconds=5.0, fps=30):
+    """模擬相機 + 轉送：一條上游連線分給兩個正常用戶端與一個很慢的用戶端"""
+    camera = await serve_jpegs(synthetic_jpegs(), port=0, fps=fps)
+    camera_url = f"http://127.0.0.1:{camera.sockets[0].getsockname()[1]}/stream"
+    relay = MJPEGRelay({'cam0': camera_url})
+    relay_task = asyncio.create_task(relay.serve('127.0.0.1', 8088))
+    await asyncio.sleep(0.5)
+
+    async def viewer(read_delay):
+        reader, writer = await asyncio.open_connection('127.0.0.1', 8088, limit=8192)
+        writer.write(b"GET /stream HTTP/1.1\r\nHost: relay\r\n\r\n")
+        total = 0
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                total += len(data)
+                if read_delay:
+                    await asyncio.sleep(read_delay)
+        except asyncio.CancelledError:
+            writer.close()
+        return total
+
+    viewers = [asyncio.create_task(viewer(delay)) for delay in (0, 0, 0.2)]
+    await asyncio.sleep(seconds)
+    print(json.dumps(relay.stats(), indent=1))
+    for task in viewers:
+        task.cancel()
+    print("bytes received:", await asyncio.gather(*viewers))
+    relay_task.cancel()
+    await asyncio.gather(relay_task, return_exceptions=True)
+    camera.close()
+
+
+def main():
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+    parser = argparse.ArgumentParser(description="Relay ESP32-CAM MJPEG streams to many clients with sampled YOLO")
+    parser.add_argument("cameras", nargs='*', help="[name=]http://<esp32>/stream (repeatable)")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--model", type=str, default="models/best.pt", help="YOLO model path ('' to relay only)")
+    parser.add_argument("--backend", type=str, default="torch", help="engine.py backend (torch / onnx / ...)")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--detect-fps", type=float, default=2.0, help="Frames per second per camera sent to YOLO")
+    parser.add_argument("--scale", type=int, default=1, choices=(1, 2, 4, 8),
+                        help="Decode frames for YOLO at 1/scale resolution")
+    parser.add_argument("--selftest", action="store_true", help="Local fake camera + fast / slow clients")
+    args = parser.parse_args()
+
+    if args.selftest:
+        asyncio.run(_selftest())
+        return
+    if not args.cameras:
+        parser.error("at least one camera URL is required")
+    engine = None
+    if args.model:
+        from engine import create_engine
+        engine = create_engine(args.model, backend=args.backend, device=args.device, imgsz=args.imgsz)
+    relay = MJPEGRelay(parse_cameras(args.cameras), engine, detect_fps=args.detect_fps, scale=args.scale)
+    try:
+        asyncio.run(relay.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        logger.info("Relay stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,526 @@
+# mjpeg_source.py - 以 asyncio 接收 ESP32-CAM 的 MJPEG（multipart/x-mixed-replace）串流，斷線自動重連，JPEG 在執行緒池解碼
+#
+# 原本 esp32test.py 用 cv2.VideoCapture(url)：FFmpeg 內部的緩衝深度不固定（畫面越積越舊）、斷線後不會重連，
+# 而且每幀都完整解碼。這裡：
+#   1. 每台相機一個協程，直接讀 HTTP（支援 ESP32 的 chunked 傳輸），自己切出每個 JPEG 部分
+#   2. 解碼交給共用的 ThreadPoolExecutor；上一張還沒解完又收到新的，只保留最新的一張（計入 dropped）
+#   3. scale=2/4/8 時用 IMREAD_REDUCED_COLOR_* 在 DCT 階段就縮小解碼（只給推理用的畫面不需要全解析度）
+#   4. 連線失敗或 read_timeout 秒沒有資料就重連，間隔從 reconnect_delay 倍增到 max_reconnect_delay
+# MJPEGCapture 提供和 cv2.VideoCapture 相同的 read() / isOpened() / release()，
+# 可直接給 FrameExchange.capture() 與 FanoutPipeline（camera 傳入 http:// 網址）使用。
+#
+#   python mjpeg_source.py http://172.30.71.19/stream --show              觀看並每 5 秒印出統計
+#   python mjpeg_source.py http://cam1/stream http://cam2/stream --scale 2 同時接收兩台、1/2 解析度解碼
+#   python mjpeg_source.py --serve ../yolotest/*.jpg --port 8081          本機模擬 ESP32-CAM（循環送出 JPEG）
+#   python mjpeg_source.py --selftest                                     本機伺服器 + 定期斷線，檢查重連與統計
+import asyncio
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAX_PART_BYTES = 4 * 1024 * 1024  # 單一 JPEG 部分的上限，超過視為串流錯誤
+_REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def decode_jpeg(data: bytes, scale: int = 1):
+    """JPEG -> BGR；scale 為 2 / 4 / 8 時直接解成 1/scale 尺寸。資料損壞時回傳 None"""
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), _REDUCED_FLAGS[scale])
+
+
+def _parse_headers(block: bytes):
+    headers = {}
+    for line in block.decode('latin-1').split('\r\n'):
+        key, sep, value = line.partition(':')
+        if sep:
+            headers[key.strip().lower()] = value.strip()
+    return headers
+
+
+class MultipartParser:
+    """
+    multipart/x-mixed-replace 的增量解析：feed(bytes) 回傳這次湊齊的各部分內容。
+    有 Content-Length 時直接依長度切，沒有時找下一個分隔線。
+    """
+
+    def __init__(self, boundary: str):
+        self.delimiter = b'--' + boundary.encode('latin-1')
+        self._buffer = bytearray()
+        self._state = 'boundary'
+        self._length = None
+
+    def feed(self, data: bytes):
+        self._buffer += data
+        parts = []
+        while True:
+            if self._state == 'boundary':
+                index = self._buffer.find(self.delimiter)
+                if index < 0:
+                    # 只保留可能是分隔線開頭的尾巴
+                    del self._buffer[:max(len(self._buffer) - len(self.delimiter), 0)]
+                    return parts
+                del self._buffer[:index + len(self.delimiter)]
+                self._state = 'headers'
+            elif self._state == 'headers':
+                # 分隔線所在行的剩餘部分（"\r\n"）+ 各標頭行 + 空行
+                index = self._buffer.find(b'\r\n\r\n')
+                if index < 0:
+                    if len(self._buffer) > 8192:
+                        raise ValueError("Multipart part headers too long")
+                    return parts
+                headers = _parse_headers(bytes(self._buffer[:index]))
+                del self._buffer[:index + 4]
+                length = headers.get('content-length')
+                self._length = int(length) if length else None
+                if self._length is not None and self._length > MAX_PART_BYTES:
+                    raise ValueError(f"Multipart part too large: {self._length} bytes")
+                self._state = 'body'
+            else:
+                if self._length is not None:
+                    if len(self._buffer) < self._length:
+                        return parts
+                    parts.append(bytes(self._buffer[:self._length]))
+                    del self._buffer[:self._length]
+                    self._state = 'boundary'
+                else:
+                    index = self._buffer.find(b'\r\n' + self.delimiter)
+                    if index < 0:
+                        if len(self._buffer) > MAX_PART_BYTES:
+                            raise ValueError("Multipart part too large (no Content-Length)")
+                        return parts
+                    parts.append(bytes(self._buffer[:index]))
+                    del self._buffer[:index + 2 + len(self.delimiter)]
+                    self._state = 'headers'
+
+
+class MJPEGSource:
+    """
+    一台 MJPEG 相機。在事件迴圈中 await run()（直到 stop()）；
+    其他執行緒用 wait_frame() 取最新的解碼結果，或傳入 on_frame(frame, captured_at)（在事件迴圈中呼叫）。
+    on_jpeg(jpeg, captured_at)：每個收到的 JPEG（解碼前，在事件迴圈中呼叫），轉送原始 bytes 用。
+    decode_fps：None 每張都解碼；> 0 最多每秒解碼這麼多張；0 不解碼（計入 notDecoded）。
+    """
+
+    def __init__(self, url: str, name: str = None, scale: int = 1, executor=None, on_frame=None, on_jpeg=None,
+                 decode_fps: float = None, reconnect_delay: float = 0.5, max_reconnect_delay: float = 10.0,
+                 read_timeout: float = 5.0):
+        if scale not in _REDUCED_FLAGS:
+            raise ValueError(f"scale must be one of {sorted(_REDUCED_FLAGS)}, got {scale}")
+        self.url = url
+        self.name = name or urllib.parse.urlsplit(url).netloc
+        self.scale = scale
+        self.executor = executor
+        self.on_frame = on_frame
+        self.on_jpeg = on_jpeg
+        self.decode_fps = decode_fps
+        self._last_decode = None
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.read_timeout = read_timeout
+        self._cond = threading.Condition()
+        self._frame = None
+        self._captured_at = None
+        self._seq = 0
+        self._next = None
+        self._decode_task = None
+        self._stopped = False
+        self._task = None
+        self.connected = False
+        self.connects = 0
+        self.failures = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.decoded = 0
+        self.dropped = 0
+        self.not_decoded = 0
+        self.decode_errors = 0
+        self.decode_seconds = 0.0
+        self.max_decode = 0.0
+        self._started = None
+
+    async def run(self):
+        self._task = asyncio.current_task()
+        self._started = time.monotonic()
+        delay = self.reconnect_delay
+        try:
+            while not self._stopped:
+                received = self.received
+                try:
+                    await self._stream()
+                    error = "stream ended"
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                    error = str(e) or type(e).__name__
+                finally:
+                    self.connected = False
+                if self._stopped:
+                    break
+                self.failures += 1
+                if self.received > received:
+                    delay = self.reconnect_delay  # 這次連線有收到畫面，退避重新計算
+                logger.warning(f"MJPEG {self.name}: {error}, reconnecting in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+
+    async def _stream(self):
+        url = urllib.parse.urlsplit(self.url)
+        path = (url.path or '/') + (f'?{url.query}' if url.query else '')
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(url.hostname, url.port or 80, limit=MAX_PART_BYTES), self.read_timeout)
+        try:
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {url.netloc}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+            await writer.drain()
+            status = await self._read(reader.readline())
+            if status.split(b' ', 2)[1:2] != [b'200']:
+                raise ConnectionError(f"HTTP status {status.decode('latin-1').strip()!r}")
+            headers = _parse_headers(await self._read(reader.readuntil(b'\r\n\r\n')))
+            content_type = headers.get('content-type', '')
+            _, _, boundary = content_type.partition('boundary=')
+            if not content_type.startswith('multipart/') or not boundary:
+                raise ValueError(f"Not an MJPEG stream: Content-Type {content_type!r}")
+            parser = MultipartParser(boundary.split(';')[0].strip('"'))
+            chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+            self.connected = True
+            self.connects += 1
+            logger.info(f"MJPEG {self.name} connected: {self.url} (boundary={parser.delimiter[2:].decode()})")
+            while not self._stopped:
+                data = await self._read(self._read_body(reader, chunked))
+                if not data:
+                    return
+                for part in parser.feed(data):
+                    self._submit(part, time.monotonic())
+        finally:
+            writer.close()
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self.read_timeout)
+
+    @staticmethod
+    async def _read_body(reader, chunked: bool) -> bytes:
+        if not chunked:
+            return await reader.read(65536)
+        size_line = await reader.readline()
+        if not size_line:
+            return b''
+        size = int(size_line.split(b';')[0], 16)
+        if size == 0:
+            return b''
+        data = await reader.readexactly(size)
+        await reader.readexactly(2)  # 區塊後的 \r\n
+        return data
+
+    def _submit(self, jpeg: bytes, captured_at: float):
+        self.received += 1
+        self.received_bytes += len(jpeg)
+        if self.on_jpeg is not None:
+            self.on_jpeg(jpeg, captured_at)
+        if self.decode_fps is not None:
+            # 抽樣解碼：離上一張解碼的幀不到 1 / decode_fps 秒就不解
+            if self.decode_fps <= 0 or (self._last_decode is not None and
+                                        captured_at - self._last_decode < 1.0 / self.decode_fps):
+                self.not_decoded += 1
+                return
+            self._last_decode = captured_at
+        if self._decode_task is not None:
+            # 還在解上一張：只保留最新的一張
+            if self._next is not None:
+                self.dropped += 1
+            self._next = (jpeg, captured_at)
+            return
+        self._decode_task = asyncio.get_running_loop().create_task(self._decode_loop(jpeg, captured_at))
+
+    async def _decode_loop(self, jpeg: bytes, captured_at: float):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                start = time.monotonic()
+                frame = await loop.run_in_executor(self.executor, decode_jpeg, jpeg, self.scale)
+                elapsed = time.monotonic() - start
+                if frame is None:
+                    self.decode_errors += 1
+                else:
+                    self.decoded += 1
+                    self.decode_seconds += elapsed
+                    self.max_decode = max(self.max_decode, elapsed)
+                    self._deliver(frame, captured_at)
+                if self._next is None:
+                    return
+                (jpeg, captured_at), self._next = self._next, None
+        finally:
+            self._decode_task = None
+
+    def _deliver(self, frame, captured_at: float):
+        with self._cond:
+            self._frame = frame
+            self._captured_at = captured_at
+            self._seq += 1
+            self._cond.notify_all()
+        if self.on_frame is not None:
+            try:
+                self.on_frame(frame, captured_at)
+            except Exception as e:
+                logger.error(f"MJPEG {self.name} on_frame failed: {e!r}")
+
+    def wait_frame(self, after_seq: int = 0, timeout: float = None):
+        """等到序號大於 after_seq 的幀，回傳 (seq, frame, captured_at)；逾時或已停止回傳 None。可從任何執行緒呼叫"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > after_seq or self._stopped, timeout):
+                return None
+            if self._seq <= after_seq:
+                return None
+            return self._seq, self._frame, self._captured_at
+
+    def stop(self):
+        """在事件迴圈中呼叫"""
+        self._stopped = True
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started if self._started else 0
+        return {
+            'url': self.url,
+            'connected': self.connected,
+            'connects': self.connects,
+            'failures': self.failures,
+            'received': self.received,
+            'decoded': self.decoded,
+            'dropped': self.dropped,
+            'notDecoded': self.not_decoded,
+            'decodeErrors': self.decode_errors,
+            'receivedFps': round(self.received / elapsed, 1) if elapsed else None,
+            'fps': round(self.decoded / elapsed, 1) if elapsed else None,
+            'kbps': round(self.received_bytes * 8 / elapsed / 1000) if elapsed else None,
+            'decodeMs': {
+                'mean': round(self.decode_seconds / self.decoded * 1000, 2) if self.decoded else None,
+                'max': round(self.max_decode * 1000, 2),
+            },
+        }
+
+
+class MJPEGHub:
+    """在背景執行緒的事件迴圈同時接收多台相機，共用一個解碼執行緒池"""
+
+    def __init__(self, urls, scale: int = 1, decode_workers: int = None, **source_kwargs):
+        if isinstance(urls, str):
+            urls = [urls]
+        workers = decode_workers or min(2 * len(urls), os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='jpeg-decode')
+        self.sources = [MJPEGSource(url, scale=scale, executor=self.executor, **source_kwargs) for url in urls]
+        self._loop = None
+        self._thread = None
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=asyncio.run, args=(self._main(ready),), name='mjpeg', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    async def _main(self, ready):
+        self._loop = asyncio.get_running_loop()
+        tasks = [asyncio.create_task(source.run()) for source in self.sources]
+        ready.set()
+        await asyncio.gather(*tasks)
+
+    def capture(self, index: int = 0, timeout: float = 5.0):
+        return MJPEGCapture(self.sources[index], timeout=timeout)
+
+    def stop(self, timeout: float = 2.0):
+        if self._loop is not None:
+            for source in self.sources:
+                try:
+                    self._loop.call_soon_threadsafe(source.stop)
+                except RuntimeError:
+                    pass  # 事件迴圈已結束
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {source.name: source.stats() for source in self.sources}
+
+
+class MJPEGCapture:
+    """
+    cv2.VideoCapture 相容介面：read() 等到比上一次更新的幀（最多 timeout 秒）。
+    傳入網址時自己開一個 MJPEGHub，release() 時一起停止。
+    """
+
+    def __init__(self, source, scale: int = 1, timeout: float = 5.0, **source_kwargs):
+        self._hub = None
+        if isinstance(source, str):
+            self._hub = MJPEGHub([source], scale=scale, **source_kwargs).start()
+            source = self._hub.sources[0]
+        self.source = source
+        self.timeout = timeout
+        self._seq = 0
+        self._released = False
+        self.captured_at = None  # 最近一次 read() 的幀收到 JPEG 的時間（time.monotonic()）
+
+    def isOpened(self) -> bool:
+        return not self._released
+
+    def read(self, image=None):
+        """回傳 (ok, frame)；image 尺寸相同時複製進去並回傳它（同 cv2.VideoCapture.read(image=...)）"""
+        if self._released:
+            return False, None
+        result = self.source.wait_frame(self._seq, self.timeout)
+        if result is None:
+            return False, None
+        self._seq, frame, self.captured_at = result
+        if image is not None and image.shape == frame.shape:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame
+
+    def set(self, prop_id, value) -> bool:
+        return False  # 解析度 / 幀率由相機端設定
+
+    def release(self):
+        self._released = True
+        if self._hub is not None:
+            self._hub.stop()
+
+    def stats(self):
+        return self.source.stats()
+
+
+async def serve_jpegs(jpegs, host: str = '127.0.0.1', port: int = 8081, fps: float = 15,
+                      chunked: bool = True, drop_after: int = None):
+    """
+    本機測試用：模擬 ESP32-CAM 的 /stream（chunked、每個部分帶 Content-Length），循環送出 jpegs（bytes 列表）。
+    drop_after：每個連線送出幾張後主動斷線（測試重連）。回傳 asyncio.Server。
+    """
+    boundary = "123456789000000000000987654321"
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            head = f"HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace;boundary={boundary}\r\n"
+            head += "Transfer-Encoding: chunked\r\n\r\n" if chunked else "\r\n"
+            writer.write(head.encode('latin-1'))
+            start = time.monotonic()
+            n = 0
+            while drop_after is None or n < drop_after:
+                jpeg = jpegs[n % len(jpegs)]
+                pieces = [f"\r\n--{boundary}\r\n".encode('latin-1'),
+                          f"Content-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n".encode('latin-1'),
+                          jpeg]
+                for piece in pieces:
+                    writer.write(b'%x\r\n%s\r\n' % (len(piece), piece) if chunked else piece)
+                await writer.drain()
+                n += 1
+                await asyncio.sleep(max(start + n / fps - time.monotonic(), 0))
+        except (OSError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # 用戶端斷線或伺服器關閉
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def synthetic_jpegs(count=30, width=640, height=480):
+    frames = []
+    for i in range(count):
+        frame = np.full((height, width, 3), 32, dtype=np.uint8)
+        x = (i * 16) % (width - 80)
+        frame[height // 2 - 40:height // 2 + 40, x:x + 80] = (0, 200, 255)
+        frames.append(cv2.imencode('.jpg', frame)[1].tobytes())
+    return frames
+
+
+async def _selftest(seconds=6.0, fps=30):
+    """兩個伺服器（chunked / 非 chunked，每 50 張斷線一次）各接一個 1/1 與 1/2 解碼的來源"""
+    jpegs = synthetic_jpegs()
+    servers = [await serve_jpegs(jpegs, port=0, fps=fps, chunked=chunked, drop_after=50) for chunked in (True, False)]
+    executor = ThreadPoolExecutor(2, thread_name_prefix='jpeg-decode')
+    sources = []
+    for server, scale in zip(servers, (1, 2)):
+        port = server.sockets[0].getsockname()[1]
+        sources.append(MJPEGSource(f"http://127.0.0.1:{port}/stream", scale=scale, executor=executor,
+                                   reconnect_delay=0.1))
+    tasks = [asyncio.create_task(source.run()) for source in sources]
+    await asyncio.sleep(seconds)
+    for source in sources:
+        source.stop()
+    await asyncio.gather(*tasks)
+    for server in servers:
+        server.close()
+    executor.shutdown()
+    for source in sources:
+        shape = source.wait_frame(0, 0)[1].shape
+        print(f"scale=1/{source.scale} frame={shape} {source.stats()}")
+
+
+def main():
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+    parser = argparse.ArgumentParser(description="Receive ESP32-CAM MJPEG streams (or serve JPEGs as one)")
+    parser.add_argument("urls", nargs='*', help="http://<esp32>/stream URLs (or JPEG files with --serve)")
+    parser.add_argument("--scale", type=int, default=1, choices=sorted(_REDUCED_FLAGS),
+                        help="Decode at 1/scale resolution")
+    parser.add_argument("--show", action="store_true", help="Show the first stream in a window")
+    parser.add_argument("--serve", action="store_true", help="Serve the given JPEG files as an MJPEG stream")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--fps", type=float, default=15)
+    parser.add_argument("--selftest", action="store_true", help="Local server + reconnect test")
+    args = parser.parse_args()
+
+    if args.selftest:
+        asyncio.run(_selftest())
+        return
+    if args.serve:
+        jpegs = [open(path, 'rb').read() for path in args.urls] or synthetic_jpegs()
+
+        async def serve():
+            server = await serve_jpegs(jpegs, '0.0.0.0', args.port, args.fps)
+            logger.info(f"Serving {len(jpegs)} JPEGs at http://127.0.0.1:{args.port}/stream")
+            await server.serve_forever()
+        asyncio.run(serve())
+        return
+    if not args.urls:
+        parser.error("at least one URL is required")
+
+    hub = MJPEGHub(args.urls, scale=args.scale).start()
+    cap = hub.capture(0)
+    last_stats = time.monotonic()
+    try:
+        while True:
+            if args.show:
+                ok, frame = cap.read()
+                if ok:
+                    cv2.imshow("ESP32-CAM Stream", frame)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+            else:
+                time.sleep(0.5)
+            if time.monotonic() - last_stats >= 5:
+                logger.info(f"MJPEG stats: {hub.stats()}")
+                last_stats = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hub.stop()
+        cv2.destroyAllWindows()
+
+
+if __name__ == "__main__":
+    main()
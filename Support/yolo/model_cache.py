@@ -0,0 +1,80 @@
+# model_cache.py - 以記憶體預算限制的 LRU 模型快取
+import collections
+import logging
+import threading
+
+
+class ModelCache:
+    """
+    保留最近使用過的模型，切回來時不必重新從磁碟載入。
+    總大小超過 budget_bytes 時從最久沒用的開始淘汰；
+    剛放入的模型與 put(pinned=...) 指定的模型不會被淘汰（即使因此超過預算）。
+    on_evict(model) 在淘汰時呼叫（例如關閉多行程引擎的工作行程）。
+    """
+
+    def __init__(self, budget_bytes: int, on_evict=None):
+        self.budget_bytes = budget_bytes
+        self.on_evict = on_evict
+        self._entries = collections.OrderedDict()  # name -> (model, size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(name)
+            return entry[0]
+
+    def put(self, name: str, model, size: int, pinned=()):
+        """pinned：不可淘汰的模型名稱（例如推理中仍在使用的模型，淘汰時 on_evict 會把它關掉）"""
+        evicted_models = []
+        with self._lock:
+            self._entries[name] = (model, size)
+            self._entries.move_to_end(name)
+            while self.total_bytes > self.budget_bytes:
+                evicted = next((key for key in self._entries if key != name and key not in pinned), None)
+                if evicted is None:
+                    break
+                evicted_model, evicted_size = self._entries.pop(evicted)
+                evicted_models.append(evicted_model)
+                logging.info(f"Evicted model from cache: {evicted} ({evicted_size / 1e6:.1f} MB)")
+        if self.on_evict is not None:
+            for evicted_model in evicted_models:
+                self.on_evict(evicted_model)
+
+    def clear(self):
+        """清空快取（關閉時使用），每個模型都會經過 on_evict"""
+        with self._lock:
+            models = [model for model, _ in self._entries.values()]
+            self._entries.clear()
+        if self.on_evict is not None:
+            for model in models:
+                self.on_evict(model)
+
+    def __contains__(self, name: str):
+        with self._lock:
+            return name in self._entries
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(size for _, size in self._entries.values())
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'models': list(self._entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hit_rate, 3),
+            }
@@ -0,0 +1,126 @@
+# motion_gate.py - 固定攝影機的變化偵測：畫面沒變就跳過推理，沿用上一次的偵測結果
+import time
+
+import cv2
+import numpy as np
+
+
+def parse_mask(spec: str):
+    """
+    解析 'x,y,w,h;x,y,w,h' 形式的正規化矩形列表（只看這些區域的變化）。
+    空字串回傳 None（整個畫面）。
+    """
+    if not spec or not spec.strip():
+        return None
+    regions = []
+    for part in spec.split(';'):
+        if not part.strip():
+            continue
+        values = [float(v) for v in part.split(',')]
+        if len(values) != 4:
+            raise ValueError(f"Invalid mask region '{part}', expected x,y,w,h")
+        regions.append(values)
+    return regions or None
+
+
+class MotionGate:
+    """
+    在縮小的灰階畫面上與「上次推理時的畫面」做差分。
+    超過 pixel_threshold 的像素比例大於 threshold 才視為有變化；
+    距離上次推理超過 max_staleness 秒時強制推理一次。
+    """
+
+    def __init__(self, threshold: float = 0.005, pixel_threshold: int = 12, width: int = 64,
+                 mask=None, max_staleness: float = 2.0, smoothing: float = 0.2):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.width = width
+        self.regions = mask
+        self.max_staleness = max_staleness
+        self.smoothing = smoothing
+        self.checked = 0
+        self.skipped = 0
+        self.last_change = 0.0
+        self.inference_seconds = None  # 每幀推理耗時（EMA）
+        self.saved_seconds = 0.0
+        self._reference = None
+        self._small = None
+        self._diff = None
+        self._mask = None
+        self._mask_pixels = 0
+        self._last_inference = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def _buffers(self, gray):
+        """依輸入大小配置縮圖與遮罩（大小改變時才重新配置）"""
+        height, width = gray.shape[:2]
+        small_h = max(1, round(height * self.width / width))
+        if self._small is not None and self._small.shape == (small_h, self.width):
+            return
+        self._small = np.empty((small_h, self.width), dtype=np.uint8)
+        self._diff = np.empty_like(self._small)
+        self._reference = None
+        self._mask = None
+        if self.regions:
+            self._mask = np.zeros_like(self._small, dtype=bool)
+            for x, y, w, h in self.regions:
+                x1, y1 = int(x * self.width), int(y * small_h)
+                x2, y2 = int(np.ceil((x + w) * self.width)), int(np.ceil((y + h) * small_h))
+                self._mask[y1:y2, x1:x2] = True
+        self._mask_pixels = int(self._mask.sum()) if self._mask is not None else self._small.size
+
+    def should_infer(self, gray, now: float = None) -> bool:
+        """
+        gray 為灰階（或 I420 的 Y 平面）。
+        回傳 True 表示需要推理；False 表示畫面沒變，可沿用上一次的結果。
+        """
+        now = time.monotonic() if now is None else now
+        if not self.enabled:
+            return True
+        self.checked += 1
+        self._buffers(gray)
+        cv2.resize(gray, self._small.shape[::-1], dst=self._small, interpolation=cv2.INTER_AREA)
+
+        stale = self._last_inference is None or now - self._last_inference >= self.max_staleness
+        if self._reference is not None and not stale:
+            cv2.absdiff(self._small, self._reference, dst=self._diff)
+            changed = self._diff > self.pixel_threshold
+            if self._mask is not None:
+                changed &= self._mask
+            self.last_change = int(np.count_nonzero(changed)) / self._mask_pixels if self._mask_pixels else 0.0
+            if self.last_change <= self.threshold:
+                self.skipped += 1
+                if self.inference_seconds is not None:
+                    self.saved_seconds += self.inference_seconds
+                return False
+
+        # 要推理：這一幀成為之後比較的基準
+        if self._reference is None:
+            self._reference = self._small.copy()
+        else:
+            self._reference[...] = self._small
+        self._last_inference = now
+        return True
+
+    def record_inference(self, seconds: float):
+        """回報實際推理一幀的耗時，用來估計跳過推理省下的時間"""
+        if self.inference_seconds is None:
+            self.inference_seconds = seconds
+        else:
+            self.inference_seconds += self.smoothing * (seconds - self.inference_seconds)
+
+    @property
+    def skip_ratio(self) -> float:
+        return self.skipped / self.checked if self.checked else 0.0
+
+    def stats(self):
+        return {
+            'checked': self.checked,
+            'skipped': self.skipped,
+            'skipRatio': round(self.skip_ratio, 3),
+            'lastChange': round(self.last_change, 4),
+            'savedMs': round(self.saved_seconds * 1000, 1),
+        }
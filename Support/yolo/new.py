@@ -1,22 +1,21 @@
 #!/usr/bin/env python3
 import os
-import cv2
 import uuid
 import asyncio
 import argparse
-import time
 import json
-import numpy as np
 from dotenv import load_dotenv
-from ultralytics import YOLO
 from getstream import Stream
 from getstream.models import UserRequest, CallRequest, MemberRequest
-from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
-from aiortc.contrib.media import MediaBlackhole, MediaRecorder
-from av import VideoFrame
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaBlackhole, MediaRecorder, MediaRelay
 import aiohttp
 import logging
 
+from fanout import FanoutPipeline
+from preview import Preview
+from webrtc_track import PipelineVideoTrack
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("YOLOStream")
@@ -34,121 +33,6 @@ if not all([STREAM_API_KEY, STREAM_API_SECRET, YOLO_MODEL_PATH]):
     logger.error("缺少必要的环境变量。请确保创建了.env文件，包含STREAM_API_KEY和STREAM_API_SECRET。")
     exit(1)
 
-class YOLOVideoStreamTrack(VideoStreamTrack):
-    """
-    YOLO视频流轨道类
-    使用YOLO模型处理视频帧并创建WebRTC视频轨道
-    """
-    def __init__(self, camera_index=0, model_path=YOLO_MODEL_PATH, width=1280, height=720, fps=15):
-        super().__init__()
-        self.camera_index = camera_index
-        self.width = width
-        self.height = height
-        self.fps = fps
-        self.frame_interval = 1 / fps
-        self.last_frame_time = 0
-        
-        # 加载YOLO模型
-        logger.info(f"正在加载YOLO模型: {model_path}")
-        try:
-            self.model = YOLO(model_path)
-            logger.info("YOLO模型加载成功")
-        except Exception as e:
-            logger.error(f"加载YOLO模型失败: {e}")
-            raise e
-        
-        # 初始化摄像头
-        self.cap = cv2.VideoCapture(camera_index)
-        if not self.cap.isOpened():
-            logger.error(f"无法打开摄像头 #{camera_index}")
-            raise RuntimeError(f"无法打开摄像头 #{camera_index}")
-            
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-        self.cap.set(cv2.CAP_PROP_FPS, fps)
-        
-        # 获取实际的摄像头配置
-        actual_width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        actual_height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        actual_fps = int(self.cap.get(cv2.CAP_PROP_FPS))
-        
-        logger.info(f"摄像头初始化: 请求={width}x{height}@{fps}fps, 实际={actual_width}x{actual_height}@{actual_fps}fps")
-        
-        # 创建黑色背景帧作为备用
-        self.black_frame = np.zeros((height, width, 3), np.uint8)
-        
-        # 计数和性能统计
-        self.frame_count = 0
-        self.start_time = time.time()
-        
-    async def recv(self):
-        """获取下一帧视频"""
-        # 获取时间戳
-        pts, time_base = await self.next_timestamp()
-        
-        current_time = time.time()
-        elapsed = current_time - self.last_frame_time
-        
-        # 控制帧率
-        if elapsed < self.frame_interval:
-            await asyncio.sleep(self.frame_interval - elapsed)
-        
-        # 读取摄像头
-        ret, frame = self.cap.read()
-        if not ret:
-            logger.warning("无法从摄像头读取帧，使用黑色帧")
-            processed_frame = self.black_frame.copy()
-        else:
-            try:
-                # 使用YOLO处理帧
-                results = self.model(frame)
-                processed_frame = results[0].plot()
-                
-                # 计算并显示FPS
-                self.frame_count += 1
-                if self.frame_count % 30 == 0:
-                    elapsed_total = time.time() - self.start_time
-                    fps = self.frame_count / elapsed_total
-                    logger.info(f"已处理 {self.frame_count} 帧, 平均FPS: {fps:.2f}")
-                    
-                    # 在画面添加FPS信息
-                    cv2.putText(
-                        processed_frame, 
-                        f"FPS: {fps:.2f}", 
-                        (10, 30), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 
-                        1, 
-                        (0, 255, 0), 
-                        2
-                    )
-            except Exception as e:
-                logger.error(f"YOLO处理失败: {e}")
-                processed_frame = frame  # 使用原始帧
-        
-        # 本地预览
-        cv2.imshow("YOLO WebRTC Stream", processed_frame)
-        cv2.waitKey(1)
-        
-        # 更新最后帧时间
-        self.last_frame_time = time.time()
-        
-        # 转换为RGB格式以供WebRTC使用
-        frame_rgb = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2RGB)
-        
-        # 创建视频帧
-        video_frame = VideoFrame.from_ndarray(frame_rgb, format="rgb24")
-        video_frame.pts = pts
-        video_frame.time_base = time_base
-        
-        return video_frame
-    
-    def stop(self):
-        """停止视频流"""
-        if self.cap and self.cap.isOpened():
-            self.cap.release()
-        cv2.destroyAllWindows()
-        logger.info("视频流已停止")
-
 class StreamYOLO:
     """
     Stream YOLO主类
@@ -156,7 +40,10 @@ class StreamYOLO:
     """
     def __init__(self):
         self.client = Stream(api_key=STREAM_API_KEY, api_secret=STREAM_API_SECRET)
+        self.pipeline = None
         self.video_track = None
+        self.relay = MediaRelay()
+        self.preview = None
         self.pc = None
         self.call = None
         self.call_id = None
@@ -230,17 +117,20 @@ class StreamYOLO:
     async def start_streaming(self, camera_index=0, width=1280, height=720, fps=15):
         """开始视频流"""
         try:
-            # 创建YOLO视频轨道
-            self.video_track = YOLOVideoStreamTrack(
-                camera_index=camera_index, 
-                width=width, 
-                height=height, 
-                fps=fps
-            )
+            # 摄像头读取与YOLO都在后台线程，视频轨道的recv()只等待处理好的帧，不阻塞事件循环
+            logger.info(f"正在加载YOLO模型: {YOLO_MODEL_PATH}")
+            self.pipeline = FanoutPipeline(camera_index, width, height, fps, model_path=YOLO_MODEL_PATH, flip=None)
+            self.video_track = PipelineVideoTrack(i420=True)
+            self.pipeline.add_callback(self.video_track.push, "webrtc", i420=True)
+            # 本地预览默认关闭（PREVIEW=window|http），开启时由预览线程以低帧率显示缩小的画面
+            self.preview = Preview.from_env("YOLO WebRTC Stream")
+            if self.preview.enabled:
+                self.pipeline.add_callback(lambda frame, captured_at: self.preview.submit(frame), "preview")
+            self.pipeline.start()
             
-            # 创建并配置WebRTC连接
+            # 创建并配置WebRTC连接（经MediaRelay订阅，多个连接共用同一次采集与推理）
             self.pc = RTCPeerConnection()
-            self.pc.addTrack(self.video_track)
+            self.pc.addTrack(self.relay.subscribe(self.video_track, buffered=False))
             
             # 创建连接到GetStream的WebRTC连接
             logger.info("正在连接到GetStream WebRTC服务...")
@@ -252,10 +142,11 @@ class StreamYOLO:
             logger.info("视频轨道已创建并添加到WebRTC连接")
             logger.info("直播已开始，YOLO检测正在进行")
             
-            # 保持流运行
+            # 保持流运行，定期输出视频轨统计
             try:
                 while True:
-                    await asyncio.sleep(1)
+                    await asyncio.sleep(30)
+                    logger.info(f"视频轨统计: {self.video_track.stats()}")
             except KeyboardInterrupt:
                 pass
             finally:
@@ -271,9 +162,15 @@ class StreamYOLO:
         """停止视频流"""
         logger.info("正在停止流...")
         
-        # 停止视频轨道
+        # 停止视频轨道与后台采集
         if self.video_track:
             self.video_track.stop()
+        if self.pipeline:
+            self.pipeline.stop()
+            self.pipeline = None
+        if self.preview:
+            self.preview.close()
+            self.preview = None
         
         # 关闭WebRTC连接
         if self.pc:
@@ -292,7 +189,7 @@ class StreamYOLO:
 async def main():
     # 解析命令行参数
     parser = argparse.ArgumentParser(description="YOLO Stream with GetStream.io")
-    parser.add_argument("--camera", type=int, default=0, help="摄像头索引")
+    parser.add_argument("--camera", type=str, default="0", help="摄像头索引、视频文件、ESP32-CAM网址或synthetic")
     parser.add_argument("--width", type=int, default=1280, help="视频宽度")
     parser.add_argument("--height", type=int, default=720, help="视频高度")
     parser.add_argument("--fps", type=int, default=15, help="帧率")
@@ -0,0 +1,185 @@
+# overlay.py - 推流端共用的偵測框疊加：直接畫在要送出的幀上，標籤預先繪製成小圖並快取
+#
+# 取代 results[0].plot()：plot() 每幀複製整張畫面再經過通用的 Ultralytics 繪圖器，
+# 這裡只在原緩衝區畫矩形、貼上快取的標籤圖。偵測結果以正規化座標保存，
+# 可以畫到沒有推理的幀上（推理比推流慢時，每一幀都疊加最新一次的結果）。
+#
+#   python overlay.py                                    與 plot() 比較耗時（1280x720, 10 個框）
+#   python overlay.py --width 1920 --height 1080 --boxes 30
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# 與 Ultralytics 相同的調色盤，框的顏色與 plot() 一致
+_PALETTE_HEX = ('FF3838', 'FF9D97', 'FF701F', 'FFB21D', 'CFD231', '48F90A', '92CC17', '3DDB86', '1A9334', '00D4BB',
+                '2C99A8', '00C2FF', '344593', '6473FF', '0018EC', '8438FF', '520085', 'CB38FF', 'FF95C8', 'FF37C7')
+PALETTE = tuple(tuple(int(h[i:i + 2], 16) for i in (4, 2, 0)) for h in _PALETTE_HEX)  # BGR
+
+
+def result_detections(result):
+    """Ultralytics Results -> (k, 6) float32：x1, y1, x2, y2（正規化）, confidence, class_id"""
+    boxes = result.boxes
+    if boxes is None or not len(boxes):
+        return np.zeros((0, 6), dtype=np.float32)
+    rows = np.empty((len(boxes), 6), dtype=np.float32)
+    rows[:, :4] = boxes.xyxyn.cpu().numpy()
+    rows[:, 4] = boxes.conf.cpu().numpy()
+    rows[:, 5] = boxes.cls.cpu().numpy()
+    return rows
+
+
+class OverlayRenderer:
+    """
+    draw(frame) 在 frame 上原地畫出偵測框與標籤並回傳 frame（不複製）。
+    detections 省略時使用 update() 存入的最新結果；rgb=True 表示 frame 為 RGB 排列。
+    標籤（類別 + 兩位小數的信心度）第一次出現時繪製，之後直接貼上快取的小圖。
+    """
+
+    def __init__(self, names, line_width: int = None, font_scale: float = 0.5, max_labels: int = 1024):
+        self.names = dict(enumerate(names)) if isinstance(names, (list, tuple)) else names
+        self.line_width = line_width
+        self.font_scale = font_scale
+        self.max_labels = max_labels
+        self._labels = {}
+        self._latest = np.zeros((0, 6), dtype=np.float32)
+        self._updated_at = None
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.label_hits = 0
+        self.label_misses = 0
+
+    def update(self, detections):
+        """存入最新的偵測結果（可從推理執行緒呼叫）"""
+        with self._lock:
+            self._latest = detections
+            self._updated_at = time.monotonic()
+
+    def update_from_result(self, result):
+        self.update(result_detections(result))
+
+    @property
+    def latest(self):
+        """最新一次 update() 的偵測結果；同一幀要畫在多個畫面上時先取一次，各畫面的框才一致"""
+        with self._lock:
+            return self._latest
+
+    @property
+    def age(self):
+        """最新結果距今秒數；尚無結果時為 None"""
+        return None if self._updated_at is None else time.monotonic() - self._updated_at
+
+    def _color(self, class_id, rgb):
+        color = PALETTE[class_id % len(PALETTE)]
+        return color[::-1] if rgb else color
+
+    def _label(self, class_id, confidence, thickness, rgb):
+        text = f"{self.names.get(class_id, class_id)} {confidence:.2f}"
+        key = (text, thickness, rgb)
+        glyph = self._labels.get(key)
+        if glyph is not None:
+            self.label_hits += 1
+            return glyph
+        self.label_misses += 1
+        if len(self._labels) >= self.max_labels:
+            self._labels.clear()
+        font_thickness = max(thickness - 1, 1)
+        (w, h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, self.font_scale, font_thickness)
+        color = self._color(class_id, rgb)
+        glyph = np.empty((h + baseline + 3, w + 2, 3), dtype=np.uint8)
+        glyph[:] = color
+        # 淺色底用黑字，深色底用白字（與 plot() 相同的判斷）
+        text_color = (0, 0, 0) if sum(color) > 3 * 0.7 * 255 else (255, 255, 255)
+        cv2.putText(glyph, text, (1, h + 1), cv2.FONT_HERSHEY_SIMPLEX, self.font_scale, text_color,
+                    font_thickness, cv2.LINE_AA)
+        self._labels[key] = glyph
+        return glyph
+
+    def draw(self, frame, detections=None, rgb: bool = False):
+        if detections is None:
+            with self._lock:
+                detections = self._latest
+        self.frames += 1
+        if not len(detections):
+            return frame
+        height, width = frame.shape[:2]
+        thickness = self.line_width or max(round((height + width) / 2 * 0.003), 2)
+        for x1, y1, x2, y2, confidence, class_id in detections.tolist():
+            class_id = int(class_id)
+            p1 = (int(x1 * width), int(y1 * height))
+            p2 = (int(x2 * width), int(y2 * height))
+            cv2.rectangle(frame, p1, p2, self._color(class_id, rgb), thickness, cv2.LINE_AA)
+
+            glyph = self._label(class_id, confidence, thickness, rgb)
+            gh, gw = glyph.shape[:2]
+            # 標籤放在框的上方，放不下時放進框內
+            top = p1[1] - gh if p1[1] - gh >= 0 else p1[1]
+            left = p1[0]
+            bottom, right = min(top + gh, height), min(left + gw, width)
+            if left < 0 or top < 0 or bottom <= top or right <= left:
+                continue
+            frame[top:bottom, left:right] = glyph[:bottom - top, :right - left]
+        return frame
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'labels': len(self._labels),
+            'labelHitRate': round(self.label_hits / (self.label_hits + self.label_misses), 3)
+            if self.label_hits + self.label_misses else None,
+        }
+
+
+def _benchmark(width=1280, height=720, boxes=10, classes=5, iterations=200):
+    """與 Ultralytics Results.plot() 比較每幀耗時（plot() 需要安裝 ultralytics / torch）"""
+    rng = np.random.default_rng(0)
+    names = {i: f"class{i}" for i in range(classes)}
+    frame = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    xy = rng.uniform(0, 0.8, (boxes, 2))
+    wh = rng.uniform(0.05, 0.2, (boxes, 2))
+    detections = np.column_stack([xy, xy + wh, rng.uniform(0.3, 1.0, boxes),
+                                  rng.integers(0, classes, boxes)]).astype(np.float32)
+
+    def timed(fn):
+        fn()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        return (time.perf_counter() - start) / iterations * 1000
+
+    renderer = OverlayRenderer(names)
+    target = frame.copy()
+    print(f"{width}x{height}, {boxes} boxes")
+    # 推流端實際的流程：畫到要送出的幀上；這裡每次複製一份幀來模擬新的一幀
+    overlay_ms = timed(lambda: renderer.draw(np.copyto(target, frame) or target, detections))
+    print(f"{'overlay (in place)':<28}{overlay_ms:8.3f} ms  {renderer.stats()}")
+    overlay_rgb_ms = timed(lambda: renderer.draw(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), detections, rgb=True))
+    print(f"{'overlay + BGR->RGB':<28}{overlay_rgb_ms:8.3f} ms")
+
+    try:
+        import torch
+        from ultralytics.engine.results import Results
+    except ImportError:
+        print("ultralytics not installed, skipping plot() comparison")
+        return
+    pixels = detections.copy()
+    pixels[:, [0, 2]] *= width
+    pixels[:, [1, 3]] *= height
+    result = Results(frame, path='', names=names, boxes=torch.from_numpy(pixels))
+    plot_ms = timed(lambda: result.plot())
+    print(f"{'results.plot()':<28}{plot_ms:8.3f} ms  ({plot_ms / overlay_ms:.1f}x)")
+    # live.py / ingross.py 之前的流程：plot() 後再 resize 與轉色
+    plot_rgb_ms = timed(lambda: cv2.cvtColor(cv2.resize(result.plot(), (width, height)), cv2.COLOR_BGR2RGB))
+    print(f"{'plot() + resize + BGR->RGB':<28}{plot_rgb_ms:8.3f} ms  ({plot_rgb_ms / overlay_rgb_ms:.1f}x)")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Overlay renderer vs Results.plot() benchmark")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--boxes', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+    _benchmark(args.width, args.height, args.boxes, iterations=args.iterations)
@@ -0,0 +1,225 @@
+# preprocess.py - 直接從 LiveKit I420 幀產生模型輸入（letterbox + 色彩轉換），寫入預先配置的緩衝區
+#
+# 原本的路徑：to_ndarray("bgr24") 配置一張 BGR 圖 -> Ultralytics 再 letterbox、BGR->RGB、
+# HWC->CHW、/255，每一步都會配置新陣列。
+# 這裡改為：
+#   1. 直接在 I420 平面上縮放（Y 全解析度、U/V 半解析度），寫進 letterbox 後的 I420 緩衝區
+#   2. 一次 cvtColor(YUV2RGB_I420) 寫進預先配置的 RGB 緩衝區
+#   3. 一次 multiply 寫進預先配置的 float32 CHW 批次陣列
+# 熱路徑上不配置任何新陣列；輸出可用 torch.from_numpy() 零複製餵給 model.predict()。
+import time
+
+import cv2
+import numpy as np
+
+# letterbox 邊框顏色：RGB(114, 114, 114) 對應的 YUV
+_PAD_Y = 114
+_PAD_UV = 128
+
+
+class LetterboxInfo:
+    """letterbox 幾何資訊，用來把模型輸出的座標換回原圖的正規化座標"""
+    __slots__ = ('width', 'height', 'imgsz', 'new_w', 'new_h', 'pad_x', 'pad_y')
+
+    def __init__(self, width, height, imgsz):
+        self.width = width
+        self.height = height
+        self.imgsz = imgsz
+        scale = min(imgsz / width, imgsz / height)
+        # I420 的色度是半解析度，尺寸與邊框都取偶數
+        self.new_w = max(2, int(round(width * scale)) & ~1)
+        self.new_h = max(2, int(round(height * scale)) & ~1)
+        self.pad_x = ((imgsz - self.new_w) // 2) & ~1
+        self.pad_y = ((imgsz - self.new_h) // 2) & ~1
+
+    def key(self):
+        return (self.width, self.height, self.imgsz)
+
+    def unletterbox(self, x, y, w, h):
+        """模型輸入（imgsz x imgsz）上的正規化 [x, y, w, h] -> 原圖正規化座標（超出畫面的部分截掉）"""
+        s = self.imgsz
+        x1 = min(max((x * s - self.pad_x) / self.new_w, 0.0), 1.0)
+        y1 = min(max((y * s - self.pad_y) / self.new_h, 0.0), 1.0)
+        x2 = min(max(((x + w) * s - self.pad_x) / self.new_w, 0.0), 1.0)
+        y2 = min(max(((y + h) * s - self.pad_y) / self.new_h, 0.0), 1.0)
+        return [x1, y1, x2 - x1, y2 - y1]
+
+
+def i420_planes(data, width: int, height: int):
+    """把連續的 I420 緩衝區切成 Y / U / V 三個平面（不複製）"""
+    buf = np.frombuffer(data, dtype=np.uint8)
+    cw, ch = (width + 1) // 2, (height + 1) // 2
+    y_size, c_size = width * height, cw * ch
+    y = buf[:y_size].reshape(height, width)
+    u = buf[y_size:y_size + c_size].reshape(ch, cw)
+    v = buf[y_size + c_size:y_size + 2 * c_size].reshape(ch, cw)
+    return y, u, v
+
+
+def livekit_i420_planes(frame):
+    """取得 LiveKit VideoFrame 的 I420 平面；不是 I420 的幀先由 LiveKit 轉換"""
+    from livekit import rtc
+    if frame.type != rtc.VideoBufferType.I420:
+        frame = frame.convert(rtc.VideoBufferType.I420)
+    return i420_planes(frame.data, frame.width, frame.height)
+
+
+class _Slot:
+    """單張影像的暫存區：letterbox 後的 I420 與 RGB"""
+
+    def __init__(self, imgsz):
+        self.i420 = np.empty((imgsz * 3 // 2, imgsz), dtype=np.uint8)
+        flat = self.i420.reshape(-1)
+        area, quarter = imgsz * imgsz, imgsz * imgsz // 4
+        self.y = flat[:area].reshape(imgsz, imgsz)
+        self.u = flat[area:area + quarter].reshape(imgsz // 2, imgsz // 2)
+        self.v = flat[area + quarter:area + 2 * quarter].reshape(imgsz // 2, imgsz // 2)
+        self.rgb = np.empty((imgsz, imgsz, 3), dtype=np.uint8)
+        self.geometry = None
+
+
+class I420Letterbox:
+    """
+    I420 -> 模型輸入（float32, RGB, CHW, 0~1）的融合前處理。
+    pool_size 個批次緩衝區輪流使用，呼叫端在下一輪 begin_batch() 前可安全持有上一批的輸出。
+    """
+
+    def __init__(self, imgsz: int = 640, max_batch: int = 1, pool_size: int = 2):
+        if imgsz % 32:
+            raise ValueError(f"imgsz must be a multiple of 32, got {imgsz}")
+        self.imgsz = imgsz
+        self.max_batch = max(1, max_batch)
+        self.pool_size = max(1, pool_size)
+        self.allocations = 0
+        self.frames = 0
+        self._pool = []
+        self._slots = []
+        self._index = -1
+        self._batch = None
+        self._count = 0
+
+    def _allocate(self):
+        self._pool = [np.empty((self.max_batch, 3, self.imgsz, self.imgsz), dtype=np.float32)
+                      for _ in range(self.pool_size)]
+        self._slots = [_Slot(self.imgsz) for _ in range(self.max_batch)]
+        self.allocations += self.pool_size + 2 * self.max_batch
+
+    def set_imgsz(self, imgsz: int):
+        """改變輸出尺寸（推理尺寸切換時呼叫），下一次 begin_batch() 重新配置緩衝區；已交出的批次不受影響"""
+        if imgsz == self.imgsz:
+            return
+        if imgsz % 32:
+            raise ValueError(f"imgsz must be a multiple of 32, got {imgsz}")
+        self.imgsz = imgsz
+        self._pool = []
+        self._slots = []
+        self._index = -1
+        self._batch = None
+
+    def begin_batch(self):
+        """換到下一個批次緩衝區"""
+        if not self._pool:
+            self._allocate()
+        self._index = (self._index + 1) % self.pool_size
+        self._batch = self._pool[self._index]
+        self._count = 0
+
+    def add(self, y, u, v):
+        """把一幀 I420 平面寫進目前批次的下一個位置，回傳 LetterboxInfo"""
+        if self._batch is None:
+            self.begin_batch()
+        if self._count >= self.max_batch:
+            raise ValueError(f"Batch is full ({self.max_batch})")
+        height, width = y.shape
+        info = LetterboxInfo(width, height, self.imgsz)
+        slot = self._slots[self._count]
+
+        if slot.geometry != info.key():
+            # 幾何改變才需要重畫邊框；之後每幀只覆寫中間的影像區域
+            slot.y.fill(_PAD_Y)
+            slot.u.fill(_PAD_UV)
+            slot.v.fill(_PAD_UV)
+            slot.geometry = info.key()
+
+        x0, y0, w, h = info.pad_x, info.pad_y, info.new_w, info.new_h
+        cv2.resize(y, (w, h), dst=slot.y[y0:y0 + h, x0:x0 + w], interpolation=cv2.INTER_LINEAR)
+        cx, cy, cw, ch = x0 // 2, y0 // 2, w // 2, h // 2
+        cv2.resize(u, (cw, ch), dst=slot.u[cy:cy + ch, cx:cx + cw], interpolation=cv2.INTER_LINEAR)
+        cv2.resize(v, (cw, ch), dst=slot.v[cy:cy + ch, cx:cx + cw], interpolation=cv2.INTER_LINEAR)
+
+        cv2.cvtColor(slot.i420, cv2.COLOR_YUV2RGB_I420, dst=slot.rgb)
+        np.multiply(slot.rgb.transpose(2, 0, 1), 1.0 / 255.0, out=self._batch[self._count], casting='unsafe')
+
+        self._count += 1
+        self.frames += 1
+        return info
+
+    def batch(self):
+        """目前批次已填入的部分（view，不複製）"""
+        return self._batch[:self._count]
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'allocations': self.allocations,
+            'allocationsPerFrame': round(self.allocations / self.frames, 4) if self.frames else None,
+        }
+
+
+def _reference_path(y, u, v, imgsz):
+    """模擬目前的路徑：to_ndarray('bgr24') + Ultralytics LetterBox + 前處理"""
+    height, width = y.shape
+    i420 = np.concatenate([y.reshape(-1), u.reshape(-1), v.reshape(-1)]).reshape(height * 3 // 2, width)
+    bgr = cv2.cvtColor(i420, cv2.COLOR_YUV2BGR_I420)
+    scale = min(imgsz / width, imgsz / height)
+    new_w, new_h = int(round(width * scale)), int(round(height * scale))
+    resized = cv2.resize(bgr, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    dw, dh = (imgsz - new_w) / 2, (imgsz - new_h) / 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    boxed = cv2.copyMakeBorder(resized, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    chw = np.ascontiguousarray(boxed[..., ::-1].transpose(2, 0, 1)[None])
+    return chw.astype(np.float32) / 255.0
+
+
+def _benchmark(width: int = 1280, height: int = 720, imgsz: int = 640, iterations: int = 200):
+    """與目前路徑比較每幀耗時與每幀配置的記憶體"""
+    import tracemalloc
+    # 平滑的合成畫面（漸層 + 色塊），比較接近真實攝影機畫面
+    xs = np.linspace(0, 255, width, dtype=np.float32)
+    ys = np.linspace(0, 255, height, dtype=np.float32)
+    bgr = np.stack(np.broadcast_arrays(xs[None, :], ys[:, None], (xs[None, :] + ys[:, None]) / 2), axis=-1)
+    bgr = bgr.astype(np.uint8)
+    cv2.rectangle(bgr, (width // 4, height // 4), (width // 2, height // 2), (0, 0, 255), -1)
+    i420 = cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_I420)
+    y, u, v = i420_planes(i420, width, height)
+
+    pre = I420Letterbox(imgsz)
+
+    def fused():
+        pre.begin_batch()
+        pre.add(y, u, v)
+        return pre.batch()
+
+    # 兩條路徑的結果應該幾乎相同（只差在色度先縮放的取樣誤差）
+    diff = np.abs(fused()[0] - _reference_path(y, u, v, imgsz)[0]).mean() * 255
+    print(f"{width}x{height} -> {imgsz}: mean abs diff vs reference = {diff:.2f} (0-255 scale)")
+
+    for name, fn in (('reference', lambda: _reference_path(y, u, v, imgsz)), ('fused', fused)):
+        fn()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        per_frame = (time.perf_counter() - start) / iterations * 1000
+
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  {name:>9}: {per_frame:6.2f} ms/frame, peak allocated {peak / 1e6:6.2f} MB/frame")
+    print(f"  fused stats: {pre.stats()}")
+
+
+if __name__ == "__main__":
+    for size in ((1280, 720), (1920, 1080), (640, 480)):
+        _benchmark(*size)
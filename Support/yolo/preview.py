@@ -0,0 +1,275 @@
+# preview.py - 本機預覽：預設關閉；開啟時在自己的執行緒以限定幀率顯示縮小的畫面（OpenCV 視窗或本機 MJPEG HTTP）
+#
+# 原本各推流腳本在熱路徑上每幀 cv2.imshow + cv2.waitKey(1)，每幀要花幾 ms，而且伺服器上沒有顯示器時會出錯。
+# 這裡推流迴圈只呼叫 submit(frame)：還沒到下一次預覽時間就直接返回；到了才縮小一份交給預覽執行緒，
+# 視窗事件（waitKey）與 JPEG 編碼都在預覽執行緒，推流迴圈只看 quit_requested（視窗裡按 q）。
+#   PREVIEW=off（預設）| window | http | http:8091     PREVIEW_FPS（預設 5）、PREVIEW_WIDTH（預設 640）
+# http 模式在 http://127.0.0.1:<port>/ 提供預覽頁面（/stream 為 MJPEG），只有在有人觀看時才編碼 JPEG。
+# macOS 的 HighGUI 只能在主執行緒使用，window 模式在 macOS 上改用 http。
+import http.server
+import logging
+import os
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MODES = ('off', 'window', 'http')
+DEFAULT_PORT = 8090
+_BOUNDARY = "previewframe"
+_PAGE = b"<html><body style='margin:0;background:#000'><img src='/stream' style='width:100%'></body></html>"
+
+
+class Preview:
+    """mode='off' 時所有方法都是空操作，推流腳本可以無條件呼叫"""
+
+    def __init__(self, mode: str = 'off', title: str = "Preview", fps: float = 5.0, width: int = 640,
+                 host: str = '127.0.0.1', port: int = DEFAULT_PORT, quality: int = 70):
+        if mode not in MODES:
+            raise ValueError(f"Preview mode must be one of {MODES}, got {mode!r}")
+        if mode == 'window' and sys.platform == 'darwin':
+            logger.warning("OpenCV windows only work on the main thread on macOS, using the HTTP preview instead")
+            mode = 'http'
+        self.mode = mode
+        self.title = title
+        self.interval = 1.0 / fps
+        self.width = width
+        self.host = host
+        self.port = port
+        self.quality = quality
+        self._cond = threading.Condition()
+        self._pending = None     # submit() 縮小後的最新一幀
+        self._pending_seq = 0
+        self._jpeg = None
+        self._jpeg_seq = 0
+        self._clients = 0
+        self._next_due = 0.0
+        self._closed = False
+        self._quit = threading.Event()
+        self._threads = []
+        self._server = None
+        self.submitted = 0
+        self.shown = 0
+        self.submit_seconds = 0.0
+        if mode == 'window':
+            self._start(self._window_loop, 'preview-window')
+        elif mode == 'http':
+            self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+            self._server.daemon_threads = True
+            self._start(self._server.serve_forever, 'preview-http')
+            self._start(self._encode_loop, 'preview-encode')
+            logger.info(f"Preview at http://{host}:{self._server.server_address[1]}/")
+
+    @classmethod
+    def from_spec(cls, spec: str, title: str = "Preview", **kwargs):
+        """'off' / 'window' / 'http' / 'http:8091'"""
+        mode, _, port = (spec or 'off').partition(':')
+        if port:
+            kwargs['port'] = int(port)
+        return cls(mode, title, **kwargs)
+
+    @classmethod
+    def from_env(cls, title: str = "Preview"):
+        """依環境變數 PREVIEW / PREVIEW_FPS / PREVIEW_WIDTH 建立（預設關閉）"""
+        return cls.from_spec(os.getenv('PREVIEW', 'off'), title, fps=float(os.getenv('PREVIEW_FPS', '5')),
+                             width=int(os.getenv('PREVIEW_WIDTH', '640')))
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'off' and not self._closed
+
+    @property
+    def quit_requested(self) -> bool:
+        """預覽視窗裡按了 q"""
+        return self._quit.is_set()
+
+    def _start(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def submit(self, frame, draw=None) -> bool:
+        """
+        推流迴圈每幀呼叫：距上一次預覽不到 1 / fps 秒直接返回 False；
+        否則把 frame（BGR）縮小寫進預覽緩衝區（呼叫返回後 frame 可以馬上重用），
+        再對縮小後的畫面呼叫 draw(image)（例如疊加偵測框）。
+        """
+        if self.mode == 'off' or self._closed:
+            return False
+        now = time.monotonic()
+        if now < self._next_due:
+            return False
+        self._next_due = now + self.interval
+        height, width = frame.shape[:2]
+        size = (width, height) if width <= self.width else (self.width, round(height * self.width / width))
+        with self._cond:
+            if self._pending is None or self._pending.shape[:2] != (size[1], size[0]):
+                self._pending = np.empty((size[1], size[0], 3), dtype=np.uint8)
+            if size == (width, height):
+                np.copyto(self._pending, frame)
+            else:
+                cv2.resize(frame, size, dst=self._pending, interpolation=cv2.INTER_NEAREST)
+            if draw is not None:
+                draw(self._pending)
+            self._pending_seq += 1
+            self._cond.notify_all()
+        self.submitted += 1
+        self.submit_seconds += time.monotonic() - now
+        return True
+
+    def _take(self, after_seq: int, timeout: float, image):
+        """等到比 after_seq 新的預覽幀，複製到 image（尺寸不同時重新配置）後回傳 (seq, image)"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending_seq > after_seq or self._closed, timeout)
+            if self._closed or self._pending_seq <= after_seq:
+                return after_seq, None
+            if image is None or image.shape != self._pending.shape:
+                image = np.empty_like(self._pending)
+            np.copyto(image, self._pending)
+            return self._pending_seq, image
+
+    def _window_loop(self):
+        seq = 0
+        image = None
+        try:
+            cv2.namedWindow(self.title)
+            while not self._closed:
+                new_seq, shown = self._take(seq, self.interval, image)
+                if shown is not None:
+                    seq, image = new_seq, shown
+                    cv2.imshow(self.title, image)
+                    self.shown += 1
+                # 沒有新幀也要處理視窗事件
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    logger.info("Preview window: q pressed")
+                    self._quit.set()
+            cv2.destroyWindow(self.title)
+        except cv2.error as e:
+            logger.error(f"Preview window unavailable, disabling preview: {e}")
+            self.mode = 'off'
+
+    def _encode_loop(self):
+        seq = 0
+        image = None
+        while not self._closed:
+            new_seq, taken = self._take(seq, 1.0, image)
+            if taken is None:
+                continue
+            seq, image = new_seq, taken
+            if not self._clients:
+                continue  # 沒人看就不編碼
+            ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if ok:
+                with self._cond:
+                    self._jpeg = jpeg.tobytes()
+                    self._jpeg_seq += 1
+                    self._cond.notify_all()
+                self.shown += 1
+
+    def _handler(self):
+        preview = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/':
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/html')
+                    self.send_header('Content-Length', str(len(_PAGE)))
+                    self.end_headers()
+                    self.wfile.write(_PAGE)
+                elif self.path == '/stream':
+                    self.send_response(200)
+                    self.send_header('Content-Type', f'multipart/x-mixed-replace;boundary={_BOUNDARY}')
+                    self.send_header('Cache-Control', 'no-cache')
+                    self.end_headers()
+                    preview._serve_stream(self.wfile)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _serve_stream(self, wfile):
+        seq = 0
+        with self._cond:
+            self._clients += 1
+        try:
+            while not self._closed:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._jpeg_seq > seq or self._closed, 1.0)
+                    if self._closed or self._jpeg_seq <= seq:
+                        continue
+                    seq, jpeg = self._jpeg_seq, self._jpeg
+                wfile.write(f"--{_BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n"
+                            .encode('latin-1') + jpeg + b"\r\n")
+                wfile.flush()
+        except OSError:
+            pass  # 瀏覽器關閉
+        finally:
+            with self._cond:
+                self._clients -= 1
+
+    def close(self, timeout: float = 2.0):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'submitted': self.submitted,
+            'shown': self.shown,
+            'clients': self._clients,
+            'submitMs': round(self.submit_seconds / self.submitted * 1000, 3) if self.submitted else None,
+        }
+
+
+def _benchmark(width=1280, height=720, iterations=300, stream_fps=30):
+    """比較每幀 imshow + waitKey(1) 與 Preview.submit() 在推流迴圈上的平均耗時（需要顯示器才會量 imshow）"""
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+
+    def timed(fn):
+        spent = 0.0
+        for _ in range(iterations):
+            start = time.perf_counter()
+            fn()
+            spent += time.perf_counter() - start
+            time.sleep(1.0 / stream_fps)  # 模擬推流節拍，讓限速生效
+        return spent / iterations * 1000
+
+    print(f"{width}x{height}, {iterations} frames at {stream_fps} fps (time spent in the streaming loop per frame)")
+    try:
+        ms = timed(lambda: (cv2.imshow("benchmark", frame), cv2.waitKey(1)))
+        cv2.destroyAllWindows()
+        print(f"{'imshow + waitKey(1)':<28}{ms:8.3f} ms")
+    except cv2.error:
+        print("no display, skipping imshow")
+    for mode in ('off', 'http'):
+        preview = Preview(mode, port=0)
+        ms = timed(lambda: preview.submit(frame))
+        preview.close()
+        print(f"{'Preview(' + mode + ').submit()':<28}{ms:8.3f} ms  {preview.stats()}")
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
+    parser = argparse.ArgumentParser(description="Benchmark per-frame imshow against the threaded preview")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--iterations", type=int, default=300)
+    args = parser.parse_args()
+    _benchmark(args.width, args.height, args.iterations)
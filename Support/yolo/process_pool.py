@@ -0,0 +1,279 @@
+# process_pool.py - 多行程推理：N 個工作行程各自載入模型，幀經由共享記憶體環形緩衝區傳遞
+#
+# 主行程把前處理好的批次（float32 NCHW）直接寫進共享記憶體的空槽，只透過佇列送出 (槽號, 張數, 尺寸)；
+# 工作行程推理後把小小的偵測結果陣列送回，由收集執行緒完成對應的 Future。
+# 收集執行緒也定期檢查工作行程：行程意外結束（OOM、segfault）時，它手上批次的 Future 以例外完成並重新啟動該行程。
+# 同一軌道的順序由 BatchScheduler 保證：軌道有批次在推理中時，不會送出它的下一幀。
+#
+#   python process_pool.py ../../models2/best.pt --backend onnx --workers 1,2,4,8   量測 1 ~ N 個行程的吞吐量
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from engine import DetectionEngine, create_engine, prepare_model_file
+
+WORKER_CHECK_INTERVAL = 1.0  # 收集執行緒檢查工作行程是否還活著的間隔（秒）
+
+
+class SharedFrameRing:
+    """slots 個 (max_batch, 3, imgsz, imgsz) float32 槽，放在同一塊共享記憶體；較小的輸入尺寸共用同一個槽"""
+
+    def __init__(self, slots: int, max_batch: int, imgsz: int, name: str = None):
+        self.shape = (slots, max_batch, 3, imgsz, imgsz)
+        size = int(np.prod(self.shape)) * np.dtype(np.float32).itemsize
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.array = np.ndarray(self.shape, dtype=np.float32, buffer=self.shm.buf)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def view(self, slot: int, count: int, size: int):
+        """槽開頭的連續 (count, 3, size, size) 視圖"""
+        return self.array[slot].reshape(-1)[:count * 3 * size * size].reshape(count, 3, size, size)
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _worker_main(worker_id, model_path, backend, imgsz, conf, threads, ring_name, ring_shape, tasks, results):
+    """工作行程：載入模型後反覆 (槽號, 張數, 尺寸) -> 推理 -> 回傳結果"""
+    try:
+        if backend == 'torch':
+            import torch
+            torch.set_num_threads(threads)
+        engine = create_engine(model_path, backend, device='cpu', imgsz=imgsz, conf=conf, threads=threads)
+        engine.warm_up()
+        ring = SharedFrameRing(ring_shape[0], ring_shape[1], ring_shape[-1], name=ring_name)
+    except Exception as e:
+        results.put(('error', worker_id, repr(e)))
+        return
+    results.put(('ready', worker_id, (engine.names, engine.size_bytes)))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, count, size = task
+        # 先回報這個槽由誰處理，行程死掉時主行程才知道哪些 Future 不會再完成
+        results.put(('taken', slot, worker_id))
+        try:
+            rows = engine.detect(ring.view(slot, count, size))
+            results.put(('done', slot, rows))
+        except Exception as e:
+            results.put(('failed', slot, repr(e)))
+    ring.close()
+
+
+class ProcessPoolEngine(DetectionEngine):
+    """
+    DetectionEngine 介面的多行程版本。detect_async() 回傳 concurrent.futures.Future，
+    BatchScheduler 可以同時讓多個批次在不同行程中推理；detect() 為同步版本。
+    槽數為 workers + 1：所有工作行程都在忙時，主行程還能先準備好下一批，再多就阻塞（背壓）。
+    """
+    asynchronous = True
+
+    def __init__(self, model_path: str, backend: str = 'onnx', workers: int = 2, imgsz: int = 640,
+                 conf: float = 0.25, max_batch: int = 1, threads: int = 0, cache_dir: str = None,
+                 calibration: str = None, start_timeout: float = 300.0):
+        # 匯出 / 量化只在主行程做一次，避免工作行程同時寫同一個快取檔
+        model_file = prepare_model_file(model_path, backend, imgsz, cache_dir, calibration)
+        threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        self.backend = f"{backend}x{workers}"
+        self.workers = workers
+        self.max_batch = max_batch
+        self.ring = SharedFrameRing(workers + 1, max_batch, imgsz)
+        self._free = queue.Queue()
+        for slot in range(workers + 1):
+            self._free.put(slot)
+        self._pending = {}
+        self._assigned = {}   # 槽號 -> 正在處理的工作行程（只在收集執行緒中使用）
+        self._lock = threading.Lock()
+        self._closed = False
+        self.restarts = 0
+
+        self._ctx = multiprocessing.get_context('spawn')
+        self._tasks = self._ctx.Queue()
+        self._results = self._ctx.Queue()
+        self._worker_args = (model_file, backend, imgsz, conf, threads, self.ring.name, self.ring.shape,
+                             self._tasks, self._results)
+        self._processes = [self._spawn(i) for i in range(workers)]
+
+        names, size = self._wait_ready(start_timeout)
+        self._size_bytes = size * workers
+        super().__init__(names, imgsz, conf)
+        self._collector = threading.Thread(target=self._collect, name='yolo-pool-results', daemon=True)
+        self._collector.start()
+        logging.info(f"Process pool ready: {workers} x {backend} ({threads} threads each)")
+
+    def _spawn(self, worker_id):
+        process = self._ctx.Process(target=_worker_main, name=f'yolo-worker-{worker_id}', daemon=True,
+                                    args=(worker_id, *self._worker_args))
+        process.start()
+        return process
+
+    def _wait_ready(self, timeout):
+        """等所有工作行程載入完模型；任何失敗（含逾時）都先關閉工作行程與共享記憶體再拋出 RuntimeError"""
+        info = None
+        deadline = time.monotonic() + timeout
+        try:
+            for _ in self._processes:
+                kind, worker_id, payload = self._results.get(timeout=max(0.0, deadline - time.monotonic()))
+                if kind == 'error':
+                    raise RuntimeError(f"Worker {worker_id} failed to start: {payload}")
+                info = payload
+        except Exception as e:
+            self.close()
+            if isinstance(e, queue.Empty):
+                raise RuntimeError(f"Workers not ready within {timeout:g}s") from e
+            if isinstance(e, RuntimeError):
+                raise
+            raise RuntimeError(f"Process pool failed to start: {e!r}") from e
+        return info
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size_bytes
+
+    def _collect(self):
+        last_check = time.monotonic()
+        while True:
+            try:
+                message = self._results.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                message = ()
+            if message is None:
+                break
+            if time.monotonic() - last_check >= WORKER_CHECK_INTERVAL:
+                self._check_workers()
+                last_check = time.monotonic()
+            if not message:
+                continue
+            kind, slot, payload = message
+            if kind == 'taken':
+                self._assigned[slot] = payload
+            elif kind == 'ready':
+                logging.info(f"Worker {slot} restarted")
+            elif kind == 'error':
+                logging.error(f"Worker {slot} failed to restart: {payload}")
+            elif kind == 'done':
+                self._finish(slot, result=payload)
+            else:
+                self._finish(slot, error=RuntimeError(f"Inference failed in worker: {payload}"))
+
+    def _finish(self, slot, result=None, error=None):
+        """完成槽的 Future 並歸還槽"""
+        self._assigned.pop(slot, None)
+        with self._lock:
+            future = self._pending.pop(slot, None)
+        self._free.put(slot)
+        if future is None:
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def _check_workers(self):
+        """工作行程意外結束時，它處理中的批次以例外完成（BatchScheduler 才會放行該軌道），並重新啟動行程"""
+        for worker_id, process in enumerate(self._processes):
+            if self._closed or process.is_alive():
+                continue
+            lost = [slot for slot, owner in self._assigned.items() if owner == worker_id]
+            logging.error(f"Worker {worker_id} exited unexpectedly (exitcode={process.exitcode}), "
+                          f"failing {len(lost)} batch(es) and restarting it")
+            for slot in lost:
+                self._finish(slot, error=RuntimeError(f"Worker {worker_id} exited (exitcode={process.exitcode})"))
+            self.restarts += 1
+            self._processes[worker_id] = self._spawn(worker_id)
+
+    def detect_async(self, batch) -> concurrent.futures.Future:
+        count, size = len(batch), batch.shape[-1]
+        if count > self.max_batch or size > self.imgsz:
+            raise ValueError(f"Batch {batch.shape} exceeds pool capacity ({self.max_batch}, 3, {self.imgsz}, {self.imgsz})")
+        slot = self._free.get()
+        if self._closed:
+            raise RuntimeError("Process pool is closed")
+        np.copyto(self.ring.view(slot, count, size), batch)
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._pending[slot] = future
+        self._tasks.put((slot, count, size))
+        return future
+
+    def detect(self, batch):
+        return self.detect_async(batch).result()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+        if getattr(self, '_collector', None) is not None:
+            self._collector.join(timeout=5)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError("Process pool closed"))
+        # 喚醒還在等空槽的 detect_async()
+        for _ in range(self.workers + 1):
+            self._free.put(None)
+        self.ring.close()
+        logging.info(f"Process pool closed ({self.backend})")
+
+
+def _benchmark(model_path, backend, worker_counts, imgsz=640, max_batch=1, duration=10.0):
+    """在 duration 秒內讓所有行程保持忙碌，量測 1 ~ N 個行程的每秒影像數"""
+    batch = np.random.rand(max_batch, 3, imgsz, imgsz).astype(np.float32)
+    baseline = None
+    print(f"{'workers':>8}{'img/s':>10}{'speedup':>9}{'efficiency':>12}")
+    for workers in worker_counts:
+        pool = ProcessPoolEngine(model_path, backend, workers=workers, imgsz=imgsz, max_batch=max_batch)
+        completed = 0
+        in_flight = []
+        start = time.monotonic()
+        while time.monotonic() - start < duration:
+            # detect_async 在沒有空槽時阻塞，所以保持 workers + 1 個批次在路上即可
+            in_flight.append(pool.detect_async(batch))
+            done = [f for f in in_flight if f.done()]
+            completed += len(done) * max_batch
+            in_flight = [f for f in in_flight if not f.done()]
+        concurrent.futures.wait(in_flight)
+        completed += len(in_flight) * max_batch
+        rate = completed / (time.monotonic() - start)
+        pool.close()
+        baseline = baseline or rate
+        print(f"{workers:>8}{rate:>10.1f}{rate / baseline:>9.2f}{rate / baseline / workers * worker_counts[0]:>12.2f}")
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [Pool] - %(message)s')
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+    parser = argparse.ArgumentParser(description="Process-pool inference scaling benchmark (CPU)")
+    parser.add_argument('model', help=".pt model path")
+    parser.add_argument('--backend', default='onnx')
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args()
+    _benchmark(args.model, args.backend, [int(w) for w in args.workers.split(',')], args.imgsz, args.batch,
+               args.duration)
@@ -0,0 +1,317 @@
+# replay_bench.py - 離線重播基準測試：不需要 LiveKit 房間與攝影機，量測 Bot 的實際處理路徑
+#
+# 從影片檔（例如 Support/yolotest/*.mov）或合成畫面產生 LiveKit I420 幀，
+# 透過假的房間 / 參與者記錄發布的結果，掃描抽樣間隔、影像大小與批次大小（只用 CPU）。
+#
+#   python replay_bench.py --bot ai --source ../yolotest/13.mov --intervals 1,2 --imgsz 320,640 --batch 1,4
+#   python replay_bench.py --bot yolo --source synthetic --model ../../models/best.pt
+# --source 接受 frame_source.py 的任何來源（影片檔、synthetic、攝影機索引、ESP32-CAM 網址）；合成畫面每次執行都相同。
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+# 只量測 CPU：在 import torch 之前隱藏 GPU
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+import cv2
+from livekit import rtc
+
+from frame_sampler import AdaptiveFrameSampler
+from frame_source import open_source
+from inference_worker import BatchScheduler
+from metrics import StageMetrics
+from preprocess import I420Letterbox
+from resolution_ladder import ResolutionLadder
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [Replay] - %(message)s')
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+
+class FakeLocalParticipant:
+    """記錄所有 publish_data 呼叫，取代真正的 Data Channel"""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.by_topic = {}
+
+    async def publish_data(self, payload, kind=None, topic=None, **kwargs):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.messages += 1
+        self.bytes += len(payload)
+        self.by_topic[topic] = self.by_topic.get(topic, 0) + 1
+
+
+class FakeRoom:
+    def __init__(self):
+        self.local_participant = FakeLocalParticipant()
+
+
+class FakeTrack:
+    """只支援 AIBot 用到的 track.on('frame_received', ...)"""
+
+    def __init__(self):
+        self.handlers = {}
+
+    def on(self, event, callback):
+        self.handlers[event] = callback
+
+    def emit(self, event, payload):
+        handler = self.handlers.get(event)
+        if handler:
+            handler(payload)
+
+
+class FakeFrameEvent:
+    __slots__ = ('frame', 'timestamp_us')
+
+    def __init__(self, frame, timestamp_us):
+        self.frame = frame
+        self.timestamp_us = timestamp_us
+
+
+def to_video_frame(bgr):
+    """BGR 影像 -> LiveKit I420 VideoFrame（與訂閱到的遠端幀相同格式）"""
+    height, width = bgr.shape[:2]
+    bgr = bgr[:height & ~1, :width & ~1]
+    height, width = bgr.shape[:2]
+    i420 = cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_I420)
+    return rtc.VideoFrame(width, height, rtc.VideoBufferType.I420, i420.tobytes())
+
+
+def load_source_frames(spec, max_frames=300, size=(1280, 720)):
+    """
+    預先讀出來源的幀（frame_source.open_source，不等待節拍），避免解碼時間混進量測；回傳 (frames, fps)。
+    size 只用於合成畫面與攝影機。
+    """
+    source = open_source(spec, *size, pacing='fast')
+    if not source.isOpened():
+        raise FileNotFoundError(f"Cannot open source: {spec}")
+    fps = source.fps or 30.0
+    frames = []
+    while len(frames) < max_frames:
+        ok, bgr = source.read()
+        if not ok:
+            if source.ended:
+                break
+            continue
+        frames.append(to_video_frame(bgr))
+    source.release()
+    if not frames:
+        raise ValueError(f"No frames read from {spec}")
+    return frames, fps
+
+
+class YoloBotAdapter:
+    """驅動 yolo_bot.YoloProcessor：與 _process_track 相同，把幀交給排程器"""
+    name = 'yolo_bot'
+
+    def __init__(self, model_path):
+        sys.path.insert(0, REPO_ROOT)
+        import yolo_bot
+        self.bot = yolo_bot.YoloProcessor(model_path)
+        self.interval = 1
+        self.counts = {}
+
+    def setup(self, loop, keys, interval, imgsz, max_batch):
+        bot = self.bot
+        bot.room = FakeRoom()
+        bot.metrics = StageMetrics('replay')
+        bot.preprocessor = I420Letterbox(imgsz, max_batch=max_batch)
+        bot.ladder = ResolutionLadder([imgsz], budget=0)  # 每組設定固定尺寸
+        for state in (bot.serializers, bot.frame_seq, bot.motion_gates, bot.last_detections):
+            state.clear()
+        bot.scheduler = BatchScheduler(bot._infer_batch, bot._publish_detections, loop,
+                                       max_batch=max_batch, stats_interval=0)
+        bot.scheduler.start()
+        for key in keys:
+            bot.scheduler.add_track(key)
+        # YoloProcessor 沒有抽樣器，抽樣間隔由這裡套用
+        self.interval = interval
+        self.counts = {key: 0 for key in keys}
+
+    def feed(self, key, frame, timestamp_us):
+        self.counts[key] += 1
+        if (self.counts[key] - 1) % self.interval:
+            return
+        seq = self.bot.frame_seq.get(key, 0) + 1
+        self.bot.frame_seq[key] = seq
+        self.bot.scheduler.submit(key, (seq, timestamp_us, frame, time.monotonic()))
+
+    def teardown(self):
+        self.bot.scheduler.stop()
+
+
+class AIBotAdapter:
+    """驅動 ai_bot.AIBot：透過假的 track 事件走 on_frame_received（含抽樣器）"""
+    name = 'ai_bot'
+
+    def __init__(self, models_dir):
+        import ai_bot
+        self.bot = ai_bot.AIBot(models_dir)
+        if not self.bot.active:
+            raise FileNotFoundError(f"No models found in {models_dir}")
+        self.tracks = {}
+
+    def setup(self, loop, keys, interval, imgsz, max_batch):
+        bot = self.bot
+        bot.room = FakeRoom()
+        bot.metrics = StageMetrics('replay')
+        bot.preprocessor = I420Letterbox(imgsz, max_batch=max_batch)
+        bot.ladder = ResolutionLadder([imgsz], budget=0)  # 每組設定固定尺寸
+        bot._activate(*bot.active[:2])  # 重設各軌道的追蹤與沿用結果
+        bot.scheduler = BatchScheduler(bot._infer_batch, bot._send_detections, loop,
+                                       max_batch=max_batch, stats_interval=0)
+        bot.scheduler.start()
+        self.tracks = {}
+        for key in keys:
+            track = FakeTrack()
+            bot.add_track(key, track)
+            # 固定抽樣間隔，讓每組設定可以比較
+            bot.samplers[key] = AdaptiveFrameSampler(target_latency=1.0, initial_interval=interval,
+                                                     min_interval=interval, max_interval=interval)
+            self.tracks[key] = track
+
+    def feed(self, key, frame, timestamp_us):
+        self.tracks[key].emit('frame_received', FakeFrameEvent(frame, timestamp_us))
+
+    def teardown(self):
+        for key in list(self.tracks):
+            self.bot.remove_track(key)
+        self.bot.scheduler.stop()
+
+
+async def run_config(adapter, frames, fps, tracks, duration, interval, imgsz, max_batch):
+    """以固定輸入幀率重播 duration 秒，回傳這組設定的結果"""
+    loop = asyncio.get_running_loop()
+    keys = ['webcam-publisher'] + [f'webcam-publisher-{i}' for i in range(2, tracks + 1)]
+    adapter.setup(loop, keys, interval, imgsz, max_batch)
+    bot = adapter.bot
+
+    period = 1.0 / fps
+    start = time.monotonic()
+    offered = 0
+    for tick in itertools.count():
+        target = start + tick * period
+        if target - start >= duration:
+            break
+        delay = target - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        timestamp_us = int(time.time() * 1e6)
+        for n, key in enumerate(keys):
+            # 每個軌道錯開起點，避免所有軌道畫面完全相同
+            adapter.feed(key, frames[(tick + n * 7) % len(frames)], timestamp_us)
+            offered += 1
+        # 讓排程器送回的發布協程有機會執行
+        await asyncio.sleep(0)
+    elapsed = time.monotonic() - start
+
+    # 等排程器把已交付的幀處理完，再讓發布協程跑完
+    scheduler = bot.scheduler
+    deadline = time.monotonic() + 5.0
+    while time.monotonic() < deadline:
+        stats = scheduler.stats()['tracks']
+        if all(s['processed'] + s['failed'] + s['dropped'] >= s['submitted'] for s in stats.values()):
+            break
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)
+
+    track_stats = scheduler.stats()['tracks']
+    adapter.teardown()
+
+    submitted = sum(s['submitted'] for s in track_stats.values())
+    processed = sum(s['processed'] for s in track_stats.values())
+    dropped = sum(s['dropped'] for s in track_stats.values())
+    latency = bot.metrics.summary()
+    pipeline = latency.get('pipeline', {'count': 0})
+    infer = latency.get('infer', {'count': 0})
+    published = bot.room.local_participant
+    return {
+        'bot': adapter.name,
+        'interval': interval,
+        'imgsz': imgsz,
+        'batch': max_batch,
+        'tracks': tracks,
+        'offered': offered,
+        'submitted': submitted,
+        'processed': processed,
+        'fps': round(processed / elapsed, 2),
+        'dropRate': round(dropped / submitted, 3) if submitted else 0.0,
+        'p50Ms': pipeline.get('p50Ms'),
+        'p95Ms': pipeline.get('p95Ms'),
+        'p99Ms': pipeline.get('p99Ms'),
+        'inferP50Ms': infer.get('p50Ms'),
+        'messages': published.messages,
+        'bytes': published.bytes,
+        'bytesPerSec': round(published.bytes / elapsed, 1),
+        'stages': latency,
+    }
+
+
+def _print_table(rows):
+    header = (f"{'bot':<9}{'int':>4}{'imgsz':>6}{'batch':>6}{'fps':>8}{'drop':>7}"
+              f"{'p50ms':>8}{'p95ms':>8}{'p99ms':>8}{'infer50':>9}{'msgs':>7}{'B/s':>9}")
+    print(header)
+    print('-' * len(header))
+    for r in rows:
+        print(f"{r['bot']:<9}{r['interval']:>4}{r['imgsz']:>6}{r['batch']:>6}{r['fps']:>8}"
+              f"{r['dropRate']:>7}{str(r['p50Ms']):>8}{str(r['p95Ms']):>8}{str(r['p99Ms']):>8}"
+              f"{str(r['inferP50Ms']):>9}{r['messages']:>7}{r['bytesPerSec']:>9}")
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+async def main(args):
+    frames, source_fps = load_source_frames(args.source, args.max_frames, args.size)
+    fps = args.fps or source_fps
+    logging.info(f"Replaying {len(frames)} frames ({frames[0].width}x{frames[0].height}) "
+                 f"at {fps:.1f} fps x {args.tracks} tracks")
+
+    if args.bot == 'ai':
+        adapter = AIBotAdapter(args.models_dir)
+    else:
+        adapter = YoloBotAdapter(args.model)
+
+    rows = []
+    for interval, imgsz, max_batch in itertools.product(args.intervals, args.imgsz, args.batch):
+        result = await run_config(adapter, frames, fps, args.tracks, args.duration, interval, imgsz, max_batch)
+        logging.info(f"interval={interval} imgsz={imgsz} batch={max_batch}: "
+                     f"{result['fps']} fps, drop {result['dropRate']:.1%}, p95 {result['p95Ms']} ms")
+        rows.append(result)
+
+    _print_table(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+        logging.info(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline replay benchmark for yolo_bot / ai_bot (CPU)")
+    parser.add_argument('--bot', choices=('ai', 'yolo'), default='ai')
+    parser.add_argument('--source', default='synthetic:150',
+                        help="video file path, synthetic[:frames], camera index or ESP32-CAM URL")
+    parser.add_argument('--size', type=lambda v: tuple(int(x) for x in v.split('x')), default=(1280, 720),
+                        help="synthetic frame size, e.g. 1280x720")
+    parser.add_argument('--max-frames', type=int, default=300)
+    parser.add_argument('--fps', type=float, default=0, help="input fps per track (default: source fps)")
+    parser.add_argument('--tracks', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per configuration")
+    parser.add_argument('--intervals', type=_int_list, default=[1, 2, 4])
+    parser.add_argument('--imgsz', type=_int_list, default=[320, 640])
+    parser.add_argument('--batch', type=_int_list, default=[1, 4])
+    parser.add_argument('--model', default=os.getenv('YOLO_MODEL_PATH', os.path.join(REPO_ROOT, 'models', 'best.pt')),
+                        help="model for --bot yolo")
+    parser.add_argument('--models-dir', default=os.getenv('MODELS_DIR', 'models2'), help="models for --bot ai")
+    parser.add_argument('--json', help="write all results to this file")
+    asyncio.run(main(parser.parse_args()))
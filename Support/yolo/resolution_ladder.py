@@ -0,0 +1,108 @@
+# resolution_ladder.py - 依推理延遲在一組推理尺寸之間自動切換（負載高時降解析度，有餘裕時升回）
+import logging
+import threading
+import time
+
+
+def parse_ladder(spec: str, default: int):
+    """解析 '640,480,320' 形式的尺寸列表；空字串回傳 [default]"""
+    if not spec or not spec.strip():
+        return [default]
+    sizes = [int(s) for s in spec.split(',') if s.strip()]
+    for size in sizes:
+        if size <= 0 or size % 32:
+            raise ValueError(f"Inference size must be a positive multiple of 32, got {size}")
+    return sizes
+
+
+class ResolutionLadder:
+    """
+    sizes 由大到小排列，從最大的尺寸開始。
+    每次推理回報耗時（EMA 平滑）：超過 budget 就降一級；
+    依面積比例預估升一級後的耗時，低於 budget * headroom 才升回，避免在兩級之間來回跳動。
+    切換後 cooldown 秒內不再切換，讓新尺寸的量測穩定下來。
+    """
+
+    def __init__(self, sizes, budget: float, headroom: float = 0.7, smoothing: float = 0.3,
+                 cooldown: float = 3.0):
+        self.sizes = sorted(set(sizes), reverse=True)
+        self.budget = budget
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+        self.index = 0
+        self.switches = 0
+        self.time_at = {size: 0.0 for size in self.sizes}
+        self.inferences = {size: 0 for size in self.sizes}
+        self._latency = None
+        self._changed_at = None
+        self._last_tick = None
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return self.sizes[self.index]
+
+    @property
+    def adaptive(self) -> bool:
+        return len(self.sizes) > 1 and self.budget > 0
+
+    def _tick(self, now):
+        """把上次結算到現在的時間記到目前的尺寸"""
+        if self._last_tick is not None:
+            self.time_at[self.size] += now - self._last_tick
+        self._last_tick = now
+
+    def record(self, seconds: float, size: int = None, now: float = None):
+        """
+        回報一次推理耗時（秒）；size 為這次推理實際使用的尺寸（預設為目前尺寸）。
+        回傳之後應使用的尺寸。
+        """
+        now = time.monotonic() if now is None else now
+        size = self.size if size is None else size
+        with self._lock:
+            self._tick(now)
+            if size in self.inferences:
+                self.inferences[size] += 1
+            # 切換前送出的批次可能晚一點才回來，不能拿來估計新尺寸的耗時
+            if size != self.size or not self.adaptive:
+                return self.size
+            self._latency = seconds if self._latency is None else \
+                self._latency + self.smoothing * (seconds - self._latency)
+            if self._changed_at is not None and now - self._changed_at < self.cooldown:
+                return self.size
+
+            if self._latency > self.budget and self.index < len(self.sizes) - 1:
+                self._switch(self.index + 1, now)
+            elif self.index > 0:
+                # 推理耗時大致與輸入面積成正比
+                predicted = self._latency * (self.sizes[self.index - 1] / self.size) ** 2
+                if predicted < self.budget * self.headroom:
+                    self._switch(self.index - 1, now)
+            return self.size
+
+    def _switch(self, index, now):
+        old = self.size
+        self.index = index
+        self.switches += 1
+        self._changed_at = now
+        logging.info(f"Inference size {old} -> {self.size} "
+                     f"(latency={self._latency * 1000:.0f}ms, budget={self.budget * 1000:.0f}ms)")
+        self._latency = None
+
+    def stats(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._tick(now)
+            total = sum(self.time_at.values())
+            return {
+                'size': self.size,
+                'sizes': self.sizes,
+                'budgetMs': round(self.budget * 1000),
+                'latencyMs': round(self._latency * 1000, 1) if self._latency is not None else None,
+                'switches': self.switches,
+                'timeAt': {str(size): {'seconds': round(self.time_at[size], 1),
+                                       'share': round(self.time_at[size] / total, 3) if total else 0.0,
+                                       'inferences': self.inferences[size]}
+                           for size in self.sizes},
+            }
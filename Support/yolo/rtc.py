@@ -4,10 +4,8 @@ import asyncio
 import subprocess
 import threading
 import time
-import cv2
 import logging
 import argparse
-import numpy as np
 
 from ultralytics import YOLO
 from dotenv import load_dotenv
@@ -17,6 +15,13 @@ from livekit import api
 from livekit.api.ingress_service import CreateIngressRequest, ListIngressRequest
 from livekit.api.twirp_client import TwirpError
 
+from ffmpeg_feeder import FFmpegFeeder
+from frame_exchange import FrameExchange, Pacer
+from frame_source import open_source
+from overlay import OverlayRenderer, result_detections
+from preview import Preview
+from resolution_ladder import ResolutionLadder, parse_ladder
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
 logger = logging.getLogger("rtmp-publisher")
 
@@ -25,6 +30,8 @@ DEFAULT_ROOM = "my-room"
 DEFAULT_PARTICIPANT_IDENTITY = "rtmp-participant"
 DEFAULT_PARTICIPANT_NAME = "RTMP Ingress Participant"
 DEFAULT_INGRESS_NAME = "my-rtmp-ingress"
+DEFAULT_IMGSZ_LADDER = "960,640,480,320"  # 推理尺寸（與串流解析度無關），依延遲自動切換
+STATS_LOG_INTERVAL = 30  # 每隔幾秒把各尺寸的使用時間、偵測延遲與略過的推理次數寫進日誌
 
 # 加载环境变量
 load_dotenv('development.env')
@@ -92,126 +99,209 @@ async def get_or_create_rtmp_ingress(name: str, room_name: str,
     await lkapi.aclose()
     return ingress_info
 
-def run_yolo_ffmpeg_loop(rtmp_url: str, camera_index: int, width: int, height: int, fps: int, model_path: str):
+def run_yolo_ffmpeg_loop(rtmp_url: str, camera_index, width: int, height: int, fps: int, model_path: str,
+                         imgsz_ladder: str = DEFAULT_IMGSZ_LADDER, infer_budget_ms: float = 0,
+                         pipe_i420: bool = True, output_backend: str = "ffmpeg", preview: str = "off"):
     """
-    Process camera frames with YOLO and stream them via FFmpeg over RTMP.
-    Every frame is resized to the desired resolution (e.g. 1920x1080) for high-quality output.
+    Stream camera frames via FFmpeg over RTMP at the camera rate, with YOLO running asynchronously.
+    Every frame is resized to the desired resolution (e.g. 1920x1080) for high-quality output, and
+    the most recent detections are overlaid on it; inference only ever sees the newest frame.
+    Inference runs at a size picked from imgsz_ladder: it steps down when inference exceeds
+    infer_budget_ms (default: one frame period) and back up when there is headroom.
+    Frames reach FFmpeg through a feeder thread with a small drop-oldest queue, so a stalled
+    RTMP link never blocks capture or inference; pipe_i420 halves the bytes piped per frame.
+    output_backend="pyav" encodes in-process instead of piping to an ffmpeg subprocess, and
+    reconnects the RTMP output on failure without stopping capture.
+    preview ("off", "window" or "http[:port]") shows a downscaled, rate-capped local preview from
+    its own thread; the streaming loop never waits on GUI events.
+    camera_index may also be a frame_source spec (video file, ESP32-CAM http:// URL or synthetic[:N]),
+    so the loop can run without a webcam; the stream stops when a finite source ends.
     """
     logger.info(f"Starting RTMP stream to: {rtmp_url}")
     model = YOLO(model_path)
     logger.info(f"YOLO model loaded: {model_path}")
+    overlay = OverlayRenderer(model.names)
+    ladder = ResolutionLadder(parse_ladder(imgsz_ladder, 640), (infer_budget_ms or 1000.0 / fps) / 1000)
+    logger.info(f"Inference sizes: {ladder.sizes}, budget {ladder.budget * 1000:.0f}ms")
 
-    cap = cv2.VideoCapture(camera_index)
     # Force the camera frame to the desired resolution (even if it means upscaling)
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-    cap.set(cv2.CAP_PROP_FPS, fps)
+    cap = open_source(camera_index, width, height, fps)
 
     if not cap.isOpened():
-        logger.error(f"Failed to open camera index={camera_index}")
+        logger.error(f"Failed to open source {camera_index}")
         return
 
     # Use desired resolution for FFmpeg output
     logger.info(f"Camera set to: {width}x{height}, target FPS: {fps}")
 
-    ffmpeg_cmd = [
-        "ffmpeg",
-        "-y",
-        "-f", "rawvideo",
-        "-pix_fmt", "bgr24",
-        "-s", f"{width}x{height}",
-        "-r", str(fps),
-        "-i", "-",
-        "-c:v", "libx264",
-        "-preset", "veryfast",
-        "-tune", "zerolatency",
-        "-pix_fmt", "yuv420p",
-        "-g", str(fps),
-        "-keyint_min", str(fps),
-        "-b:v", "5000k",
-        "-f", "flv",
-        rtmp_url
-    ]
-    logger.info("FFmpeg command: " + " ".join(ffmpeg_cmd))
+    process = None
+    if output_backend == "pyav":
+        from av_output import AVOutput
+        feeder = AVOutput(rtmp_url, width, height, fps, bitrate="5000k", gop=fps, preset="veryfast", i420=pipe_i420)
+        logger.info("Encoding in-process with PyAV")
+    else:
+        ffmpeg_cmd = [
+            "ffmpeg",
+            "-y",
+            "-f", "rawvideo",
+            "-pix_fmt", "yuv420p" if pipe_i420 else "bgr24",
+            "-s", f"{width}x{height}",
+            "-r", str(fps),
+            "-i", "-",
+            "-c:v", "libx264",
+            "-preset", "veryfast",
+            "-tune", "zerolatency",
+            "-pix_fmt", "yuv420p",
+            "-g", str(fps),
+            "-keyint_min", str(fps),
+            "-b:v", "5000k",
+            "-f", "flv",
+            rtmp_url
+        ]
+        logger.info("FFmpeg command: " + " ".join(ffmpeg_cmd))
 
-    process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-    lock = threading.Lock()
-    latest_frame = None
+        # stderr is not read, so don't pipe it: a full stderr pipe would stall FFmpeg
+        process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+        feeder = FFmpegFeeder(lambda: process, width, height, i420=pipe_i420, stall_threshold=1.0 / fps)
+    # One capture thread fills a preallocated buffer pool at camera rate; inference and streaming
+    # each read the latest frame from it on their own schedule (no per-frame copy, no spinning).
+    exchange = FrameExchange((height, width, 3), readers=2)
+    inference_reader = exchange.reader('inference')
+    stream_reader = exchange.reader('stream')
     stop_flag = False
-    display_enabled = True  # Enable local display by default
+    local_preview = Preview.from_spec(preview, "YOLO Processed")
+    inference_count = 0
 
-    def yolo_thread():
-        nonlocal latest_frame, stop_flag, display_enabled
+    def capture_thread():
         while not stop_flag:
-            ret, frame = cap.read()
-            if not ret:
+            # Read straight into a free buffer and flip it horizontally in place;
+            # frames of another size are resized to the streaming resolution (e.g. 1920x1080).
+            if not exchange.capture(cap, flip=1):
+                if cap.ended:
+                    logger.info(f"Source ended: {cap.stats()}")
+                    break
                 logger.warning("Failed to read from camera")
                 time.sleep(0.01)
-                continue
+        exchange.close()
 
-            # Flip the frame horizontally
-            frame = cv2.flip(frame, 1)
-            # Resize to desired resolution (e.g. 1920x1080)
-            frame_resized = cv2.resize(frame, (width, height))
+    def yolo_thread():
+        nonlocal inference_count
+        while not stop_flag:
+            # Always infer on the newest frame; frames captured meanwhile are skipped
+            # (inference reader's "dropped" count).
+            frame = inference_reader.get(timeout=1.0)
+            if frame is None:
+                continue
             try:
-                # YOLO inference using the resized frame with imgsz set to the desired resolution.
-                result = model(frame_resized, imgsz=(width, height))
-                annotated = result[0].plot()  # Annotated frame (BGR)
-                annotated = np.clip(annotated, 0, 255).astype(np.uint8)
-                # Do NOT resize back; keep the inference resolution.
+                # YOLO inference at the ladder's current size; Ultralytics letterboxes internally and
+                # returns normalized boxes, so the overlay stays aligned at every size.
+                size = ladder.size
+                start = time.monotonic()
+                result = model(frame.array, imgsz=size, verbose=False)
+                ladder.record(time.monotonic() - start, size)
+                overlay.update(result_detections(result[0]))
+                inference_count += 1
             except Exception as e:
                 logger.error(f"YOLO processing error: {e}")
-                annotated = frame_resized
-
-            if display_enabled:
-                try:
-                    cv2.imshow("YOLO Processed", annotated)
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        stop_flag = True
-                        break
-                except cv2.error as e:
-                    logger.error(f"cv2.imshow/waitKey error: {e}")
-                    display_enabled = False
+            finally:
+                frame.release()
+        logger.info(f"YOLO thread finished, inference size stats: {ladder.stats()}")
 
-            with lock:
-                latest_frame = annotated.copy()
-        logger.info("YOLO thread finished")
+    def stream_stats(elapsed, age_sum, age_max, aged_frames):
+        inference = inference_reader.stats()
+        return {
+            'streamFps': round(stream_reader.received / elapsed, 1) if elapsed else None,
+            'inferenceFps': round(inference_count / elapsed, 1) if elapsed else None,
+            'skippedInferences': inference['dropped'],
+            'detectionAgeMs': {
+                'mean': round(age_sum / aged_frames * 1000, 1) if aged_frames else None,
+                'max': round(age_max * 1000, 1) if aged_frames else None,
+            },
+            'exchange': exchange.stats(),
+            'feeder': feeder.stats(),
+        }
 
-    t = threading.Thread(target=yolo_thread, daemon=True)
-    t.start()
+    threads = [threading.Thread(target=capture_thread, daemon=True),
+               threading.Thread(target=yolo_thread, daemon=True)]
+    for t in threads:
+        t.start()
 
+    pacer = Pacer(fps)
+    started = last_stats_log = time.monotonic()
+    age_sum = age_max = 0.0
+    aged_frames = 0
     try:
-        while True:
-            with lock:
-                if latest_frame is None:
-                    continue
-                frame_to_send = latest_frame
-            try:
-                process.stdin.write(frame_to_send.tobytes())
-                process.stdin.flush()
-            except BrokenPipeError:
+        while not stop_flag:
+            # Stream fresh camera frames at the camera rate, independent of inference speed;
+            # the camera frame is re-sent only when the camera itself is late (counted as duplicated).
+            pacer.wait()
+            frame = stream_reader.get(wait=False) or stream_reader.get(timeout=1.0)
+            if frame is None:
+                if exchange.closed:
+                    break  # capture stopped (a finite source ended)
+                continue
+            # Pool buffers are shared with the inference thread, so the overlay is drawn on the copies
+            # the preview and the feeder take anyway (same detections on both), not on a private one
+            captured_at = frame.timestamp
+            detections = overlay.latest
+            age = overlay.age
+            if age is not None:
+                age_sum += age
+                age_max = max(age_max, age)
+                aged_frames += 1
+
+            def draw(image):
+                overlay.draw(image, detections)
+
+            local_preview.submit(frame.array, draw)
+            # Queued for the feeder thread; it stops (and submit fails) once the FFmpeg pipe breaks
+            sent = feeder.submit(frame.array, captured_at, draw)
+            frame.release()
+            if local_preview.quit_requested:
+                break
+            if not sent:
                 logger.error("FFmpeg pipe broken, stopping stream")
                 break
-            time.sleep(1.0 / fps)
+
+            if time.monotonic() - last_stats_log >= STATS_LOG_INTERVAL:
+                logger.info(f"Inference size stats: {ladder.stats()}")
+                logger.info(f"Stream stats: {stream_stats(time.monotonic() - started, age_sum, age_max, aged_frames)}")
+                last_stats_log = time.monotonic()
     except KeyboardInterrupt:
         logger.info("User interrupted")
     finally:
         stop_flag = True
-        t.join()
+        exchange.close()
+        for t in threads:
+            t.join()
+        feeder.close()
+        logger.info(f"Stream stats: {stream_stats(time.monotonic() - started, age_sum, age_max, aged_frames)}")
         cap.release()
-        cv2.destroyAllWindows()
-        if process.stdin:
-            process.stdin.close()
-        process.wait()
-        logger.info("Process finished, FFmpeg closed")
+        local_preview.close()
+        if process is not None:
+            if process.stdin:
+                process.stdin.close()
+            process.wait()
+        logger.info("Process finished, output closed")
 
 async def main():
     parser = argparse.ArgumentParser(description="RTMP streaming to LiveKit Ingress (YOLO + FFmpeg)")
-    parser.add_argument("--camera", type=int, default=0, help="Camera index")
+    parser.add_argument("--camera", type=str, default="0",
+                        help="Camera index, ESP32-CAM http://.../stream URL, video file or synthetic[:frames]")
     parser.add_argument("--width", type=int, default=1920, help="Desired streaming width (e.g. 1920 for 1080p)")
     parser.add_argument("--height", type=int, default=1080, help="Desired streaming height (e.g. 1080 for 1080p)")
     parser.add_argument("--fps", type=int, default=15, help="Target FPS")
     parser.add_argument("--model", type=str, default="models/best.pt", help="YOLO model path")
+    parser.add_argument("--imgsz-ladder", type=str, default=DEFAULT_IMGSZ_LADDER,
+                        help="Comma-separated inference sizes, largest first (e.g. 960,640,480,320)")
+    parser.add_argument("--infer-budget-ms", type=float, default=0,
+                        help="Inference latency budget before stepping down (default: one frame period)")
+    parser.add_argument("--pipe-pix-fmt", choices=["yuv420p", "bgr24"], default="yuv420p",
+                        help="Raw format piped into FFmpeg (yuv420p is half the bytes of bgr24)")
+    parser.add_argument("--output-backend", choices=["ffmpeg", "pyav"], default="ffmpeg",
+                        help="ffmpeg subprocess fed through a pipe, or in-process PyAV encoding")
+    parser.add_argument("--preview", type=str, default=os.getenv("PREVIEW", "off"),
+                        help="Local preview: off, window or http[:port] (downscaled, from its own thread)")
     parser.add_argument("--room", type=str, default=DEFAULT_ROOM, help="LiveKit room name")
     parser.add_argument("--participant-identity", type=str, default=DEFAULT_PARTICIPANT_IDENTITY, help="Ingress connection identity")
     parser.add_argument("--participant-name", type=str, default=DEFAULT_PARTICIPANT_NAME, help="Ingress display name")
@@ -249,7 +339,12 @@ async def main():
         width=args.width,
         height=args.height,
         fps=args.fps,
-        model_path=args.model
+        model_path=args.model,
+        imgsz_ladder=args.imgsz_ladder,
+        infer_budget_ms=args.infer_budget_ms,
+        pipe_i420=args.pipe_pix_fmt == "yuv420p",
+        output_backend=args.output_backend,
+        preview=args.preview
     )
 
 if __name__ == "__main__":
@@ -1,20 +1,27 @@
+import os
 import cv2
 import time
+import numpy as np
 import threading
 import subprocess
 from ultralytics import YOLO
 
+from frame_exchange import FrameExchange, Pacer
+from frame_source import open_source
+from overlay import OverlayRenderer, result_detections
+from preview import Preview
+
 # 載入 YOLO 模型
 model = YOLO("models/best.pt")
+# 推理執行緒更新偵測結果，推流迴圈把最新結果畫在最新的畫面上
+overlay = OverlayRenderer(model.names)
 
-# 開啟攝影機
-cap = cv2.VideoCapture(1)
+# 開啟攝影機（FRAME_SOURCE 可改成影片檔、ESP32-CAM 網址或 synthetic，見 frame_source.py）
+cap = open_source(os.getenv("FRAME_SOURCE", "1"), 640, 480)
 if not cap.isOpened():
     print("無法開啟攝影機")
     exit()
 
-cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
 width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
 height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 target_fps = 15
@@ -56,40 +63,39 @@ ffmpeg_cmd = [
 process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
 print(f"已啟動推流到 Janus: {output_url}")
 
-# 全域變數與鎖
-latest_raw_frame = None
-latest_processed_frame = None
-lock = threading.Lock()
+# 幀交換：攝影機直接讀進預先配置的緩衝區，推理與推流各自取最新幀（不複製、不忙等）
+exchange = FrameExchange((height, width, 3), readers=2)
+STATS_INTERVAL = 10  # 每隔幾秒印出丟幀 / 重複幀統計
+preview = Preview.from_env("YOLO Processed Frame")
 
-# 捕獲線程
+# 捕獲線程（cap.read() 本身會等下一幀，鏡像翻轉直接在緩衝區內完成）
 def capture_thread():
-    global latest_raw_frame
-    while True:
-        ret, frame = cap.read()
-        if ret:
-            frame = cv2.flip(frame, 1)
-            with lock:
-                latest_raw_frame = frame.copy()
-        time.sleep(0.005)
+    while not exchange.closed:
+        if not exchange.capture(cap, flip=1):
+            if cap.ended:
+                exchange.close()  # 影片檔 / synthetic:N 讀完，結束推流
+                break
+            time.sleep(0.01)
 
-# YOLO 處理線程
+# YOLO 處理線程：只更新偵測結果，不產生標註後的畫面
 def processing_thread():
-    global latest_raw_frame, latest_processed_frame
-    interval = 0.03
-    while True:
-        with lock:
-            if latest_raw_frame is None:
-                continue
-            frame_for_infer = latest_raw_frame.copy()
+    interval = 0.03  # 兩次推理之間的最短間隔
+    reader = exchange.reader('inference')
+    while not exchange.closed:
+        start = time.monotonic()
+        # 等到有比上次更新的幀才推理
+        frame = reader.get(timeout=1.0)
+        if frame is None:
+            continue
         try:
-            results = model(frame_for_infer)
-            processed = results[0].plot()
+            results = model(frame.array, verbose=False)
+            overlay.update(result_detections(results[0]))
         except Exception as e:
             print("YOLO 處理錯誤:", e)
-            processed = frame_for_infer
-        with lock:
-            latest_processed_frame = processed.copy()
-        time.sleep(interval)
+        frame.release()
+        remaining = interval - (time.monotonic() - start)
+        if remaining > 0:
+            time.sleep(remaining)
 
 t_cap = threading.Thread(target=capture_thread, daemon=True)
 t_proc = threading.Thread(target=processing_thread, daemon=True)
@@ -97,30 +103,47 @@ t_cap.start()
 t_proc.start()
 
 # 主推流迴圈
+stream_reader = exchange.reader('stream')
+frame_to_send = np.empty((height, width, 3), dtype=np.uint8)
+pacer = Pacer(target_fps)
+last_stats_time = time.monotonic()
 try:
     while True:
-        with lock:
-            if latest_processed_frame is None:
-                continue
-            frame_to_send = latest_processed_frame.copy()
+        # 固定以 target_fps 推流；攝影機較慢時重送最新幀（計入 duplicated）
+        pacer.wait()
+        frame = stream_reader.get(wait=False) or stream_reader.get(timeout=1.0)
+        if frame is None:
+            if exchange.closed:
+                break
+            continue
+        # 共用緩衝區不能畫，複製到推流專用的緩衝區後疊加最新一次的偵測結果
+        # （這裡直接同步寫進 FFmpeg 的 stdin，沒有送幀佇列可以借用，所以保留這一次複製）
+        np.copyto(frame_to_send, frame.array)
+        frame.release()
+        overlay.draw(frame_to_send)
 
-        cv2.imshow("YOLO Processed Frame", frame_to_send)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        # 本地預覽（PREVIEW=window 或 http，預設關閉）在自己的執行緒顯示，不會卡住推流
+        preview.submit(frame_to_send)
+        if preview.quit_requested:
             break
 
         try:
-            process.stdin.write(frame_to_send.tobytes())
+            process.stdin.write(frame_to_send.data)  # 直接寫緩衝區，不再經 tobytes() 多複製一次
             process.stdin.flush()
         except BrokenPipeError as e:
             print("FFmpeg 管道錯誤:", e)
             break
 
-        time.sleep(1.0 / target_fps)
+        if time.monotonic() - last_stats_time >= STATS_INTERVAL:
+            print("幀交換統計:", exchange.stats())
+            last_stats_time = time.monotonic()
 except KeyboardInterrupt:
     print("使用者中斷")
 finally:
+    exchange.close()
+    print("幀交換統計:", exchange.stats())
     cap.release()
     process.stdin.close()
     process.wait()
-    cv2.destroyAllWindows()
+    preview.close()
     print("程序已結束")
\ No newline at end of file
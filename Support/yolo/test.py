@@ -1,18 +1,27 @@
+import os
 import cv2
 import time
 import threading
 import subprocess
 from ultralytics import YOLO
 
+from ffmpeg_feeder import FFmpegFeeder
+from frame_exchange import FrameExchange, Pacer
+from frame_source import open_source
+from overlay import OverlayRenderer, result_detections
+from preview import Preview
+
 # --------------------
 # 1. 載入 YOLO 模型
 # --------------------
 model = YOLO("models/best.pt")
+# 推論線程更新偵測結果，推流迴圈把最新結果畫在最新的畫面上
+overlay = OverlayRenderer(model.names)
 
 # --------------------
-# 2. 開啟攝影機
+# 2. 開啟攝影機（FRAME_SOURCE 可改成影片檔、ESP32-CAM 網址或 synthetic，見 frame_source.py）
 # --------------------
-cap = cv2.VideoCapture(0)
+cap = open_source(os.getenv("FRAME_SOURCE", "0"))
 if not cap.isOpened():
     print("無法開啟攝影機")
     exit()
@@ -29,6 +38,10 @@ print(f"攝影機解析度：{width}x{height}, FPS: {fps}")
 # 3. 設定 RTMP 推流參數 (低延遲優化)
 # --------------------
 rtmp_url = "rtmp://178.128.54.195/live/stream"
+# 送進 FFmpeg 前先轉成 I420（每幀 bytes 減半）；False 則送 bgr24
+PIPE_I420 = True
+# "ffmpeg"：子行程 + 管道；"pyav"：行程內編碼（參數同下方命令，斷線時只重連輸出）
+OUTPUT_BACKEND = "ffmpeg"
 
 # 建議嘗試更低解析度 (640x360 or 960x540) & 更低碼率 以減少卡頓
 # 可嘗試修改 -s, -maxrate, -bufsize, -g (GOP), -preset ultrafast ...
@@ -38,7 +51,7 @@ ffmpeg_cmd = [
     "-y",
     "-f", "rawvideo",
     "-vcodec", "rawvideo",
-    "-pix_fmt", "bgr24",
+    "-pix_fmt", "yuv420p" if PIPE_I420 else "bgr24",
     "-s", f"{width}x{height}",
     "-r", str(fps),
     "-i", "-",
@@ -53,55 +66,63 @@ ffmpeg_cmd = [
     rtmp_url
 ]
 
-process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
+# 送幀執行緒：推流卡住時只會丟掉佇列中最舊的幀，不會卡住推流迴圈
+if OUTPUT_BACKEND == "pyav":
+    from av_output import AVOutput
+    process = None
+    feeder = AVOutput(rtmp_url, width, height, int(fps), bitrate="1500k", bufsize="800k",
+                      gop=15, preset="veryfast", i420=PIPE_I420)
+else:
+    process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, bufsize=0)
+    feeder = FFmpegFeeder(lambda: process, width, height, i420=PIPE_I420, stall_threshold=1.0 / fps)
 print("開始推流到 RTMP 伺服器...")
 
 # --------------------
-# 4. 全局變數與鎖
+# 4. 幀交換：攝影機直接讀進預先配置的緩衝區，推論與推流各自取最新幀（不複製、不忙等）
 # --------------------
-latest_raw_frame = None
-latest_processed_frame = None
-lock = threading.Lock()
+exchange = FrameExchange((height, width, 3), readers=2)
+STATS_INTERVAL = 10  # 每隔幾秒印出丟幀 / 重複幀統計
+# 本地預覽預設關閉（PREVIEW=window 或 http），開啟時在自己的執行緒以低幀率顯示縮小的畫面
+preview = Preview.from_env("Processed Frame")
 
 # --------------------
 # 5. 捕獲線程
 # --------------------
 def capture_thread():
-    global latest_raw_frame
-    while True:
-        ret, frame = cap.read()
-        if ret:
-            with lock:
-                latest_raw_frame = frame.copy()
-        # 保持較高頻讀取
-        time.sleep(0.005)
+    # cap.read() 本身會等下一幀，不需要額外 sleep
+    while not exchange.closed:
+        if not exchange.capture(cap):
+            if cap.ended:
+                exchange.close()  # 影片檔 / synthetic:N 讀完，結束推流
+                break
+            time.sleep(0.01)
 
 # --------------------
 # 6. YOLO 推論線程
 # --------------------
 def processing_thread():
-    global latest_raw_frame, latest_processed_frame
-    # 一次 YOLO 推論時間若很快，可提升頻率；若CPU較大負載，可放慢一點
+    # 兩次推論之間至少間隔 yolo_interval 秒；若CPU較大負載，可放慢一點
     # 例如 0.05 (約20FPS) or 0.1 (10FPS)
     yolo_interval = 0.06
+    reader = exchange.reader('inference')
+
+    while not exchange.closed:
+        start = time.monotonic()
+        # 等到有比上次更新的幀才推論
+        frame = reader.get(timeout=1.0)
+        if frame is None:
+            continue
+        try:
+            results = model(frame.array, verbose=False)
+            # 只更新偵測結果，不產生標註後的畫面
+            overlay.update(result_detections(results[0]))
+        except Exception as e:
+            print("推論錯誤:", e)
+        frame.release()
 
-    while True:
-        frame_for_infer = None
-        with lock:
-            if latest_raw_frame is not None:
-                frame_for_infer = latest_raw_frame.copy()
-
-        if frame_for_infer is not None:
-            try:
-                results = model(frame_for_infer)
-                processed = results[0].plot()
-            except Exception as e:
-                print("推論錯誤:", e)
-                processed = frame_for_infer
-            with lock:
-                latest_processed_frame = processed.copy()
-
-        time.sleep(yolo_interval)
+        remaining = yolo_interval - (time.monotonic() - start)
+        if remaining > 0:
+            time.sleep(remaining)
 
 # --------------------
 # 7. 啟動線程
@@ -114,27 +135,41 @@ t_proc.start()
 # --------------------
 # 8. 主推流迴圈
 # --------------------
+stream_reader = exchange.reader('stream')
+pacer = Pacer(fps)
+last_stats_time = time.monotonic()
 try:
     while True:
-        with lock:
-            if latest_processed_frame is None:
-                continue
-            frame_to_send = latest_processed_frame.copy()
-
-        # 本地顯示
-        cv2.imshow("Processed Frame", frame_to_send)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        # 推流帧率與攝影機 fps 同步；攝影機較慢時重送最新幀（計入 duplicated）
+        pacer.wait()
+        frame = stream_reader.get(wait=False) or stream_reader.get(timeout=1.0)
+        if frame is None:
+            if exchange.closed:
+                break
+            continue
+        # 共用緩衝區不能畫：預覽與送幀各自把它複製進自己的緩衝區後，才在複本上疊加最新一次的偵測結果
+        captured_at = frame.timestamp  # 來源的擷取時間，送幀統計以它計算延遲
+        detections = overlay.latest
+
+        def draw(image):
+            overlay.draw(image, detections)
+
+        # 本地顯示（不會等待視窗事件）
+        preview.submit(frame.array, draw)
+
+        # 將影像送進 FFmpeg（交給送幀執行緒；管道斷掉後送幀執行緒會停止）
+        sent = feeder.submit(frame.array, captured_at, draw)
+        frame.release()
+        if preview.quit_requested:
             break
-
-        # 將影像送進 FFmpeg
-        try:
-            process.stdin.write(frame_to_send.tobytes())
-        except BrokenPipeError as e:
-            print("FFmpeg 輸出錯誤:", e)
+        if not sent:
+            print("FFmpeg 輸出錯誤，停止推流")
             break
 
-        # 推流帧率與攝影機 fps 同步
-        time.sleep(1.0 / fps)
+        if time.monotonic() - last_stats_time >= STATS_INTERVAL:
+            print("幀交換統計:", exchange.stats())
+            print("送幀統計:", feeder.stats())
+            last_stats_time = time.monotonic()
 
 except KeyboardInterrupt:
     pass
@@ -142,7 +177,12 @@ except KeyboardInterrupt:
 # --------------------
 # 9. 收尾
 # --------------------
+exchange.close()
+feeder.close()
+print("幀交換統計:", exchange.stats())
+print("送幀統計:", feeder.stats())
 cap.release()
-process.stdin.close()
-process.wait()
-cv2.destroyAllWindows()
+if process is not None:
+    process.stdin.close()
+    process.wait()
+preview.close()
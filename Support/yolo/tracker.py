@@ -0,0 +1,156 @@
+# tracker.py - 輕量多目標追蹤（IoU / 中心點距離）與差量發布
+import time
+
+
+def iou(a, b):
+    """兩個 [x, y, w, h] 正規化框的 IoU"""
+    ax2, ay2 = a[0] + a[2], a[1] + a[3]
+    bx2, by2 = b[0] + b[2], b[1] + b[3]
+    iw = min(ax2, bx2) - max(a[0], b[0])
+    ih = min(ay2, by2) - max(a[1], b[1])
+    if iw <= 0 or ih <= 0:
+        return 0.0
+    inter = iw * ih
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def centroid_distance(a, b):
+    dx = (a[0] + a[2] / 2) - (b[0] + b[2] / 2)
+    dy = (a[1] + a[3] / 2) - (b[1] + b[3] / 2)
+    return (dx * dx + dy * dy) ** 0.5
+
+
+class Track:
+    __slots__ = ('id', 'label', 'confidence', 'box', 'missed')
+
+    def __init__(self, track_id, det):
+        self.id = track_id
+        self.label = det['label']
+        self.confidence = det['confidence']
+        self.box = list(det['box'])
+        self.missed = 0
+
+    def to_dict(self):
+        return {'id': self.id, 'label': self.label, 'confidence': self.confidence, 'box': self.box}
+
+
+class IoUTracker:
+    """
+    以貪婪法配對前後幀的偵測框，給予持續的 track id。
+    同類別才會配對；IoU 不足時改看中心點距離（快速移動的小物件）。
+    連續 max_missed 次沒配對到才視為消失，避免偵測閃爍造成 id 跳動。
+    """
+
+    def __init__(self, iou_threshold: float = 0.3, max_distance: float = 0.1, max_missed: int = 3):
+        self.iou_threshold = iou_threshold
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.tracks = {}
+        self._next_id = 1
+
+    def _score(self, track, det):
+        if track.label != det['label']:
+            return 0.0
+        overlap = iou(track.box, det['box'])
+        if overlap >= self.iou_threshold:
+            return 1.0 + overlap
+        distance = centroid_distance(track.box, det['box'])
+        if distance <= self.max_distance:
+            return 1.0 - distance / self.max_distance
+        return 0.0
+
+    def update(self, detections):
+        """
+        輸入本幀偵測結果，回傳 (本幀看到的 tracks, 本幀移除的 track ids)
+        """
+        pairs = []
+        for track in self.tracks.values():
+            for i, det in enumerate(detections):
+                score = self._score(track, det)
+                if score > 0.0:
+                    pairs.append((score, track.id, i))
+        pairs.sort(reverse=True)
+
+        matched_tracks, matched_dets = set(), set()
+        for _, track_id, i in pairs:
+            if track_id in matched_tracks or i in matched_dets:
+                continue
+            track = self.tracks[track_id]
+            det = detections[i]
+            track.box = list(det['box'])
+            track.confidence = det['confidence']
+            track.missed = 0
+            matched_tracks.add(track_id)
+            matched_dets.add(i)
+
+        for i, det in enumerate(detections):
+            if i not in matched_dets:
+                track = Track(self._next_id, det)
+                self._next_id += 1
+                self.tracks[track.id] = track
+                matched_tracks.add(track.id)
+
+        lost = []
+        for track_id, track in list(self.tracks.items()):
+            if track_id in matched_tracks:
+                continue
+            track.missed += 1
+            if track.missed > self.max_missed:
+                del self.tracks[track_id]
+                lost.append(track_id)
+
+        visible = [t for t in self.tracks.values() if t.missed == 0]
+        return visible, lost
+
+    def reset(self):
+        self.tracks.clear()
+
+
+class DeltaPublisher:
+    """
+    只發布變化：新出現 (new)、移動超過門檻 (moved)、消失 (lost)，
+    並每隔 keyframe_interval 秒送一次完整清單 (keyframe) 讓新加入的觀看端同步。
+    沒有任何變化時回傳 None，不發送。
+    """
+
+    def __init__(self, move_threshold: float = 0.02, keyframe_interval: float = 1.0):
+        self.move_threshold = move_threshold
+        self.keyframe_interval = keyframe_interval
+        self._published = {}
+        self._last_keyframe = None
+
+    def _moved(self, track):
+        old = self._published[track.id]
+        return max(abs(a - b) for a, b in zip(old, track.box)) > self.move_threshold
+
+    def update(self, tracks, lost_ids, now: float = None):
+        now = time.monotonic() if now is None else now
+
+        if self._last_keyframe is None or now - self._last_keyframe >= self.keyframe_interval:
+            self._last_keyframe = now
+            if not tracks and not self._published:
+                return None
+            self._published = {t.id: list(t.box) for t in tracks}
+            return {'keyframe': True, 'tracks': [t.to_dict() for t in tracks]}
+
+        new = [t for t in tracks if t.id not in self._published]
+        moved = [t for t in tracks if t.id in self._published and self._moved(t)]
+        lost = [i for i in lost_ids if i in self._published]
+        if not (new or moved or lost):
+            return None
+
+        for t in new + moved:
+            self._published[t.id] = list(t.box)
+        for i in lost:
+            del self._published[i]
+        return {
+            'keyframe': False,
+            'new': [t.to_dict() for t in new],
+            'moved': [t.to_dict() for t in moved],
+            'lost': lost
+        }
+
+    def reset(self):
+        self._published.clear()
+        self._last_keyframe = None
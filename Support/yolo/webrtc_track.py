@@ -0,0 +1,107 @@
+# webrtc_track.py - aiortc 視訊軌：recv() 只等待背景執行緒送來的幀，不在事件迴圈裡讀攝影機或跑 YOLO
+#
+# 原本的 YOLOVideoStreamTrack.recv() 直接呼叫 camera.read() 與 model(frame)，會卡住同一個事件迴圈上的 ICE / DTLS。
+# 這裡由 FanoutPipeline（擷取 + 推理 + 疊加都在背景執行緒）透過 CallbackSink 呼叫 push()：
+# I420 轉換與 VideoFrame 建立都在 sink 的執行緒完成，事件迴圈只收到做好的幀。
+# 時間戳取自擷取時的 time.monotonic()（90 kHz），不是 recv() 被呼叫的時間。
+# 多個 RTCPeerConnection 用 MediaRelay 共用同一個軌：pc.addTrack(relay.subscribe(track, buffered=False))。
+import asyncio
+import fractions
+import time
+
+from aiortc import VideoStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from av import VideoFrame
+
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+
+
+class PipelineVideoTrack(VideoStreamTrack):
+    """
+    push(frame, captured_at) 可從任何執行緒呼叫（frame 為 I420 或 BGR 的 ndarray，只在呼叫期間有效）；
+    recv() 回傳最新的一幀，還沒被取走就被新幀取代的計入 skipped。必須在事件迴圈執行中建立。
+    """
+
+    def __init__(self, i420: bool = True):
+        super().__init__()
+        self.i420 = i420
+        self._loop = asyncio.get_running_loop()
+        self._latest = None
+        self._event = asyncio.Event()
+        self._clock_start = None
+        self._last_pts = -1
+        self.pushed = 0
+        self.delivered = 0
+        self.skipped = 0
+        self.latency_sum = 0.0
+        self.max_latency = 0.0
+
+    def push(self, frame, captured_at: float):
+        """送進一幀（由 FanoutPipeline.add_callback(track.push, i420=True) 呼叫）"""
+        video_frame = VideoFrame.from_ndarray(frame, format='yuv420p' if self.i420 else 'bgr24')
+        self.pushed += 1
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, video_frame, captured_at)
+        except RuntimeError:
+            pass  # 事件迴圈已關閉
+
+    def _deliver(self, video_frame, captured_at):
+        if self._latest is not None:
+            self.skipped += 1
+        self._latest = (video_frame, captured_at)
+        self._event.set()
+
+    async def recv(self):
+        while self._latest is None:
+            if self.readyState != "live":
+                raise MediaStreamError
+            await self._event.wait()
+            self._event.clear()
+        if self.readyState != "live":
+            raise MediaStreamError
+        video_frame, captured_at = self._latest
+        self._latest = None
+
+        if self._clock_start is None:
+            self._clock_start = captured_at
+        pts = max(int((captured_at - self._clock_start) * VIDEO_CLOCK_RATE), self._last_pts + 1)
+        self._last_pts = pts
+        video_frame.pts = pts
+        video_frame.time_base = VIDEO_TIME_BASE
+
+        latency = time.monotonic() - captured_at
+        self.delivered += 1
+        self.latency_sum += latency
+        self.max_latency = max(self.max_latency, latency)
+        return video_frame
+
+    def stop(self):
+        super().stop()
+        # 叫醒等待中的 recv()，讓它拋出 MediaStreamError
+        self._event.set()
+
+    def stats(self):
+        return {
+            'pushed': self.pushed,
+            'delivered': self.delivered,
+            'skipped': self.skipped,
+            'latencyMs': {
+                'mean': round(self.latency_sum / self.delivered * 1000, 1) if self.delivered else None,
+                'max': round(self.max_latency * 1000, 1),
+            },
+        }
+
+
+def start_pipeline_track(camera_index: int, width: int, height: int, fps: int, model_path: str = None,
+                         flip: int = None, **pipeline_kwargs):
+    """
+    開啟攝影機（失敗時直接拋出）並在背景執行擷取 / 推理 / 疊加，回傳 (pipeline, track)。
+    必須在事件迴圈中呼叫；結束時先 track.stop() 再 pipeline.stop()。
+    """
+    from fanout import FanoutPipeline
+    pipeline = FanoutPipeline(camera_index, width, height, fps, model_path=model_path, flip=flip, **pipeline_kwargs)
+    track = PipelineVideoTrack(i420=True)
+    pipeline.add_callback(track.push, "webrtc", i420=True)
+    pipeline.start()
+    return pipeline, track
@@ -1,16 +1,28 @@
-# yolo_bot.py
+# yolo_bot.py（GPU 請用 yolo_bot_gpu.py，或設定 YOLO_DEVICE=0）
 import asyncio
 import json
 import logging
 import os
+import sys
+import time
 import numpy as np
 import cv2
 from livekit import rtc, api
-from ultralytics import YOLO
 from dotenv import load_dotenv
 
+# 共用模組放在 Support/yolo
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Support', 'yolo'))
+from detection_codec import DetectionSerializer
+from engine import chain_future, create_engine
+from inference_worker import BatchScheduler
+from metrics import StageMetrics
+from motion_gate import MotionGate, parse_mask
+from preprocess import I420Letterbox, livekit_i420_planes
+from resolution_ladder import ResolutionLadder, parse_ladder
+
 # --- 基本日誌設定 ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [YOLO Bot] - %(message)s')
+_LOG_TAG = 'YOLO Bot' if os.getenv('YOLO_DEVICE', 'cpu') == 'cpu' else 'YOLO Bot GPU'
+logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - %(levelname)s - [{_LOG_TAG}] - %(message)s')
 
 # --- 載入環境變數 ---
 load_dotenv()
@@ -19,65 +31,221 @@ LIVEKIT_API_KEY = os.getenv('LIVEKIT_API_KEY')
 LIVEKIT_API_SECRET = os.getenv('LIVEKIT_API_SECRET')
 ROOM_NAME = os.getenv('LIVEKIT_ROOM_NAME', 'my-room')
 MODEL_PATH = os.getenv('YOLO_MODEL_PATH', 'models/best.pt')
+# 推理裝置：'cpu' 或 GPU 編號（'0' = 第一個 GPU）
+YOLO_DEVICE = os.getenv('YOLO_DEVICE', 'cpu')
+# 推理後端：torch / onnx / onnx-int8 / onnx-int8-static（見 engine.py；ONNX 只在 CPU 節點上建議使用）
+YOLO_BACKEND = os.getenv('YOLO_BACKEND', 'torch')
+ONNX_CALIBRATION = os.getenv('ONNX_CALIBRATION')  # onnx-int8-static 的校正影像資料夾或影片
+ENGINE_CACHE_DIR = os.getenv('ENGINE_CACHE_DIR')  # 匯出的 ONNX 模型快取位置（預設為模型旁的 .engine_cache）
+# 偵測結果格式：'json'（預設，相容舊客戶端）或 'binary'（見 detection_codec.py）
+DETECTION_WIRE_FORMAT = os.getenv('DETECTION_WIRE_FORMAT', 'json')
+# 發布模式：'full'（每幀完整清單）或 'delta'（只送 new / moved / lost，定期 keyframe）
+DETECTION_PUBLISH_MODE = os.getenv('DETECTION_PUBLISH_MODE', 'full')
+# 多軌道批次推理：一次最多幾個軌道、每個軌道每秒最多推理幾次（0 = 不限）
+MAX_BATCH = int(os.getenv('MAX_BATCH', '4'))
+TRACK_MAX_FPS = float(os.getenv('TRACK_MAX_FPS', '0'))
+# 前處理：'i420'（直接從 I420 幀 letterbox 到模型輸入，不配置暫存影像）或 'bgr'（舊路徑）
+YOLO_PREPROCESS = os.getenv('YOLO_PREPROCESS', 'i420')
+YOLO_IMGSZ = int(os.getenv('YOLO_IMGSZ', '640'))
+# 推理尺寸階梯：例如 '640,480,320'，批次推理超過 INFER_BUDGET_MS 就降一級，有餘裕時升回（空 = 固定 YOLO_IMGSZ）
+YOLO_IMGSZ_LADDER = os.getenv('YOLO_IMGSZ_LADDER', '')
+INFER_BUDGET_MS = float(os.getenv('INFER_BUDGET_MS', '150'))
+# 變化偵測：變化像素比例超過 MOTION_THRESHOLD 才推理（0 = 停用），MOTION_MASK 為 'x,y,w,h;...' 正規化區域
+MOTION_THRESHOLD = float(os.getenv('MOTION_THRESHOLD', '0'))
+MOTION_MASK = os.getenv('MOTION_MASK', '')
+MOTION_MAX_STALENESS = float(os.getenv('MOTION_MAX_STALENESS', '2.0'))  # 最多沿用幾秒就強制推理
+# 各階段延遲：本機 HTTP 端點 /metrics、/metrics.json（0 = 停用），並定期把 p50/p95/p99 寫進日誌
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', '30'))
+# 多行程推理（CPU）：YOLO_WORKERS 個工作行程各自載入模型，可同時推理多個批次（0 = 在推理執行緒中推理）
+# 搭配 MAX_BATCH=1 讓各軌道分散到不同行程；YOLO_WORKER_THREADS 為每個行程的執行緒數（0 = 平分 CPU 核心）
+YOLO_WORKERS = int(os.getenv('YOLO_WORKERS', '0'))
+YOLO_WORKER_THREADS = int(os.getenv('YOLO_WORKER_THREADS', '0'))
 
 # --- Bot 的身份設定 ---
 YOLO_BOT_IDENTITY = 'yolo-bot'
-# Bot 需要訂閱的影像來源身份
-PUBLISHER_IDENTITY = 'webcam-publisher'
+# Bot 需要訂閱的影像來源身份（每支手臂一台攝影機：webcam-publisher、webcam-publisher-2 ...）
+PUBLISHER_IDENTITY_PREFIX = 'webcam-publisher'
 
 class YoloProcessor:
     def __init__(self, model_path: str):
-        self.model = YOLO(model_path)
-        logging.info(f"YOLO model loaded from {model_path}")
+        self.ladder = ResolutionLadder(parse_ladder(YOLO_IMGSZ_LADDER, YOLO_IMGSZ), INFER_BUDGET_MS / 1000)
+        # 以最大的尺寸建立引擎（ONNX 匯出為動態尺寸），各級尺寸先暖機，切換時不會卡一下
+        self.engine = create_engine(model_path, YOLO_BACKEND, device=YOLO_DEVICE, imgsz=self.ladder.sizes[0],
+                                    cache_dir=ENGINE_CACHE_DIR, calibration=ONNX_CALIBRATION,
+                                    threads=YOLO_WORKER_THREADS, workers=YOLO_WORKERS if YOLO_DEVICE == 'cpu' else 0,
+                                    max_batch=MAX_BATCH)
+        if self.ladder.adaptive:
+            for size in self.ladder.sizes:
+                self.engine.warm_up(imgsz=size)
+        logging.info(f"YOLO model loaded from {model_path} (backend={self.engine.backend}, device={YOLO_DEVICE}, "
+                     f"imgsz={self.ladder.sizes})")
+        self.model_name = os.path.basename(model_path)
+        # 每個軌道各自的追蹤 / 序列化狀態（同一軌道同時只會有一個批次在處理）
+        self.serializers = {}
+        self.frame_seq = {}
+        self.motion_gates = {}
+        self.last_detections = {}
         self.room: rtc.Room = None
-        self.processing_task = None
+        self.processing_tasks = {}
+        self.scheduler: BatchScheduler = None
+        self.preprocessor = I420Letterbox(self.ladder.size, max_batch=MAX_BATCH)
+        self.metrics = StageMetrics('yolo_bot')
+
+    def _serializer_for(self, key):
+        serializer = self.serializers.get(key)
+        if serializer is None:
+            serializer = DetectionSerializer(self.engine.names, DETECTION_WIRE_FORMAT, DETECTION_PUBLISH_MODE)
+            self.serializers[key] = serializer
+        return serializer
+
+    def _motion_gate_for(self, key):
+        gate = self.motion_gates.get(key)
+        if gate is None:
+            gate = MotionGate(MOTION_THRESHOLD, mask=parse_mask(MOTION_MASK), max_staleness=MOTION_MAX_STALENESS)
+            self.motion_gates[key] = gate
+        return gate
+
+    def _to_detections(self, rows, letterbox=None):
+        """將單張影像的偵測結果轉成要發送的座標資料；letterbox 不為 None 時換回原圖座標"""
+        detections = []
+        for x, y, width, height, confidence, class_id in rows.tolist():
+            # 引擎輸出已是正規化的左上角座標 [x, y, width, height]
+            box_xywh = [x, y, width, height]
+            if letterbox is not None:
+                box_xywh = letterbox.unletterbox(*box_xywh)
+
+            detections.append({
+                'label': self.engine.names[int(class_id)],
+                'confidence': confidence,
+                'box': box_xywh
+            })
+        return detections
+
+    def _infer_batch(self, batch):
+        """
+        在推理執行緒中執行：變化偵測 + 格式轉換 + 批次 YOLO 偵測 + 依軌道序列化。
+        多行程引擎回傳 Future，後處理與序列化在結果回來後於收集執行緒完成。
+        """
+        # receive：幀從事件迴圈收到到被排程器取出的等待時間
+        now = time.monotonic()
+        for _, (_, _, _, received_at) in batch:
+            self.metrics.observe('receive', now - received_at)
+
+        # 變化偵測：畫面沒變（且有上次結果）的軌道不推理，沿用上一次的偵測結果
+        with self.metrics.time('motion'):
+            planes = [livekit_i420_planes(buffer) for _, (_, _, buffer, _) in batch]
+            # 先呼叫 should_infer()：第一幀也要記錄成變化偵測的基準畫面
+            infer = [self._motion_gate_for(key).should_infer(y_plane) or key not in self.last_detections
+                     for (key, _), (y_plane, _, _) in zip(batch, planes)]
+        selected = [i for i, run in enumerate(infer) if run]
+
+        if selected:
+            # 這一批使用的推理尺寸；座標經由各幀的 LetterboxInfo 換回原圖，與尺寸無關
+            size = self.ladder.size
+            with self.metrics.time('convert'):
+                if YOLO_PREPROCESS == 'i420':
+                    # 直接從 I420 平面 letterbox 進預先配置的 float32 批次陣列，零複製交給模型
+                    self.preprocessor.set_imgsz(size)
+                    self.preprocessor.begin_batch()
+                    letterboxes = [self.preprocessor.add(*planes[i]) for i in selected]
+                else:
+                    # 將 LiveKit Frame 轉為 OpenCV 格式 (ndarray)
+                    # to_ndarray 是一個方便的輔助函數
+                    letterboxes = [None] * len(selected)
+                    images = [batch[i][1][2].to_ndarray(format="bgr24") for i in selected]
+
+            # --- 執行 YOLO 偵測：一次推理所有需要推理的軌道 ---
+            start = time.monotonic()
+            if YOLO_PREPROCESS == 'i420' and self.engine.asynchronous:
+                future = self.engine.detect_async(self.preprocessor.batch())
+                return chain_future(future, lambda results: self._finish_batch(
+                    batch, infer, selected, letterboxes, results, time.monotonic() - start, size))
+            if YOLO_PREPROCESS == 'i420':
+                results = self.engine.detect(self.preprocessor.batch())
+            else:
+                results = self.engine.detect_images(images, size)
+            return self._finish_batch(batch, infer, selected, letterboxes, results, time.monotonic() - start, size)
+        return self._finish_batch(batch, infer, selected, [], [], 0.0, None)
+
+    def _finish_batch(self, batch, infer, selected, letterboxes, results, elapsed, size):
+        """後處理推理結果，並把所有軌道（含沿用結果的）序列化成要發送的內容"""
+        if selected:
+            self.metrics.observe('infer', elapsed)
+            self.ladder.record(elapsed, size)
+            per_frame = elapsed / len(selected)
+            for i, result, letterbox in zip(selected, results, letterboxes):
+                key = batch[i][0]
+                with self.metrics.time('postprocess'):
+                    self.last_detections[key] = self._to_detections(result, letterbox)
+                self._motion_gate_for(key).record_inference(per_frame)
+
+        payloads = []
+        for (key, (seq, timestamp_us, _, received_at)), run in zip(batch, infer):
+            # 追蹤 + 序列化；沒有需要發送的內容時為 None
+            with self.metrics.time('serialize'):
+                payload = self._serializer_for(key).serialize(
+                    self.last_detections[key], seq, timestamp_us, reused=not run)
+            # 擷取時間戳與收到的時間一路帶到發布，用來計算端到端延遲
+            payloads.append((payload, timestamp_us, received_at) if payload is not None else None)
+        return payloads
 
-    async def _process_track(self, track: rtc.VideoTrack):
-        logging.info(f"Starting processing for track: {track.sid}")
+    async def _publish_detections(self, key, result):
+        """在事件迴圈中執行：透過 Data Channel 發送結果，topic 標示來源攝影機"""
+        payload, timestamp_us, received_at = result
+        start = time.monotonic()
+        try:
+            # 使用 RELIABLE 確保資料送達
+            await self.room.local_participant.publish_data(payload, kind=api.DataPacketKind.RELIABLE, topic=key)
+        except Exception as e:
+            logging.warning(f"Failed to publish data for {key}: {e}")
+            return
+        now = time.monotonic()
+        self.metrics.observe('publish', now - start)
+        # pipeline：Bot 內部從收到幀到送出結果；e2e：從擷取時間戳算起（需為 wall clock）
+        self.metrics.observe('pipeline', now - received_at)
+        self.metrics.observe_e2e(timestamp_us)
+
+    async def _broadcast_model_info(self):
+        """廣播模型資訊與類別名稱表（二進位格式以 class id 傳送標籤）"""
+        serializer = DetectionSerializer(self.engine.names, DETECTION_WIRE_FORMAT, DETECTION_PUBLISH_MODE)
+        payload = {
+            'type': 'modelList',
+            'models': [self.model_name],
+            'current': self.model_name,
+            'backend': self.engine.backend,
+            'classes': serializer.classes,
+            'wireFormat': serializer.wire_format,
+            'publishMode': serializer.publish_mode,
+            'tracks': {key: {**stats, 'motion': self.motion_gates[key].stats() if key in self.motion_gates else None}
+                       for key, stats in self.scheduler.stats()['tracks'].items()},
+            'preprocess': self.preprocessor.stats(),
+            'resolution': self.ladder.stats(),
+            'latency': self.metrics.summary()
+        }
+        try:
+            await self.room.local_participant.publish_data(json.dumps(payload).encode('utf-8'), kind=api.DataPacketKind.RELIABLE)
+        except Exception as e:
+            logging.warning(f"Failed to publish model info: {e}")
+
+    async def _process_track(self, track: rtc.VideoTrack, key: str):
+        logging.info(f"Starting processing for track: {track.sid} ({key})")
+        self.scheduler.add_track(key, TRACK_MAX_FPS)
         try:
             # 異步地從視訊軌道讀取每一幀
             async for frame in rtc.VideoSource.from_track(track):
-                # 將 LiveKit Frame 轉為 OpenCV 格式 (ndarray)
-                buffer = frame.frame
-                # to_ndarray 是一個方便的輔助函數
-                arr = buffer.to_ndarray(format="bgr24")
-
-                # --- 執行 YOLO 偵測 ---
-                results = self.model.predict(arr, verbose=False, device='cpu') # device='cpu' or '0' for GPU
-
-                # 準備要發送的座標資料
-                detections = []
-                for r in results:
-                    for box in r.boxes:
-                        # 獲取正規化的座標 [x_center, y_center, width, height]
-                        x_center, y_center, width, height = box.xyn[0].tolist()
-                        # 轉換為左上角座標 [x, y, width, height]
-                        x = x_center - (width / 2)
-                        y = y_center - (height / 2)
-                        
-                        detections.append({
-                            'label': self.model.names[int(box.cls)],
-                            'confidence': float(box.conf),
-                            'box': [x, y, width, height]
-                        })
-                
-                # --- 透過 Data Channel 發送結果 ---
-                if detections:
-                    payload = json.dumps(detections).encode('utf-8')
-                    try:
-                        # 使用 RELIABLE 確保資料送達
-                        await self.room.local_participant.publish_data(payload, kind=api.DataPacketKind.RELIABLE)
-                    except Exception as e:
-                        logging.warning(f"Failed to publish data: {e}")
-                
-                # 讓出控制權給 asyncio 事件迴圈，避免阻塞
-                await asyncio.sleep(0.01)
+                # 只把幀交給排程器，來不及處理的舊幀會被直接丟棄
+                seq = self.frame_seq.get(key, 0) + 1
+                self.frame_seq[key] = seq
+                self.scheduler.submit(key, (seq, frame.timestamp_us, frame.frame, time.monotonic()))
 
         except Exception as e:
             logging.error(f"Error while processing track {track.sid}: {e}", exc_info=True)
         finally:
-            logging.info(f"Finished processing for track: {track.sid}")
-
+            # 若已被同一發布者的新任務取代，槽位留給新任務使用
+            if self.processing_tasks.get(key) is asyncio.current_task():
+                self.scheduler.remove_track(key)
+            logging.info(f"Finished processing for track: {track.sid} ({key})")
 
     async def run(self):
         # 產生一個有訂閱和發布資料權限的 Token
@@ -92,23 +260,33 @@ class YoloProcessor:
                  )).to_jwt())
         
         self.room = rtc.Room()
+        # 所有攝影機共用一個模型，由排程器輪流取各軌道最新幀做批次推理
+        self.scheduler = BatchScheduler(self._infer_batch, self._publish_detections, asyncio.get_running_loop(),
+                                        max_batch=MAX_BATCH, max_fps=TRACK_MAX_FPS)
+        self.scheduler.start()
+        if METRICS_PORT:
+            self.metrics.start_http_server(METRICS_PORT, extra=lambda: {
+                'scheduler': self.scheduler.stats(), 'resolution': self.ladder.stats()})
+        self.metrics.start_reporter(METRICS_LOG_INTERVAL)
 
         @self.room.on("track_subscribed")
         async def on_track_subscribed(track: rtc.Track, publication: rtc.RemoteTrackPublication, participant: rtc.RemoteParticipant):
-            # 只處理來自指定發布者的視訊軌道
-            if track.kind == rtc.TrackKind.VIDEO and participant.identity == PUBLISHER_IDENTITY:
-                logging.info(f"Subscribed to video track from {participant.identity}, starting processing task.")
-                # 如果已有處理任務，先取消
-                if self.processing_task:
-                    self.processing_task.cancel()
+            # 只處理來自 webcam-publisher* 發布者的視訊軌道
+            if track.kind == rtc.TrackKind.VIDEO and participant.identity.startswith(PUBLISHER_IDENTITY_PREFIX):
+                key = participant.identity
+                logging.info(f"Subscribed to video track from {key}, starting processing task.")
+                # 同一個發布者如果已有處理任務，先取消
+                if key in self.processing_tasks:
+                    self.processing_tasks[key].cancel()
                 # 建立一個新的異步任務來處理這個軌道
-                self.processing_task = asyncio.create_task(self._process_track(track))
+                self.processing_tasks[key] = asyncio.create_task(self._process_track(track, key))
+                await self._broadcast_model_info()
         
         @self.room.on("disconnected")
         async def on_disconnected():
             logging.info("Disconnected from the room.")
-            if self.processing_task:
-                self.processing_task.cancel()
+            for task in self.processing_tasks.values():
+                task.cancel()
 
         try:
             logging.info(f"Connecting to room '{ROOM_NAME}' as '{YOLO_BOT_IDENTITY}'...")
@@ -121,13 +299,16 @@ class YoloProcessor:
             logging.error(f"Failed to connect or run the bot: {e}", exc_info=True)
         finally:
             logging.info("Shutting down bot.")
-            if self.processing_task:
-                self.processing_task.cancel()
+            for task in self.processing_tasks.values():
+                task.cancel()
+            self.scheduler.stop()
+            self.engine.close()
+            self.metrics.stop()
             if self.room and self.room.connection_state == rtc.ConnectionState.CONNECTED:
                 await self.room.disconnect()
 
 
-if __name__ == "__main__":
+def main():
     if not LIVEKIT_API_KEY or not LIVEKIT_API_SECRET:
         logging.error("FATAL: LIVEKIT_API_KEY and LIVEKIT_API_SECRET must be set.")
     else:
@@ -135,4 +316,8 @@ if __name__ == "__main__":
         try:
             asyncio.run(processor.run())
         except KeyboardInterrupt:
-            logging.info("Bot stopped by user.")
\ No newline at end of file
+            logging.info("Bot stopped by user.")
+
+
+if __name__ == "__main__":
+    main()